@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""
+Benchmark the overhead of ipynbtest using synthetic notebooks
+
+Each scenario generates a notebook along one of the axes cell count, stdout
+volume, image payload size, error rate and timeout rate. The notebook is
+tested with `run_notebook`, so its cells go through the same timeouts,
+interrupts and comparisons as in a normal test. The measured values are
+taken from the timing that `run_notebook` records for every cell. Every
+scenario runs in its own process, so the peak memory belongs to that
+scenario only.
+
+The results are saved as json and can be compared to those of another
+version of ipynbtest
+
+    python devtools/benchmark/benchmark.py --output new.json --compare old.json
+
+Reported for each scenario
+--------------------------
+- overhead    : mean seconds per cell not spent executing in the kernel
+- compare     : mean seconds per cell to wrap and compare the outputs
+- msgs/s      : iopub messages processed per second of wall time
+- MB/s        : text and data of messages processed per second
+- peak MB     : the peak resident memory of the process running the scenario
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import base64
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+from io import open
+
+import nbformat
+
+# use the ipynbtest of this checkout and not an installed version
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ipynbtest'))
+
+import ipynbtest as ipt  # noqa: E402
+
+
+# the default parameters of a scenario. Each scenario changes some of them.
+# The timeout of the cells that time out is in seconds
+default_params = {
+    'cells': 50,
+    'stdout_lines': 1,
+    'image_size': 0,
+    'error_rate': 0.0,
+    'timeout_rate': 0.0,
+    'timeout': 1
+}
+
+# the options of ipynbtest a scenario is tested with. A cell that times out
+# is not run again and a failed cell does not restart the notebook, so every
+# cell is run once
+test_options = [
+    '--no-cache', '--timeout', '60', '--timeout-factor', '0',
+    '--rerun-if-timeout', '0', '--restart-if-fail', '0']
+
+scenarios = [
+    ('baseline', {}),
+    ('cells', {'cells': 500}),
+    ('stdout', {'stdout_lines': 20000}),
+    ('images', {'image_size': 500 * 1024}),
+    ('errors', {'error_rate': 0.2}),
+    ('timeouts', {'cells': 20, 'timeout_rate': 0.1})
+]
+
+# the first cell of every notebook, defines the helpers used by the others
+SETUP_CODE = """
+import base64
+import time
+from IPython.display import publish_display_data
+
+def payload(size, seed):
+    data = bytearray((i * 7919 + seed) % 251 for i in range(size))
+    return base64.b64encode(bytes(data)).decode('ascii')
+"""
+
+
+def payload(size, seed):
+    """the base64 encoded data the kernel creates with the same arguments"""
+    data = bytearray((i * 7919 + seed) % 251 for i in range(size))
+    return base64.b64encode(bytes(data)).decode('ascii')
+
+
+def make_notebook(params, seed=0):
+    """create a notebook with stored outputs that match a new run
+
+    Parameters
+    ----------
+    params : dict
+        the parameters of the scenario, see `default_params`
+    seed : int, default 0
+        the seed for choosing the cells that fail or time out
+
+    Returns
+    -------
+    nbformat.NotebookNode
+        the notebook
+    """
+    # the rates are the exact fractions of the cells, so a scenario with few
+    # cells still has cells that time out or fail
+    rnd = random.Random(seed)
+    indices = list(range(params['cells']))
+    rnd.shuffle(indices)
+    n_timeouts = int(round(params['cells'] * params['timeout_rate']))
+    n_errors = int(round(params['cells'] * params['error_rate']))
+    timeouts = set(indices[:n_timeouts])
+    errors = set(indices[n_timeouts:n_timeouts + n_errors])
+
+    nb = nbformat.v4.new_notebook()
+    nb.cells.append(nbformat.v4.new_code_cell(SETUP_CODE))
+
+    for index in range(params['cells']):
+        outputs = []
+        if index in timeouts:
+            source = '#! timeout:%d\ntime.sleep(%d)' % (
+                params['timeout'], 2 * params['timeout'])
+        elif index in errors:
+            source = 'raise ValueError("cell %d")' % index
+            outputs.append(nbformat.v4.new_output(
+                'error', ename='ValueError', evalue='cell %d' % index,
+                traceback=[]))
+        else:
+            source = 'for i in range(%d):\n    print("cell %d line %%d" %% i)' % (
+                params['stdout_lines'], index)
+            outputs.append(nbformat.v4.new_output(
+                'stream', name='stdout', text=''.join(
+                    'cell %d line %d\n' % (index, i)
+                    for i in range(params['stdout_lines']))))
+
+            if params['image_size'] > 0:
+                source += "\npublish_display_data({'image/png': payload(%d, %d)})" % (
+                    params['image_size'], index)
+                outputs.append(nbformat.v4.new_output(
+                    'display_data', data={
+                        'image/png': payload(params['image_size'], index)}))
+
+        nb.cells.append(nbformat.v4.new_code_cell(source, outputs=outputs))
+
+    return nb
+
+
+def run_scenario(params):
+    """test a synthetic notebook and measure the harness
+
+    Parameters
+    ----------
+    params : dict
+        the parameters of the scenario, see `default_params`
+
+    Returns
+    -------
+    dict
+        the measured values of the scenario
+    """
+    nb = make_notebook(params)
+    output_types = ipt.select_output_types(['stdout', 'image/png'])
+
+    path = tempfile.mkdtemp(prefix='ipynbtest-benchmark-')
+    try:
+        ipynb = os.path.join(path, 'benchmark.ipynb')
+        nbformat.write(nb, ipynb)
+
+        args = ipt.get_parser().parse_args(test_options + [ipynb])
+        tv = ipt.create_console(args, stream=ipt.StringIO())
+        ipt.run_notebook(ipynb, args, output_types, tv)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+    # the setup cell is not part of the scenario
+    timings = [timing for timing in tv.cell_timings if timing['index'] > 0]
+
+    totals = {
+        key: sum(timing[key] for timing in timings)
+        for key in ['wall', 'busy', 'compare', 'messages', 'bytes']}
+
+    n_cells = float(max(1, len(timings)))
+    wall = max(totals['wall'], 1e-9)
+
+    peak_memory = None
+    if resource is not None:
+        # kilobytes on linux, bytes on macOS
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != 'darwin':
+            peak_memory *= 1024
+
+    return {
+        'params': params,
+        'startup': tv.phase_times.get('startup', 0.0),
+        'overhead': (totals['wall'] - totals['busy']) / n_cells,
+        'compare': totals['compare'] / n_cells,
+        'messages_per_second': totals['messages'] / wall,
+        'bytes_per_second': totals['bytes'] / wall,
+        'peak_memory': peak_memory,
+        'timeouts': tv.result_count['timeout'],
+        'diffs': tv.result_count['diff']
+    }
+
+
+def run_isolated(params):
+    """run a scenario in a fresh process so its peak memory is its own"""
+    pool = multiprocessing.Pool(processes=1)
+    try:
+        return pool.apply(run_scenario, (params,))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def git_revision():
+    """the git revision of this checkout or `unknown`"""
+    try:
+        out = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode('ascii').strip()
+    except Exception:
+        return 'unknown'
+
+
+def format_row(name, result):
+    peak = result['peak_memory']
+    return '%-10s %10.4f %10.4f %10.1f %10.2f %10s' % (
+        name, result['overhead'], result['compare'],
+        result['messages_per_second'], result['bytes_per_second'] / 1e6,
+        '%.1f' % (peak / 1e6) if peak is not None else '-')
+
+
+def write_table(results, reference=None):
+    """print the results and their ratio to the reference results"""
+    print('%-10s %10s %10s %10s %10s %10s' % (
+        'scenario', 'overhead', 'compare', 'msgs/s', 'MB/s', 'peak MB'))
+
+    for name, result in sorted(results.items()):
+        print(format_row(name, result))
+
+        if reference is not None and name in reference:
+            ref = reference[name]
+            ratios = []
+            for key in ['overhead', 'compare', 'messages_per_second',
+                        'bytes_per_second', 'peak_memory']:
+                if ref.get(key) and result.get(key) is not None:
+                    ratios.append('%10.2f' % (result[key] / float(ref[key])))
+                else:
+                    ratios.append('%10s' % '-')
+
+            print('%-10s %s' % ('  x ref', ' '.join(ratios)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Measure the overhead of ipynbtest with synthetic '
+                    'notebooks')
+
+    parser.add_argument(
+        '--scenarios', dest='scenarios',
+        type=str, default=','.join(name for name, _ in scenarios),
+        help='a comma separated list of the scenarios to run. Default is '
+             'all of "%s"' % ', '.join(name for name, _ in scenarios))
+
+    parser.add_argument(
+        '--scale', dest='scale',
+        type=float, default=1.0,
+        help='multiply the number of cells of all scenarios, e.g. 0.1 for a '
+             'quick check. Default is 1')
+
+    parser.add_argument(
+        '--output', dest='output',
+        type=str, default='',
+        help='a json file to save the results to')
+
+    parser.add_argument(
+        '--compare', dest='compare',
+        type=str, default='',
+        help='a json file with saved results to compare to')
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+
+    selected = [name.strip() for name in args.scenarios.split(',')]
+    unknown = set(selected) - set(name for name, _ in scenarios)
+    if unknown:
+        get_parser().error('unknown scenarios "%s"' % '", "'.join(unknown))
+
+    results = {}
+    for name, changes in scenarios:
+        if name not in selected:
+            continue
+
+        params = dict(default_params)
+        params.update(changes)
+        params['cells'] = max(1, int(params['cells'] * args.scale))
+
+        sys.stdout.write('running %s ... ' % name)
+        sys.stdout.flush()
+        results[name] = run_isolated(params)
+        sys.stdout.write('ok\n')
+
+    reference = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            reference = json.load(f)['results']
+
+    print('')
+    write_table(results, reference)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(u'%s' % json.dumps({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results
+            }, indent=1, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
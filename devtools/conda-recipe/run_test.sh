@@ -1,2 +1,4 @@
 #!/bin/sh
+set -e
+python -m pytest -v tests
 ipynbtest.py --eval "denom=0" --show-diff --timeout 2 --restart-if-fail 1 ipynbtest/examples/ipynbtest_tutorial.ipynb --tested-types "image/png, text/plain" --verbose --pylab
@@ -0,0 +1,6 @@
+"""
+Test ipython notebooks by running their cells and comparing the outputs
+
+The test runner is the script `ipynbtest.py`, `pytest_plugin` runs the same
+tests from pytest.
+"""
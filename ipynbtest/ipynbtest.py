@@ -2,21 +2,117 @@
 """
 Simple example script for running and testing IPython notebooks.
 
-usage: ipynbtest.py [-h] [-t TIMEOUT] [--rerun-if-timeout [RERUN]]
-                    [--restart-if-fail [RESTART]] [-l] [-s] [--eval [EVAL]]
-                    [--tested-types [TTYPES]] [--pass-if-timeout] [-d]
-                    [--abort-if-fail] [--extra-arguments [EXTRA_ARGUMENTS]]
-                    [-y] [-v]
-                    file.ipynb
+usage: ipynbtest.py [-h] [-j JOBS] [--shard SHARD] [--timings TIMINGS]
+                    [--result-file RESULT_FILE] [--merge] [--watch [WATCH]]
+                    [--cells CELLS] [--changed-since CHANGED_SINCE] [--record]
+                    [--golden] [--kernels KERNELS] [--serve [SERVE]]
+                    [--kernel-pool KERNEL_POOL] [--warmup WARMUP] [--no-cache]
+                    [--cache-dir CACHE_DIR] [--cache-size CACHE_SIZE]
+                    [--cache-fingerprint CACHE_FINGERPRINT] [-t TIMEOUT]
+                    [--timeout-factor TIMEOUT_FACTOR]
+                    [--min-timeout MIN_TIMEOUT]
+                    [--interrupt-timeout INTERRUPT_TIMEOUT]
+                    [--rerun-if-timeout [RERUN]] [--restart-if-fail [RESTART]]
+                    [-l] [-s] [--eval [EVAL]] [--tested-types [TTYPES]]
+                    [--rtol RTOL] [--atol ATOL]
+                    [--image-threshold IMAGE_THRESHOLD]
+                    [--image-tolerance IMAGE_TOLERANCE]
+                    [--image-size IMAGE_SIZE]
+                    [--stream-max-size STREAM_MAX_SIZE] [--pass-if-timeout]
+                    [-d] [--diff-context DIFF_CONTEXT]
+                    [--diff-max-lines DIFF_MAX_LINES] [--profile]
+                    [--profile-dump PROFILE_DUMP] [--abort-if-fail]
+                    [--extra-arguments [EXTRA_ARGUMENTS]] [-y] [-v]
+                    [file.ipynb ...]
 
 Run all cells in an ipython notebook as a test and check whether these
 successfully execute and compares their output to the one inside the notebook
 
 positional arguments:
-  file.ipynb            the notebook to be checked
+  file.ipynb            the notebooks to be checked. Directories are searched
+                        for notebooks and glob patterns like
+                        `examples/*.ipynb` are expanded
 
 optional arguments:
   -h, --help            show this help message and exit
+  -j JOBS, --jobs JOBS  the number of notebooks tested in parallel. Each
+                        notebook is run in its own kernel in a separate
+                        process. Default is 1
+  --shard SHARD         only test the i-th of N parts of the notebooks, e.g.
+                        `2/4`. The notebooks are split so that all parts take
+                        about the same time using the durations of earlier
+                        runs (see `--timings`) or the file size of new
+                        notebooks
+  --timings TIMINGS     the json file that records the duration of each
+                        notebook for `--shard`. It is updated after each run
+                        without `--shard` and by `--merge`, not with `--no-
+                        cache` unless this is given. Default is `timings.json`
+                        in the cache dir
+  --result-file RESULT_FILE
+                        a json file to write the results of all notebooks to,
+                        e.g. one for each shard
+  --merge               if set then the files are result files written with
+                        `--result-file` and their combined results are
+                        reported instead of testing notebooks
+  --watch [WATCH]       if set then the notebooks are tested again whenever
+                        they are saved, checking every given number of seconds
+                        (default 1). Each notebook keeps its kernel and only
+                        the first changed code cell and the cells after it are
+                        run
+  --cells CELLS         only run these cells and the cells they depend on,
+                        e.g. `3,5-7`. Cells are given by their index in the
+                        notebook counting from 0 like `Cell 3` of the pytest
+                        plugin. The dependencies are found from the names each
+                        cell defines and uses, see `#! uses` and `#! defines`
+  --changed-since CHANGED_SINCE
+                        only run the cells that changed since this git
+                        revision, e.g. `HEAD` or `main`, and the cells they
+                        depend on. All cells of a notebook that is not part of
+                        the revision are run
+  --record              store the outputs of all cells that run without error
+                        in `NOTEBOOK.golden.json.gz` next to each notebook.
+                        Only the tested mime types are stored, keyed by a hash
+                        of the cell source. Results are not cached
+  --golden              compare with the outputs stored by `--record` instead
+                        of the outputs in the notebook, which are not loaded.
+                        Cells without stored outputs are expected to have no
+                        output
+  --kernels KERNELS     run each notebook in each of these kernels at the same
+                        time, e.g. `python2,python3`. The kernels are given by
+                        the name of their kernelspec, see `jupyter kernelspec
+                        list`, and the result of each cell in each kernel is
+                        shown as a matrix. Default is the default kernel
+  --serve [SERVE]       run as a server on this unix socket and test the
+                        notebooks sent by `ipynbtest_client.py` with the same
+                        options as `ipynbtest.py`. Imports and a kernel pool
+                        (`--kernel-pool`, at least 1) are kept warm between
+                        jobs. Default socket is `ipynbtest-USER.sock` in the
+                        temp directory
+  --kernel-pool KERNEL_POOL
+                        the number of kernels that are started ahead of time
+                        and kept ready for the next notebook or restart. With
+                        `--jobs` each job has its own pool. Default is 0
+                        (start kernels when needed)
+  --warmup WARMUP       a python file that is run in every kernel after
+                        starting it, e.g. to import heavy packages. Together
+                        with `--kernel-pool` this happens before the kernel is
+                        needed
+  --no-cache            if set then all cells are run even if the notebook,
+                        its outputs and the options did not change since all
+                        cells passed the last time. Changes to the environment
+                        and to data files are only detected through `--cache-
+                        fingerprint`. The timing history is not updated unless
+                        `--timings` is given
+  --cache-dir CACHE_DIR
+                        the directory to store the results of passed cells.
+                        Default is `.ipynbtest_cache`
+  --cache-size CACHE_SIZE
+                        the maximal size of the cache in MB. Least recently
+                        used results are removed first. Default is 50
+  --cache-fingerprint CACHE_FINGERPRINT
+                        a string that describes the environment, e.g. a hash
+                        of the installed packages. Cached results are only
+                        used for the same fingerprint
   -t TIMEOUT, --timeout TIMEOUT
                         the default timeout time in seconds for a cell
                         evaluation. Default is 300s (5mins). Note that travis
@@ -25,6 +121,22 @@ optional arguments:
                         default limit by travis. However, a test cell that
                         takes this long should be split in more than one or
                         simplified.
+  --timeout-factor TIMEOUT_FACTOR
+                        the timeout of a cell that ran before is the 95th
+                        percentile of its recorded durations times this
+                        factor, but at least `--min-timeout` and at most
+                        `--timeout`. `#! timeout` is always used. The
+                        durations are kept in `timings.cells.json` next to
+                        `--timings`. Use 0 to always use `--timeout`. Default
+                        is 5
+  --min-timeout MIN_TIMEOUT
+                        the smallest timeout of a cell derived from its
+                        recorded durations, see `--timeout-factor`. Default is
+                        10s
+  --interrupt-timeout INTERRUPT_TIMEOUT
+                        a cell that timed out is interrupted. If it did not
+                        stop after this many seconds the kernel is restarted
+                        and the cells before it are run again. Default is 10s
   --rerun-if-timeout [RERUN]
                         if set then a timeout in a cell will cause to run the.
                         Default is 2 (means make up to 3 attempts)
@@ -45,19 +157,58 @@ optional arguments:
                         the argument will specify be output types to be
                         checked forequality. Currently the following types
                         "stream.stdout.text/plain, stream.stderr.text/plain,
+                        display_data.data.text/plain,
                         execute_result.data.text/plain,
                         display_data.data.image/png,
+                        execute_result.data.image/png,
                         display_data.data.image/svg,
-                        display_data.data.text/plain,
-                        execute_result.data.image/png " can be given as acomma
-                        `,` separated list. Default setting is
+                        stream.stdout.text/plain~numeric,
+                        stream.stderr.text/plain~numeric,
+                        display_data.data.text/plain~numeric,
+                        execute_result.data.text/plain~numeric,
+                        display_data.data.image/png~pixel,
+                        execute_result.data.image/png~pixel " can be given as
+                        acomma `,` separated list. Default setting is
                         "stdout.text/plain, data.text/plain" which will test
                         stdout and test/plain exeution results. No images will
                         be tested.
+  --rtol RTOL           the relative tolerance for numbers in outputs compared
+                        with the `numeric` types, e.g. `--tested-types
+                        numeric`. Default is 1e-05
+  --atol ATOL           the absolute tolerance for numbers in outputs compared
+                        with the `numeric` types. Default is 1e-08
+  --image-threshold IMAGE_THRESHOLD
+                        pixels of images compared with the `pixel` types count
+                        as different if a color channel differs by more than
+                        this value (0-255). Default is 10
+  --image-tolerance IMAGE_TOLERANCE
+                        the fraction of pixels that may differ for images
+                        compared with the `pixel` types. Default is 0.01
+  --image-size IMAGE_SIZE
+                        images compared with the `pixel` types are scaled down
+                        to this size in pixels before comparing. Use 0 to
+                        compare at full size. Default is 256
+  --stream-max-size STREAM_MAX_SIZE
+                        the maximal size in MB (million characters) kept of
+                        the stdout and stderr of a cell. Output beyond that is
+                        only compared by its length and hash. Use 0 to keep
+                        all output. Default is 16
   --pass-if-timeout     if set then a timeout (after last retry) is considered
                         a passed test
   -d, --show-diff       if set to true differences in the cell are shown in
                         `diff` style
+  --diff-context DIFF_CONTEXT
+                        the number of unchanged lines shown around each change
+                        with `--show-diff`. Default is 3
+  --diff-max-lines DIFF_MAX_LINES
+                        the maximal number of lines shown for each diff with
+                        `--show-diff`. Default is 500
+  --profile             if set then the time spent in each phase (kernel
+                        startup, waiting, execution, transport, comparison and
+                        output) and the slowest cells are shown at the end
+  --profile-dump PROFILE_DUMP
+                        a json file to write the timing, the number of
+                        messages and their size for every executed cell to
   --abort-if-fail       if set to true then a fail will stop the whole test.
   --extra-arguments [EXTRA_ARGUMENTS]
                         additional arguments passed to the ipython kernel on
@@ -109,16 +260,108 @@ Nov-4 2016
 - Compatibility with Python 3
 - Preparations for a first release
 
+Oct-18 2026
+- Test several notebooks in one call. Files, directories and glob patterns
+  are accepted and `--jobs N` tests up to N notebooks in parallel, each in its
+  own kernel that runs in the directory of the notebook
+- Fixed the startup of the kernel with recent versions of jupyter_client
+- Added `--kernel-pool N` to start kernels ahead of time and `--warmup` to
+  run a script (e.g. heavy imports) in every kernel before it is used
+- Added `#! checkpoint` cells. With `--restart-if-fail` a restart resumes
+  from the variables saved after the last checkpoint cell instead of running
+  the whole notebook again
+- Added a cache of passed cells. A notebook is not run again if its cells,
+  stored outputs and the options did not change since all cells passed.
+  Use `--no-cache` to run all notebooks
+- Rework of the execution of cells. Messages of all kernels are processed
+  by an event loop as soon as they arrive. The timeout of a cell is now the
+  total time the cell may take and not the time between two messages
+- Added `numeric` output types that compare numbers in text outputs with a
+  tolerance (`--rtol`, `--atol`). Use `--tested-types numeric` or `#! numeric`
+  for single cells
+- Faster diffs for `--show-diff` using patience diff. Only the lines around
+  a change are shown (`--diff-context`) and long diffs are cut after
+  `--diff-max-lines`. Diffs are only computed if they are shown
+- Added `pixel` output types that compare PNG images pixel by pixel with a
+  tolerance (`--image-threshold`, `--image-tolerance`). Needs Pillow. Decoded
+  images are cached and scaled down to `--image-size` before comparing
+- Output streams of a cell are collected in chunks with carriage returns
+  applied as the text arrives (e.g. progress bars). Text beyond
+  `--stream-max-size` is only compared by its length and hash
+- Every executed cell records its wall time, the time until the kernel
+  started it, the time the kernel was busy, the number and size of its
+  messages and the time of the comparison. `--profile` shows the time of each
+  phase and the slowest cells, `--profile-dump` writes all timings as json
+- Added a benchmark suite in `devtools/benchmark` that measures the overhead
+  per cell, the message throughput and the memory with synthetic notebooks
+- Stored outputs of mime types that are not tested (e.g. images by default)
+  are skipped when a notebook is read. Large notebooks load much faster and
+  need a fraction of the memory
+- Outputs are matched to output types using a table built once per set of
+  types instead of trying every type on every output
+- Added `--shard i/N` to test only a part of the notebooks, e.g. on one of
+  several CI machines. Parts take about the same time using the durations
+  of earlier runs (`--timings`). `--result-file` writes the results of a
+  part and `--merge` combines the result files into one report
+- Added a pytest plugin (`pytest --nbtest`) that collects notebooks as files
+  and code cells as tests and works with pytest-xdist
+- Added `--serve` to keep imports and kernels warm in a server on a unix
+  socket. `ipynbtest_client.py` sends it notebooks to test and prints the
+  same output as `ipynbtest.py`
+- Added `--watch` to test notebooks again when they are saved. The kernel
+  is kept and only the first changed code cell and the cells after it run
+- The timeout of a cell is derived from its recorded durations
+  (`--timeout-factor`, `--min-timeout`) with `--timeout` as the upper bound
+- A cell that timed out is interrupted, so a rerun does not wait for it. If
+  it cannot be interrupted the kernel is restarted and the cells before it
+  are run again (`--interrupt-timeout`)
+- The messages of the kernels are read by a background thread into a
+  bounded queue for each cell. Messages of `--eval` and of interrupted cells
+  are dropped instead of kept until the end. `--profile` shows the queued
+  and dropped messages of the slowest cells
+- Added `--cells 3,5-7` and `--changed-since REV` to run only some cells and
+  the cells they depend on, found from the names each cell defines and uses
+- The next cell is started while the outputs of a cell are compared. Not
+  if the result of the cell could abort or restart the test
+- Text outputs larger than 64 KB are compared by a hash of their sanitized
+  text instead of a sanitized copy
+- Added `--record` to store the tested outputs of a notebook in a compressed
+  file next to it, keyed by a hash of the cell source. `--golden` compares
+  with the stored outputs, so notebooks can be committed without outputs
+- Added `--kernels python2,python3` to run each notebook in several
+  kernelspecs at the same time and show the result of each cell in each
+  kernel as a matrix
+
 The original is found in a gist under https://gist.github.com/minrk/2620735
 """
 
 import os
 import sys
 import re
+import ast
 import argparse
 import uuid
-import difflib
+import itertools
+import bisect
+import base64
+import mmap
+import gzip
+from collections import OrderedDict, deque
 import time
+import math
+import glob
+import json
+import shutil
+import signal
+import socket
+import getpass
+import hashlib
+import traceback
+import tempfile
+import subprocess
+import multiprocessing
+import threading
+from multiprocessing.util import Finalize
 
 # --------------------------------
 # Compatibility with IPython 4.0.0
@@ -127,6 +370,7 @@ import time
 try:
     # IPython 4.0.0+ / Jupyter - the big split
     from jupyter_client.manager import KernelManager
+    from jupyter_client.kernelspec import KernelSpecManager
     import nbformat
 
     # print('Found Jupyter / IPython 4+')
@@ -134,10 +378,14 @@ try:
 except ImportError:
     # IPython 3.0.0+
     from IPython.kernel.manager import KernelManager
+    from IPython.kernel.kernelspec import KernelSpecManager
     import IPython.nbformat as nbformat
 
     # print('Using IPython 3+')
 
+# pyzmq is used by all versions to talk to the kernel
+import zmq
+
 
 # -------------------------------
 # Compatibility with Python 2 / 3
@@ -153,14 +401,47 @@ except NameError:
 # use better open to always read unicode
 from io import open
 
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+# numpy is optional and only used to speed up comparisons
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Pillow is optional and needed to compare images pixel by pixel
+try:
+    from PIL import Image, ImageChops
+except ImportError:
+    Image = None
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from io import BytesIO
+
+try:
+    # Python 2 StringIO accepts str and unicode
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 
 class TravisConsole(object):
     """
     A wrapper class to allow easier output to the console especially for travis
     """
 
-    def __init__(self):
-        self.stream = sys.stdout
+    def __init__(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+
+        self.stream = stream
         self.linebreak = '\n'
         self.fold_count = dict()
         self.fold_stack = dict()
@@ -253,7 +534,7 @@ class TravisConsole(object):
         self.stream.flush()
 
     def warning(self, s):
-        self.write(tv.red(s))
+        self.write(self.red(s))
 
     @staticmethod
     def red(s):
@@ -310,15 +591,16 @@ class TravisConsole(object):
         return BLUE + s + DEFAULT
 
     def format_diff(self, difference):
-        """format a list of diff commands for travis output
+        """format diff commands for travis output
 
         this will remove empty lines, lines starting with `?` and
         add coloring depending on whether a line starts with `+` or `-`
 
         Parameters
         ----------
-        difference : list of diff (string)
-            the list of diff commands to be formatted
+        difference : iterable of diff (string)
+            the diff commands to be formatted, e.g. a generator returned
+            by `line_diff`
 
         Returns
         -------
@@ -327,19 +609,19 @@ class TravisConsole(object):
         """
         colored_diffs = []
         for ll in difference:
+            # remove unnecessary linebreaks
+            ll = ll.replace('\n', '')
+
+            # remove line we do not want
+            if len(ll) == 0 or ll[0] == '?':
+                continue
+
             if ll[0] == '-':
-                colored_diffs.append(self.red(ll))
+                ll = self.red(ll)
             elif ll[0] == '+':
-                colored_diffs.append(self.green(ll))
-            else:
-                colored_diffs.append(ll)
+                ll = self.green(ll)
 
-        # remove unnecessary linebreaks
-        colored_diffs = [ll.replace('\n', '') for ll in colored_diffs]
-
-        # remove line we do not want
-        colored_diffs = [ll for ll in colored_diffs
-                         if len(ll) > 0 and ll[0] != '?']
+            colored_diffs.append(ll)
 
         return '\n'.join(colored_diffs)
 
@@ -349,8 +631,8 @@ class IPyTestConsole(TravisConsole):
     Add support for different output results
     """
 
-    def __init__(self):
-        super(IPyTestConsole, self).__init__()
+    def __init__(self, stream=None):
+        super(IPyTestConsole, self).__init__(stream)
 
         self.default_results = {
             'success': True,  # passed without differences
@@ -367,12 +649,54 @@ class IPyTestConsole(TravisConsole):
         self.result_count = dict()
         self.last_fail = False
 
+        # the cell the next result belongs to and all results so far as
+        # tuples of (cell, result, passed)
+        self.current_cell = None
+        self.cell_results = []
+
+        # the timing of all executed cells and the total time spent in each
+        # phase of the test. Unlike the results these are kept on a restart
+        self.cell_timings = []
+        self.phase_times = {}
+
+        # True if the results were taken from the result cache, so the run
+        # time is not the duration of the notebook
+        self.cached = False
+
         self.reset()
 
     def reset(self):
         self.result_count = {key: 0 for key in self.default_results.keys()}
         self.pass_count = 0
         self.fail_count = 0
+        self.cell_results = []
+
+    def keep_results(self, cell_results):
+        """count the results of cells of an earlier run that are not run again
+
+        Parameters
+        ----------
+        cell_results : list of tuple
+            the results as (cell, result, passed) like in `cell_results`
+        """
+        for cell, result, passed in cell_results:
+            if passed:
+                self.pass_count += 1
+            else:
+                self.fail_count += 1
+
+            self.result_count[result] += 1
+            self.cell_results.append((cell, result, passed))
+
+    def add_time(self, phase, seconds):
+        """add time spent in a phase of the test like `startup` or `comparison`
+        """
+        self.phase_times[phase] = self.phase_times.get(phase, 0.0) + seconds
+
+    def write(self, s, indent=0):
+        start_time = time.time()
+        super(IPyTestConsole, self).write(s, indent)
+        self.add_time('output', time.time() - start_time)
 
     def write_result(self, result, okay_list=None):
         """write final result of test
@@ -394,464 +718,4840 @@ class IPyTestConsole(TravisConsole):
 
         self.writeln(' [' + result + ']')
         self.result_count[result] += 1
+        self.cell_results.append((self.current_cell, result, not self.last_fail))
 
+    def write_summary(self, run_time):
+        """write the result counts of a notebook
 
-class IPyKernel(object):
-    """
-    A simple wrapper class to run cells in an IPython Notebook.
+        Parameters
+        ----------
+        run_time : float
+            the time the test took in seconds
+        """
+        self.writeln("  testing results (%5.3f seconds)" % run_time)
+        self.writeln("  ================================")
+        if self.pass_count > 0:
+            self.writeln("    %3i cells passed [" %
+                         self.pass_count + self.green('ok') + "]")
+        if self.fail_count > 0:
+            self.writeln("    %3i cells failed [" %
+                         self.fail_count + self.red('fail') + "]")
+
+        self.br()
+        self.writeln("  %3i cells successfully replicated [success]" %
+                     self.result_count['success'])
+        self.writeln("  %3i cells had mismatched outputs [diff]" %
+                     self.result_count['diff'])
+        self.writeln("  %3i cells timed out during execution [time]" %
+                     self.result_count['timeout'])
+        self.writeln("  %3i cells ran with python errors [error]" %
+                     self.result_count['error'])
+        self.writeln("  %3i cells have been run without comparison [ignore]" %
+                     self.result_count['ignore'])
+        self.writeln("  %3i cells failed to even run (IPython error) [kernel]" %
+                     self.result_count['kernel'])
+        self.writeln("  %3i cells have been skipped [skip]" %
+                     self.result_count['skip'])
+
+
+# run in the kernel to save all variables of the notebook to `path`
+CHECKPOINT_SAVE_CODE = """
+import json
+import types
+from IPython import get_ipython
 
-    Notes
-    -----
-    - Use `with` construct to properly instantiate
-    - IPython 3.0.0+ is assumed for this version
+try:
+    import dill as pickle
+    by_value = True
+except ImportError:
+    import pickle
+    by_value = False
+
+shell = get_ipython()
+modules = {}
+values = {}
+skipped = []
+
+for name, value in list(shell.user_ns.items()):
+    if name.startswith('_') or name in shell.user_ns_hidden:
+        continue
+
+    if isinstance(value, types.ModuleType):
+        modules[name] = value.__name__
+        continue
+
+    if not by_value and '__main__' in (
+            getattr(value, '__module__', None),
+            getattr(type(value), '__module__', None)):
+        # pickle stores functions and classes of the notebook by reference
+        # and these do not exist in a new kernel
+        skipped.append(name)
+        continue
+
+    try:
+        pickle.dumps(value, 2)
+        values[name] = value
+    except Exception:
+        skipped.append(name)
+
+with open(path, 'wb') as f:
+    pickle.dump({'modules': modules, 'values': values}, f, 2)
+
+with open(path + '.json', 'w') as f:
+    json.dump({'skipped': sorted(skipped)}, f)
+"""
 
-    """
+# run in the kernel to restore the variables saved to `path`
+CHECKPOINT_LOAD_CODE = """
+import importlib
+from IPython import get_ipython
 
-    def __init__(self, nb_version=4, extra_arguments=None):
-        # default timeout time is 60 seconds
-        self.default_timeout = 60
+try:
+    import dill as pickle
+except ImportError:
+    import pickle
 
-        if extra_arguments is None:
-            extra_arguments = []
-        self.extra_arguments = extra_arguments
-        self.nb_version = nb_version
+shell = get_ipython()
 
-    def __enter__(self):
-        self.km = KernelManager()
-        self.km.start_kernel(
-            extra_arguments=self.extra_arguments,
-            stderr=open(os.devnull, 'w')
-        )
+with open(path, 'rb') as f:
+    state = pickle.load(f)
 
-        self.kc = self.km.client()
-        self.kc.start_channels()
+for name, module in state['modules'].items():
+    shell.user_ns[name] = importlib.import_module(module)
 
-        self.iopub = self.kc.iopub_channel
-        self.shell = self.kc.shell_channel
+shell.user_ns.update(state['values'])
+"""
 
-        # run %pylab inline, because some notebooks assume this
-        # even though they shouldn't
 
-        self.shell.send("pass")
-        self.shell.get_msg()
-        while True:
-            try:
-                self.iopub.get_msg(timeout=0.05)
-            except Exception as e:
-                if repr(e) == 'Empty()':
-                    break
+def collapse_carriage_returns(line):
+    """apply the carriage returns in a line of text like a console would
 
-                # we got a real error so raise it
-                raise
+    Text after a carriage return replaces everything before it. A trailing
+    carriage return is kept until the next text arrives.
 
-        self.cmd_list = []
-        self.msg_list = {}
+    Parameters
+    ----------
+    line : string
+        a line of text without newlines
 
-        return self
+    Returns
+    -------
+    string
+        the line as it is displayed
+    """
+    if '\r' not in line:
+        return line
 
-    def clear(self):
-        self.iopub.get_msgs()
+    collapsed = line.rstrip('\r').rsplit('\r', 1)[-1]
+    if line.endswith('\r'):
+        collapsed += '\r'
 
-    def execute(self, cmd):
-        uid = self.kc.execute(cmd)
-        self.cmd_list.append((uid, cmd))
-        return uid
+    return collapsed
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.kc.stop_channels()
-        self.km.shutdown_kernel()
-        del self.msg_list
-        del self.cmd_list
-        del self.km
 
-    def listen(self, uid, use_timeout=None):
-        if use_timeout is None:
-            use_timeout = self.default_timeout
+class StreamBuffer(object):
+    """
+    Collect the text of an output stream in chunks with limited memory
 
-        while True:
-            if uid in self.msg_list and len(self.msg_list[uid]) > 0:
-                return self.msg_list[uid].pop(0)
+    Carriage returns are applied as the text arrives, so progress bars keep
+    only their last state. Once the completed lines grow above `max_size`
+    characters only the beginning is kept and the rest is summarized by its
+    length and sha1 hash. As long as no line is longer than `max_size`
+    characters after applying its carriage returns, the resulting text does
+    not depend on how the text was split into chunks, so stored outputs can
+    be bounded the same way using `stream_text`.
+
+    Notes
+    -----
+    - The last line is limited to `max_size` characters on its own. A longer
+      line is cut as it arrives and a carriage return after the cut does not
+      replace the part that was cut. So the text of such a line depends on
+      the chunks it arrived in and may differ from `stream_text`
+
+    Examples
+    --------
+    >>> buf = StreamBuffer()
+    >>> buf.write('10%\\r')
+    >>> buf.write('100%\\n')
+    >>> buf.getvalue()
+    '100%\\n'
+    """
 
-            msg = self.iopub.get_msg(timeout=use_timeout)
-            if 'msg_id' in msg['parent_header']:
-                msg_uid = msg['parent_header']['msg_id']
+    # characters kept free at the end of the text for the summary line
+    reserve = 128
 
-                if msg_uid not in self.msg_list:
-                    self.msg_list[msg_uid] = []
+    def __init__(self, max_size=None):
+        self.max_size = max_size
 
-                self.msg_list[msg_uid].append(msg)
+        # the completed lines and their number of characters
+        self.lines = []
+        self.size = 0
 
-    def run(self, cell, use_timeout=None):
+        # the pieces of the last line, which is not terminated yet
+        self.line = []
+        self.line_size = 0
+
+        # once the text exceeds `max_size`, the kept beginning and the hash
+        # and number of characters of the rest
+        self.head = None
+        self.digest = None
+        self.skipped = 0
+
+    def write(self, text):
         """
-        Run a notebook cell in the IPythonKernel
+        Add a chunk of text
 
         Parameters
         ----------
-        cell : IPython.notebook.Cell
-            the cell to be run
-        use_timeout : int or None (default)
-            the time in seconds after which a cell is stopped and assumed to
-            have timed out. If set to None the value in `default_timeout`
-            is used
+        text : string
+            the text as sent by the kernel
+        """
+        if not text:
+            return
+
+        pending_return = self.line and self.line[-1].endswith('\r')
+
+        if '\n' not in text and '\r' not in text and not pending_return:
+            # many small prints just extend the last line
+            self.line.append(text)
+            self.line_size += len(text)
+        else:
+            parts = (''.join(self.line) + text).split('\n')
+
+            completed = [
+                collapse_carriage_returns(part).rstrip('\r') + '\n'
+                for part in parts[:-1]]
+
+            if self.digest is None:
+                self.lines.extend(completed)
+                self.size += sum(len(line) for line in completed)
+            else:
+                self._skip(''.join(completed))
+
+            last = collapse_carriage_returns(parts[-1])
+            self.line = [last]
+            self.line_size = len(last)
+
+        if self.max_size is not None:
+            if self.digest is None and self.size > self.max_size:
+                self._cut()
+
+            if self.line_size > self.max_size:
+                # keep a very long line from growing further
+                last = ''.join(self.line)
+                if self.digest is None:
+                    self.lines.append(last)
+                    self.size += len(last)
+                    self._cut()
+                else:
+                    self._skip(last)
+
+                self.line = []
+                self.line_size = 0
+
+    def _cut(self):
+        text = ''.join(self.lines)
+        keep = max(0, self.max_size - self.reserve)
+
+        self.head = text[:keep]
+        self.digest = hashlib.sha1()
+        self._skip(text[keep:])
+
+        self.lines = []
+        self.size = 0
+
+    def _skip(self, text):
+        self.digest.update(text.encode('utf-8'))
+        self.skipped += len(text)
+
+    def getvalue(self):
+        """
+        Return the text collected so far
 
         Returns
         -------
-        list of ex_cell_outputs
-            a list of NotebookNodes of the returned types. This is
-            similar to the list of outputs generated when a cell is run
+        string
+            the text with carriage returns applied and the lines above
+            `max_size` characters summarized
         """
+        last = ''.join(self.line).rstrip('\r')
 
-        if timeout is not None:
-            use_timeout = use_timeout
-        else:
-            use_timeout = self.default_timeout
+        if self.digest is None:
+            return ''.join(self.lines) + last
 
-        if hasattr(cell, 'source'):
-            uid = self.execute(cell.source)
-        else:
-            raise AttributeError('No source/input key')
+        digest = self.digest.copy()
+        digest.update(last.encode('utf-8'))
 
-        outs = []
-        stdout_cells = {}
+        return self.head + '\n[... %d characters skipped, sha1 %s]\n' % (
+            self.skipped + len(last), digest.hexdigest())
 
-        while True:
-            msg = self.listen(uid, use_timeout)
 
-            msg_type = msg['msg_type']
+def stream_text(text, max_size=None):
+    """apply carriage returns and the size limit of a `StreamBuffer`
 
-            if msg_type == 'execute_input':
-                continue
-            elif msg_type == 'clear_output':
-                outs = []
-                continue
-            elif msg_type == 'status':
-                if msg['content']['execution_state'] == 'idle':
-                    # we are done with the cell, let's compare
-                    break
+    Parameters
+    ----------
+    text : string
+        the complete text of an output stream
+    max_size : int or None (default)
+        the maximal number of characters. If None the size is not limited
 
-                continue
+    Returns
+    -------
+    string
+        the text as a `StreamBuffer` would return it
+    """
+    if '\r' not in text and (max_size is None or len(text) <= max_size):
+        return text
 
-            out_cell = nbformat.NotebookNode(output_type=msg_type)
+    buf = StreamBuffer(max_size)
+    buf.write(text)
+    return buf.getvalue()
 
-            content = msg['content']
 
-            if msg_type == 'stream':
-                name = content['name']
-                if name not in stdout_cells:
-                    out_cell.name = name
-                    out_cell.text = content['text']
-                    stdout_cells[name] = out_cell
-                    outs.append(out_cell)
-                else:
-                    # we already have a stdout cell, so append to it
-                    stdout_cells[name].text += content['text']
+def payload_size(content):
+    """the number of characters of text and data in the content of a message
 
-            elif msg_type in ('display_data', 'execute_result'):
-                if hasattr(content, 'execution_count'):
-                    out_cell['execution_count'] = content['execution_count']
-                else:
-                    out_cell['execution_count'] = None
+    Parameters
+    ----------
+    content : dict
+        the content of a message
 
-                out_cell['data'] = content['data']
-                out_cell['metadata'] = content['metadata']
+    Returns
+    -------
+    int
+        the total length of all strings in the content and in its `data`
+    """
+    size = 0
+    for value in content.values():
+        if isinstance(value, dict):
+            value = list(value.values())
 
-                outs.append(out_cell)
+        if isinstance(value, basestring):
+            size += len(value)
+        elif isinstance(value, list):
+            size += sum(len(v) for v in value if isinstance(v, basestring))
 
-            elif msg_type == 'error':
-                out_cell.ename = content['ename']
-                out_cell.evalue = content['evalue']
-                out_cell.traceback = content['traceback']
+    return size
 
-                outs.append(out_cell)
 
-            elif msg_type.startswith('comm_'):
-                # messages used to initialize, close and unpdate widgets
-                # we will ignore these and hope for the best
-                pass
+class CellExecution(object):
+    """
+    The outputs of a single cell collected from the messages of its execution
 
-            else:
-                tv.warning("Unhandled iopub msg of type `%s`" % msg_type)
+    Notes
+    -----
+    - Created by `IPyKernel.submit`
+    - The execution is `done` once the kernel reports to be idle again. If
+      this does not happen before the `deadline` it is `timed_out`
+    - The text of stream outputs is collected in a `StreamBuffer` limited to
+      `stream_max_size` characters of the kernel and set when the execution
+      is done
+    - The time of submitting, of the `execute_input` message and when the
+      kernel became busy and idle again are recorded, see `timing`
+    - The messages are queued by the `KernelEventLoop` of the kernel until
+      they are handled. The largest number of queued messages is
+      `peak_depth`
+    """
 
-        return outs
+    def __init__(self, ipy, uid, use_timeout):
+        self.ipy = ipy
+        self.uid = uid
+        self.submit_time = time.time()
+        self.deadline = self.submit_time + use_timeout
 
-    def get_commands(self, cell):
-        """
-        Extract potential commands from the first line of a cell
+        self.input_time = None
+        self.busy_time = None
+        self.idle_time = None
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.peak_depth = 0
 
-        if a code cell starts with the hashbang `#!` it can be followed by
-        a comma separated list of commands. Each command can be
-        1. a single key `skip`, or
-        2. a key/value pair separated by a colon `timeout:[int]`
+        self.outs = []
+        self.stdout_cells = {}
+        self.stream_buffers = {}
 
-        Parameters
-        ----------
-        cell : a NotebookCell
-            the cell to be examined
+        self.done = False
+        self.timed_out = False
+
+    @property
+    def finished(self):
+        return self.done or self.timed_out
+
+    @property
+    def timing(self):
+        """
+        The timing and the messages of the execution so far
 
         Returns
         -------
         dict
-            a dict of key/value pairs. For a single command the value is `True`
+            `wait` the seconds from submitting until the kernel started the
+            cell, `busy` the seconds the kernel was busy, `messages` the number
+            of iopub messages, `bytes` the size of their text and data and
+            `queued` the largest number of messages waiting to be handled
         """
-        commands = {}
-        source = cell.source
-        if source is not None:
-            lines = source.splitlines()
-            if len(lines) > 0:
-                n_line = 0
-                line = lines[n_line].strip()
-                while line.startswith('#!') or len(line) == 0:
-                    txt = line[2:].strip()
-
-                    parts = txt.split(',')
-                    for part in parts:
-                        subparts = part.split(':')
-                        if len(subparts) == 1:
-                            commands[subparts[0].strip().lower()] = True
-                        elif len(subparts) == 2:
-                            commands[subparts[0].strip().lower()] = subparts[1]
-
-                    n_line += 1
-                    line = lines[n_line]
-
-        return commands
+        end_time = self.idle_time or time.time()
+
+        return {
+            'wait': (self.input_time or end_time) - self.submit_time,
+            'busy': end_time - (self.busy_time or end_time),
+            'messages': self.n_messages,
+            'bytes': self.n_bytes,
+            'queued': self.peak_depth
+        }
 
-    def is_empty_cell(self, cell):
+    def handle(self, msg):
         """
-        Check if a cell has no code
+        Add the content of an iopub message to the outputs
 
         Parameters
         ----------
-        cell : a NotebookCell
-            the cell to be examined
-
-        Returns
-        -------
-        bool
-            True if the cell has no code, False otherwise
+        msg : dict
+            the message sent by the kernel for this execution
         """
-        return not bool(cell.source)
+        msg_type = msg['msg_type']
+
+        self.n_messages += 1
+        self.n_bytes += payload_size(msg['content'])
+
+        if msg_type == 'execute_input':
+            self.input_time = time.time()
+            return
+        elif msg_type == 'clear_output':
+            self.outs = []
+            self.stdout_cells = {}
+            self.stream_buffers = {}
+            return
+        elif msg_type == 'status':
+            if msg['content']['execution_state'] == 'busy':
+                self.busy_time = time.time()
+
+            if msg['content']['execution_state'] == 'idle':
+                self.idle_time = time.time()
+
+                # we are done with the cell, let's compare
+                for name, buf in self.stream_buffers.items():
+                    self.stdout_cells[name].text = buf.getvalue()
+
+                self.done = True
+
+            return
+
+        out_cell = nbformat.NotebookNode(output_type=msg_type)
+
+        content = msg['content']
+
+        if msg_type == 'stream':
+            name = content['name']
+            if name not in self.stdout_cells:
+                out_cell.name = name
+                out_cell.text = ''
+                self.stdout_cells[name] = out_cell
+                self.stream_buffers[name] = StreamBuffer(
+                    self.ipy.stream_max_size)
+                self.outs.append(out_cell)
+
+            # the text is set from the buffer once the cell is done
+            self.stream_buffers[name].write(content['text'])
+
+        elif msg_type in ('display_data', 'execute_result'):
+            if hasattr(content, 'execution_count'):
+                out_cell['execution_count'] = content['execution_count']
+            else:
+                out_cell['execution_count'] = None
 
+            out_cell['data'] = content['data']
+            out_cell['metadata'] = content['metadata']
 
-class TypedOutput(object):
-    """
-    Simple class to define possible outputs like stdout, png, etc
+            self.outs.append(out_cell)
 
-    It will know how to detect these, have a name by which to address the
-    type and can compare
+        elif msg_type == 'error':
+            out_cell.ename = content['ename']
+            out_cell.evalue = content['evalue']
+            out_cell.traceback = content['traceback']
+
+            self.outs.append(out_cell)
+
+        elif msg_type.startswith('comm_'):
+            # messages used to initialize, close and unpdate widgets
+            # we will ignore these and hope for the best
+            pass
+
+        elif self.ipy.console is not None:
+            self.ipy.console.warning(
+                "Unhandled iopub msg of type `%s`" % msg_type)
 
+
+class KernelEventLoop(object):
+    """
+    Route the messages of many kernels to their executions
+
+    A reader thread waits on the iopub sockets of all kernels of the loop and
+    puts each message in the queue of the execution it belongs to as soon as
+    it arrives, also while no cell is waited for. Messages of requests that
+    are not (or no longer) waited for, e.g. of `--eval` or of a cell that
+    timed out, are dropped right away. `wait` hands the queued messages to
+    their executions, so executions on different kernels progress at the
+    same time while one of them is waited for.
+
+    The queue of an execution holds at most `queue_size` messages. If it is
+    full the reader waits until the messages are processed.
+
+    Attributes
+    ----------
+    dropped : int
+        the number of messages dropped because no execution waited for them
+    peak_depth : int
+        the largest number of messages queued for an execution
+
+    Examples
+    --------
+    >>> loop = KernelEventLoop()
+    >>> cell = nbformat.v4.new_code_cell('print(1 + 1)')
+    >>> with IPyKernel(loop=loop) as k1, IPyKernel(loop=loop) as k2:
+    ...     executions = [k1.submit(cell), k2.submit(cell)]
+    ...     loop.wait(executions)
+    >>> [execution.outs[0].text for execution in executions]
+    ['2\\n', '2\\n']
     """
 
-    mime = ''
-    name = ''
-    output_type = ''
+    # the maximal number of messages queued for a single execution
+    queue_size = 1000
 
-    def __init__(self, output):
-        self._out = output
-        self._key = None
+    # the seconds the reader waits for messages before it looks for added
+    # or removed kernels
+    poll_interval = 0.1
 
-    def __nonzero__(self):
-        return self.otype == self.output_type
+    def __init__(self):
+        self.kernels = {}
+        self.executions = {}
+        self.queues = {}
 
-    def __bool__(self):
-        return self.__nonzero__()
+        # guards all of the above. Notified whenever messages are queued or
+        # taken and after each round of the reader
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
 
-    def __eq__(self, other):
-        if type(other) is type(self):
-            return self.key == other.key
-        else:
-            raise NotImplemented
+        self.thread = None
+        self.version = 0
+        self.rounds = 0
 
-    def __ne__(self, other):
-        if type(other) is not type(self):
-            return True
-        else:
-            return self.key != other.key
+        self.dropped = 0
+        self.peak_depth = 0
 
-    @property
-    def key(self):
-        if self._key is None:
-            self._key = self._cmp_key()
+    def add(self, ipy):
+        """
+        Read the messages of a started kernel in this loop
+        """
+        with self.lock:
+            self.kernels[ipy.iopub.socket] = ipy
+            self.version += 1
 
-        return self._key
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._read)
+                self.thread.daemon = True
+                self.thread.start()
 
-    def _cmp_key(self):
-        return ''
+    def remove(self, ipy):
+        """
+        Stop reading the messages of a kernel and drop its executions
 
-    def compare_str(self, other):
-        return ['>>> diff in %s' % str(self)] + \
-            self.run_ndiff(self.key, other.key)
+        Returns once the reader no longer uses the socket of the kernel, so
+        its channels can be closed.
+        """
+        with self.lock:
+            if self.kernels.pop(ipy.iopub.socket, None) is None:
+                return
 
-    @property
-    def otype(self):
-        return self._out['output_type']
+            self.version += 1
+            for uid, execution in list(self.executions.items()):
+                if execution.ipy is ipy:
+                    self._discard(uid)
 
-    def __str__(self):
-        return self.identifier
+            if self.thread is threading.current_thread():
+                return
 
-    @property
-    def identifier(self):
-        return '%s.%s.%s' % (self.output_type, self.name, self.mime)
+            # wait for the reader to start a new round
+            rounds = self.rounds
+            while self.thread is not None and self.rounds == rounds:
+                self.changed.wait(self.poll_interval)
 
-    @staticmethod
-    def sanitize(s):
-        """sanitize a string for comparison.
+    def register(self, execution):
+        """
+        Queue the messages of an execution until it is done or cancelled
 
-        fix universal newlines, strip trailing newlines, and normalize likely
-        random values (memory addresses and UUIDs)
+        Must be called with `lock` held and before the request is sent, so
+        no message of the execution is dropped.
+        """
+        self.executions[execution.uid] = execution
+        self.queues[execution.uid] = deque()
 
-        Parameters
-        ----------
-        s : str
-            string to be sanitized, i.e. remove UUIDs, Hex-addresses,
-            unnecessary newlines
+    def cancel(self, execution):
         """
-        if not isinstance(s, basestring):
-            return s
-        # normalize newline:
-        s = s.replace('\r\n', '\n')
+        Stop queueing messages for an execution
 
-        # ignore trailing newlines (but not space)
-        s = s.rstrip('\n')
+        Queued messages and those that still arrive for it are dropped.
+        """
+        with self.lock:
+            if execution.uid in self.executions:
+                self._discard(execution.uid)
+
+    def _discard(self, uid):
+        del self.executions[uid]
+        self.dropped += len(self.queues.pop(uid))
+        self.changed.notify_all()
+
+    def _read(self):
+        poller = None
+        version = None
+
+        while True:
+            with self.lock:
+                self.rounds += 1
+                self.changed.notify_all()
+
+                if not self.kernels:
+                    self.thread = None
+                    return
+
+                if version != self.version:
+                    poller = zmq.Poller()
+                    for socket in self.kernels:
+                        poller.register(socket, zmq.POLLIN)
+
+                    kernels = dict(self.kernels)
+                    version = self.version
+
+            for socket, event in poller.poll(1000 * self.poll_interval):
+                ipy = kernels[socket]
+                messages = []
+                while len(messages) < self.queue_size:
+                    try:
+                        messages.append(ipy.iopub.get_msg(timeout=0))
+                    except Empty:
+                        break
+
+                self._route(messages)
+
+    def _route(self, messages):
+        with self.lock:
+            for msg in messages:
+                uid = msg['parent_header'].get('msg_id')
+
+                while True:
+                    queue = self.queues.get(uid)
+                    if queue is None or len(queue) < self.queue_size:
+                        break
+
+                    self.changed.notify_all()
+                    self.changed.wait(self.poll_interval)
+
+                if queue is None:
+                    self.dropped += 1
+                    continue
+
+                queue.append(msg)
+
+                execution = self.executions[uid]
+                if len(queue) > execution.peak_depth:
+                    execution.peak_depth = len(queue)
+                    self.peak_depth = max(self.peak_depth, len(queue))
+
+            self.changed.notify_all()
+
+    def process(self):
+        """
+        Hand all queued messages to their executions
+
+        An execution is no longer queued for once it is done. Messages that
+        arrive for it later are dropped.
+        """
+        with self.lock:
+            batches = [
+                (self.executions[uid], queue)
+                for uid, queue in self.queues.items() if queue]
+
+            for execution, queue in batches:
+                self.queues[execution.uid] = deque()
+
+            if batches:
+                self.changed.notify_all()
+
+        for execution, queue in batches:
+            while queue and not execution.done:
+                execution.handle(queue.popleft())
+
+            if execution.done:
+                with self.lock:
+                    self.dropped += len(queue)
+
+                self.cancel(execution)
+
+    def wait(self, executions):
+        """
+        Process messages until all given executions are done or timed out
+
+        An execution that passes its deadline is marked as `timed_out` and
+        its remaining messages are dropped.
+
+        Parameters
+        ----------
+        executions : list of CellExecution
+            the executions to wait for
+        """
+        pending = [e for e in executions if not e.finished]
+
+        while pending:
+            self.process()
+
+            now = time.time()
+            for execution in pending:
+                if not execution.done and execution.deadline <= now:
+                    execution.timed_out = True
+                    self.cancel(execution)
+
+            pending = [e for e in pending if not e.finished]
+            if not pending:
+                break
+
+            wait_time = max(0.0, min(e.deadline for e in pending) - now)
+
+            with self.lock:
+                if not any(self.queues.values()):
+                    self.changed.wait(wait_time)
+
+
+class IPyKernel(object):
+    """
+    A simple wrapper class to run cells in an IPython Notebook.
+
+    Notes
+    -----
+    - Use `with` construct to properly instantiate
+    - IPython 3.0.0+ is assumed for this version
+
+    """
+
+    def __init__(self, nb_version=4, extra_arguments=None, cwd=None,
+                 console=None, warmup=None, loop=None, kernel_name=None):
+        # default timeout time is 60 seconds
+        self.default_timeout = 60
+
+        # the kernelspec to start, e.g. `python2`. If None the default kernel
+        # of the KernelManager is used
+        self.kernel_name = kernel_name
+
+        # the maximal number of characters kept of each output stream of a
+        # cell. If None the text is not limited
+        self.stream_max_size = None
+
+        if extra_arguments is None:
+            extra_arguments = []
+        self.extra_arguments = extra_arguments
+        self.nb_version = nb_version
+
+        # the working directory of the kernel process. If None the kernel
+        # inherits the working directory of this process
+        self.cwd = cwd
+
+        # console used to report unexpected messages
+        self.console = console
+
+        # code that is run right after the kernel has started, e.g. to import
+        # heavy packages before the first cell
+        self.warmup = warmup
+
+        # the event loop that processes the messages of this kernel. Kernels
+        # that share a loop can run cells at the same time
+        self.loop = loop
+
+        # the execution of the last cell passed to `run`, e.g. for its timing
+        self.last_execution = None
+
+        # if True the kernel is not shut down at the end of a `with`
+        # statement, e.g. to run more cells in it later
+        self.keep_alive = False
+
+        # the seconds to wait for a timed out cell to stop after interrupting
+        # it. If it does not stop the kernel is `hung` and needs a restart
+        self.interrupt_timeout = 10
+        self.hung = False
+
+        self.started = False
+
+    def __enter__(self):
+        if not self.started:
+            self.start()
+
+        return self
+
+    def start(self):
+        """
+        Start the kernel, connect to it and run the warm up code
+
+        A kernel that was started already, e.g. by an `IPyKernelPool`, is
+        not started again when used in a `with` statement.
+        """
+        kernel_kwargs = {}
+        if self.cwd is not None:
+            kernel_kwargs['cwd'] = self.cwd
+
+        if self.kernel_name is not None:
+            self.km = KernelManager(kernel_name=self.kernel_name)
+        else:
+            self.km = KernelManager()
+
+        self.km.start_kernel(
+            extra_arguments=self.extra_arguments,
+            stderr=open(os.devnull, 'w'),
+            **kernel_kwargs
+        )
+
+        self._connect()
+
+    def _connect(self):
+        """
+        Connect to the kernel process, wait for it and run the warm up code
+        """
+        self.kc = self.km.client()
+        self.kc.start_channels()
+
+        self.iopub = self.kc.iopub_channel
+        self.shell = self.kc.shell_channel
+
+        if self.loop is None:
+            self.loop = KernelEventLoop()
+
+        self.loop.add(self)
+        self.started = True
+        self.hung = False
+
+        # the reply on the shell channel tells that the kernel is running
+        self._wait_reply(
+            self.kc.execute('pass', silent=True, store_history=False),
+            self.default_timeout)
+
+        # wait for the end of an execution on the iopub channel so no startup
+        # messages are left. The first messages are lost if the channel is
+        # not yet connected, then the execution is tried again
+        deadline = time.time() + self.default_timeout
+        while time.time() < deadline:
+            execution = self.submit(
+                nbformat.NotebookNode(source='pass'), use_timeout=1.0)
+            self.loop.wait([execution])
+            if execution.done:
+                break
+
+        if self.warmup:
+            outs = self.run(nbformat.NotebookNode(source=self.warmup))
+            for out in outs:
+                if out.output_type == 'error':
+                    self.stop()
+                    raise RuntimeError(
+                        'warm up code failed with %s ("%s")' % (
+                            out.ename, out.evalue))
+
+    def stop(self):
+        """
+        Disconnect from the kernel and shut it down
+        """
+        self.loop.remove(self)
+        self.kc.stop_channels()
+        self.km.shutdown_kernel()
+        del self.km
+        self.started = False
+
+    def restart(self):
+        """
+        Replace the kernel process by a new one, e.g. if it is `hung`
+
+        The new kernel runs the warm up code and uses the same working
+        directory. All other state of the notebook is lost.
+        """
+        self.loop.remove(self)
+        self.kc.stop_channels()
+        self.km.restart_kernel(now=True)
+        self._connect()
+
+        if self.cwd is not None:
+            self.change_directory(self.cwd)
+
+    def interrupt(self):
+        """
+        Interrupt the running cell and wait until the kernel is idle again
+
+        Waits at most `interrupt_timeout` seconds. The messages of the
+        interrupted execution are dropped.
+
+        Returns
+        -------
+        bool
+            True if the kernel is ready for the next cell, False if the cell
+            could not be stopped
+        """
+        self.km.interrupt_kernel()
+
+        # the kernel replies after the interrupted cell has finished. The
+        # request may be aborted because the cell ended with an error
+        uid = self.kc.execute('pass', silent=True, store_history=False)
+        try:
+            self._wait_reply(uid, self.interrupt_timeout)
+        except Empty:
+            return False
+
+        return True
+
+    def change_directory(self, path):
+        """
+        Change the working directory of a running kernel
+
+        This is used for kernels that have been started before the notebook
+        was known. The code is run silently and does not define any names in
+        the namespace of the notebook.
+
+        Parameters
+        ----------
+        path : string
+            the new working directory
+        """
+        self.run_silent("__import__('os').chdir(%r)" % path)
+        self.cwd = path
+
+    def run_silent(self, code, use_timeout=None):
+        """
+        Run code in the kernel without output and wait for it to finish
+
+        Parameters
+        ----------
+        code : string
+            the code to be run
+        use_timeout : int or None (default)
+            the time in seconds to wait for the reply. If set to None the
+            value in `default_timeout` is used
+
+        Returns
+        -------
+        dict
+            the content of the `execute_reply` message
+
+        Raises
+        ------
+        RuntimeError
+            if the code raised an exception in the kernel
+        """
+        if use_timeout is None:
+            use_timeout = self.default_timeout
+
+        uid = self.kc.execute(code, silent=True, store_history=False)
+        content = self._wait_reply(uid, use_timeout)
+
+        if content['status'] != 'ok':
+            raise RuntimeError('%s ("%s")' % (
+                content.get('ename'), content.get('evalue')))
+
+        return content
+
+    def _wait_reply(self, uid, use_timeout):
+        """
+        Wait for the reply to a request on the shell channel
+
+        Replies to earlier requests that nobody waited for are skipped.
+
+        Raises
+        ------
+        Empty
+            if no reply arrived within `use_timeout` seconds
+        """
+        while True:
+            msg = self.shell.get_msg(timeout=use_timeout)
+            if msg['parent_header'].get('msg_id') == uid:
+                return msg['content']
+
+    def save_checkpoint(self, path):
+        """
+        Save the variables of the notebook to a file
+
+        Imported modules are stored by name, all other values are pickled
+        (using `dill` if it is installed in the kernel). Values that cannot
+        be restored in a new kernel are not saved and returned instead.
+
+        Parameters
+        ----------
+        path : string
+            the file to write the checkpoint to
+
+        Returns
+        -------
+        list of string
+            the names of all variables that could not be saved
+        """
+        self.run_silent(
+            'exec(%r, {"path": %r})' % (CHECKPOINT_SAVE_CODE, path))
+
+        with open(path + '.json', encoding='utf-8') as f:
+            return json.load(f)['skipped']
+
+    def load_checkpoint(self, path):
+        """
+        Restore the variables of the notebook from a checkpoint file
+
+        Parameters
+        ----------
+        path : string
+            the file written by `save_checkpoint`
+        """
+        self.run_silent(
+            'exec(%r, {"path": %r})' % (CHECKPOINT_LOAD_CODE, path))
+
+    def clear(self):
+        self.receive()
+
+    def execute(self, cmd):
+        return self.kc.execute(cmd)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.keep_alive:
+            self.stop()
+
+    def is_alive(self):
+        """
+        Check if the kernel is started and its process is still running
+        """
+        return self.started and self.km.is_alive()
+
+    def submit(self, cell, use_timeout=None):
+        """
+        Send a notebook cell to the kernel without waiting for it
+
+        The messages of the execution are queued by the event loop of the
+        kernel and collected whenever it processes messages, e.g. in `run`
+        or `KernelEventLoop.wait`.
+
+        Parameters
+        ----------
+        cell : IPython.notebook.Cell
+            the cell to be run
+        use_timeout : int or None (default)
+            the time in seconds after which a cell is stopped and assumed to
+            have timed out. If set to None the value in `default_timeout`
+            is used
+
+        Returns
+        -------
+        CellExecution
+            the execution that collects the outputs of the cell
+        """
+        if use_timeout is None:
+            use_timeout = self.default_timeout
+
+        if not hasattr(cell, 'source'):
+            raise AttributeError('No source/input key')
+
+        # the reader of the loop must know the execution before its first
+        # message arrives
+        with self.loop.lock:
+            uid = self.execute(cell.source)
+            execution = CellExecution(self, uid, use_timeout)
+            self.loop.register(execution)
+
+        return execution
+
+    def cancel(self, execution):
+        """
+        Stop collecting messages for an execution
+
+        Messages that still arrive for it are dropped.
+        """
+        self.loop.cancel(execution)
+
+    def receive(self):
+        """
+        Process all messages that have arrived on the iopub channel
+
+        Each message is passed to the execution it belongs to. Messages of
+        requests that are not (or no longer) waited for are dropped.
+        """
+        self.loop.process()
+
+    def run(self, cell, use_timeout=None):
+        """
+        Run a notebook cell in the IPythonKernel
+
+        Parameters
+        ----------
+        cell : IPython.notebook.Cell
+            the cell to be run
+        use_timeout : int or None (default)
+            the time in seconds after which a cell is stopped and assumed to
+            have timed out. If set to None the value in `default_timeout`
+            is used
+
+        Returns
+        -------
+        list of ex_cell_outputs
+            a list of NotebookNodes of the returned types. This is
+            similar to the list of outputs generated when a cell is run
+
+        Raises
+        ------
+        Empty
+            if the cell did not finish within the timeout. The cell is
+            interrupted, if this fails the kernel is `hung`
+        """
+        self.last_execution = None
+        return self.finish(self.submit(cell, use_timeout))
+
+    def finish(self, execution):
+        """
+        Wait for a cell passed to `submit` and return its outputs
+
+        This allows to do other work while the kernel runs the cell, e.g. to
+        compare the outputs of the cell before.
+
+        Parameters
+        ----------
+        execution : CellExecution
+            the execution returned by `submit`
+
+        Returns
+        -------
+        list of ex_cell_outputs
+            the outputs of the cell like `run`
+
+        Raises
+        ------
+        Empty
+            if the cell did not finish before its deadline, see `run`
+        """
+        self.last_execution = execution
+        self.loop.wait([execution])
+
+        if execution.timed_out:
+            self.hung = not self.interrupt()
+            raise Empty()
+
+        return execution.outs
+
+    @staticmethod
+    def get_commands(cell):
+        """
+        Extract potential commands from the first line of a cell
+
+        if a code cell starts with the hashbang `#!` it can be followed by
+        a comma separated list of commands. Each command can be
+        1. a single key `skip`, or
+        2. a key/value pair separated by a colon `timeout:[int]`
+
+        Parameters
+        ----------
+        cell : a NotebookCell
+            the cell to be examined
+
+        Returns
+        -------
+        dict
+            a dict of key/value pairs. For a single command the value is `True`
+        """
+        commands = {}
+        source = cell.source
+        if source is not None:
+            lines = source.splitlines()
+            if len(lines) > 0:
+                n_line = 0
+                line = lines[n_line].strip()
+                while line.startswith('#!') or len(line) == 0:
+                    txt = line[2:].strip()
+
+                    parts = txt.split(',')
+                    for part in parts:
+                        subparts = part.split(':')
+                        if len(subparts) == 1:
+                            commands[subparts[0].strip().lower()] = True
+                        elif len(subparts) == 2:
+                            commands[subparts[0].strip().lower()] = subparts[1]
+
+                    n_line += 1
+                    line = lines[n_line]
+
+        return commands
+
+    def is_empty_cell(self, cell):
+        """
+        Check if a cell has no code
+
+        Parameters
+        ----------
+        cell : a NotebookCell
+            the cell to be examined
+
+        Returns
+        -------
+        bool
+            True if the cell has no code, False otherwise
+        """
+        return not bool(cell.source)
+
+
+class IPyKernelPool(object):
+    """
+    A pool of kernels that are started ahead of time
+
+    Starting a kernel and importing heavy packages can take seconds. The pool
+    keeps a number of started (and optionally warmed up) kernels ready and
+    hands them out immediately. For every kernel taken from the pool a new
+    one is started in a background thread.
+
+    Kernels are used only once. A kernel taken with `acquire` is shut down
+    at the end of the `with` statement it is used in.
+
+    Notes
+    -----
+    - Call `shutdown` to stop all kernels that are still waiting in the pool
+    """
+
+    def __init__(self, size=1, extra_arguments=None, warmup=None,
+                 kernel_name=None):
+        self.size = size
+        self.extra_arguments = extra_arguments
+        self.warmup = warmup
+        self.kernel_name = kernel_name
+
+        # started kernels or exceptions raised while starting one
+        self.ready = Queue()
+        self.threads = []
+        self.closed = False
+
+        for _ in range(self.size):
+            self._refill()
+
+    def _refill(self):
+        thread = threading.Thread(target=self._start_kernel)
+        thread.daemon = True
+        thread.start()
+        self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+
+    def _start_kernel(self):
+        ipy = IPyKernel(
+            extra_arguments=self.extra_arguments,
+            warmup=self.warmup,
+            kernel_name=self.kernel_name)
+
+        try:
+            ipy.start()
+        except Exception as e:
+            self.ready.put(e)
+            return
+
+        if self.closed:
+            ipy.stop()
+        else:
+            self.ready.put(ipy)
+
+    def acquire(self, cwd=None):
+        """
+        Take a started kernel from the pool
+
+        Waits until a kernel is ready if all kernels are in use. A new kernel
+        is started in the background to replace the one taken.
+
+        Parameters
+        ----------
+        cwd : string or None (default)
+            if not None, the working directory the kernel is changed to
+
+        Returns
+        -------
+        IPyKernel
+            the started kernel. Use it in a `with` statement to shut it
+            down after use
+        """
+        ipy = self.ready.get()
+        self._refill()
+
+        if isinstance(ipy, Exception):
+            raise ipy
+
+        if cwd is not None:
+            ipy.change_directory(cwd)
+
+        return ipy
+
+    def matches(self, extra_arguments, warmup, kernel_name=None):
+        """
+        Check if the kernels of the pool are started with these options
+        """
+        return (self.extra_arguments, self.warmup, self.kernel_name) == (
+            extra_arguments, warmup, kernel_name)
+
+    def shutdown(self):
+        """
+        Stop all kernels in the pool including those still starting
+        """
+        self.closed = True
+        for thread in self.threads:
+            thread.join()
+
+        while True:
+            try:
+                ipy = self.ready.get_nowait()
+            except Empty:
+                break
+
+            if isinstance(ipy, IPyKernel):
+                ipy.stop()
+
+
+class OutputDigest(object):
+    """
+    The sha1 hash and length of a large string that is compared
+
+    The string is hashed in chunks, so a large output is never copied as a
+    whole. With `sanitize` each chunk is sanitized like
+    `TypedOutput.sanitize` before it is hashed. Chunks end after a newline,
+    which none of the replaced patterns contains, so the hash is the one of
+    the sanitized string.
+
+    Parameters
+    ----------
+    content : string
+        the string to hash
+    sanitize : bool, default False
+        if True the hash and length are those of the sanitized string
+    """
+
+    __slots__ = ('size', 'digest')
+
+    # the number of characters hashed at once
+    chunk_size = 1024 * 1024
+
+    def __init__(self, content, sanitize=False):
+        end = len(content)
+        if sanitize:
+            # trailing newlines are removed by sanitize, also as `\r\n`
+            while end and content[end - 1] == '\n':
+                end -= 1
+                if end and content[end - 1] == '\r':
+                    end -= 1
+
+        sha = hashlib.sha1()
+        self.size = 0
+
+        start = 0
+        while start < end:
+            stop = min(end, start + self.chunk_size)
+            if sanitize and stop < end:
+                newline = content.find('\n', stop, end)
+                stop = end if newline < 0 else newline + 1
+
+            chunk = content[start:stop]
+            if sanitize:
+                chunk = TypedOutput.normalize(chunk)
+
+            sha.update(chunk.encode('utf-8'))
+            self.size += len(chunk)
+            start = stop
+
+        self.digest = sha.hexdigest()
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        return isinstance(other, OutputDigest) and \
+            self.digest == other.digest and self.size == other.size
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __repr__(self):
+        return '<%d characters with sha1 %s>' % (self.size, self.digest)
+
+
+class TypedOutput(object):
+    """
+    Simple class to define possible outputs like stdout, png, etc
+
+    It will know how to detect these, have a name by which to address the
+    type and can compare
+
+    Notes
+    -----
+    - Outputs are found by `get_outs` using the `output_type` and `name` of
+      the class and `accepts`
+    - Subclasses need to define `__slots__` as well, since many outputs are
+      wrapped for every cell
+    - Sanitized outputs with more than `digest_size` characters are
+      compared by an `OutputDigest` of their `_content` instead of keeping a
+      sanitized copy in their `key`. The full key is only made for a diff.
+      Other outputs like images use their data as key, which is no copy
+    """
+
+    __slots__ = ('_out', '_key', 'options')
+
+    mime = ''
+    name = ''
+    output_type = ''
+
+    # the kind of comparison if not exact. Types with a variant are only
+    # used if the variant is explicitly selected
+    variant = ''
+
+    # outputs with more characters are compared by their digest. If None
+    # all outputs are compared in full
+    digest_size = 64 * 1024
+
+    def __init__(self, output, options=None):
+        self._out = output
+        self._key = None
+
+        # options for the comparison like tolerances
+        if options is None:
+            options = {}
+        self.options = options
+
+    @classmethod
+    def accepts(cls, output):
+        """
+        Check if an output of a notebook is of this type
+
+        Parameters
+        ----------
+        output : NotebookNode
+            the output of a cell
+
+        Returns
+        -------
+        bool
+            True if the output can be wrapped by this type
+        """
+        return output['output_type'] == cls.output_type
+
+    def __nonzero__(self):
+        return self.accepts(self._out)
+
+    def __bool__(self):
+        return self.__nonzero__()
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            return self.matches(other)
+        else:
+            raise NotImplemented
+
+    def __ne__(self, other):
+        if type(other) is not type(self):
+            return True
+        else:
+            return not self.matches(other)
+
+    def matches(self, other):
+        """
+        Check if the output matches another output of the same type
+
+        Parameters
+        ----------
+        other : TypedOutput
+            the output to compare to
+
+        Returns
+        -------
+        bool
+            True if both are considered equal
+        """
+        return self.key == other.key
+
+    @property
+    def key(self):
+        if self._key is None:
+            content = self._content()
+            if isinstance(content, basestring) and \
+                    self.digest_size is not None and \
+                    len(content) > self.digest_size:
+                self._key = OutputDigest(content, sanitize=True)
+            else:
+                self._key = self._cmp_key()
+
+        return self._key
+
+    @property
+    def full_key(self):
+        """the key with the full content, also for an output with a digest
+        """
+        if isinstance(self.key, OutputDigest):
+            return self._cmp_key()
+
+        return self.key
+
+    def _content(self):
+        """the string that is compared after `sanitize` or None"""
+        return None
+
+    def _cmp_key(self):
+        return ''
+
+    def compare_str(self, other):
+        return itertools.chain(
+            ['>>> diff in %s' % str(self)],
+            self.run_diff(self.full_key, other.full_key))
+
+    @property
+    def otype(self):
+        return self._out['output_type']
+
+    def __str__(self):
+        return self.identifier
+
+    @property
+    def identifier(self):
+        identifier = '%s.%s.%s' % (self.output_type, self.name, self.mime)
+        if self.variant:
+            identifier += '~' + self.variant
+
+        return identifier
+
+    @staticmethod
+    def sanitize(s):
+        """sanitize a string for comparison.
+
+        fix universal newlines, strip trailing newlines, and normalize likely
+        random values (memory addresses and UUIDs)
+
+        Parameters
+        ----------
+        s : str
+            string to be sanitized, i.e. remove UUIDs, Hex-addresses,
+            unnecessary newlines
+        """
+        if not isinstance(s, basestring):
+            return s
+
+        # ignore trailing newlines (but not space)
+        return TypedOutput.normalize(s).rstrip('\n')
+
+    @staticmethod
+    def normalize(s):
+        """normalize newlines and likely random values in a string
+
+        Unlike `sanitize` trailing newlines are kept. No pattern spans
+        several lines, so the lines of a string can be normalized one by one.
+        """
+        # normalize newline:
+        s = s.replace('\r\n', '\n')
 
         # normalize hex addresses:
         s = re.sub(r'0x[a-f0-9]+', '0xFFFFFFFF', s)
 
-        # normalize UUIDs:
-        s = re.sub(r'[a-f0-9]{8}(-[a-f0-9]{4}){3}-[a-f0-9]{12}', 'U-U-I-D', s)
+        # normalize UUIDs:
+        s = re.sub(r'[a-f0-9]{8}(-[a-f0-9]{4}){3}-[a-f0-9]{12}', 'U-U-I-D', s)
+
+        return s
+
+    def run_diff(self, original, testing):
+        return line_diff(
+            original, testing,
+            context=self.options.get('diff_context', 3),
+            max_lines=self.options.get('diff_max_lines'))
+
+
+class StdOutOutput(TypedOutput):
+    __slots__ = ()
+
+    output_type = 'stream'
+    name = 'stdout'
+    mime = 'text/plain'
+
+    @classmethod
+    def accepts(cls, output):
+        return super(StdOutOutput, cls).accepts(output) and \
+            output['name'] == cls.name
+
+    def _content(self):
+        return self.text
+
+    def _cmp_key(self):
+        return self.sanitize(self.text)
+
+    @property
+    def text(self):
+        # stored outputs may still contain carriage returns or be larger than
+        # the outputs of a new run, so bound them the same way
+        return stream_text(
+            self._out['text'], self.options.get('stream_max_size'))
+
+
+class StdErrOutput(StdOutOutput):
+    __slots__ = ()
+
+    name = 'stderr'
+
+
+class MimeBundleOutput(TypedOutput):
+    __slots__ = ()
+
+    mime = 'none'
+    name = 'data'
+    output_type = 'display_data'
+
+    @property
+    def data(self):
+        return self._out[self.name]
+
+    @classmethod
+    def accepts(cls, output):
+        return super(MimeBundleOutput, cls).accepts(output) and \
+            cls.mime in output[cls.name]
+
+    def _cmp_key(self):
+        return self.data[self.mime]
+
+
+class ImageOutput(MimeBundleOutput):
+    __slots__ = ()
+
+    def compare_str(self, other):
+        return ['>>> diff in %s' % str(self)] + \
+               ['size new : %d vs size old : %d )' % (
+                   len(self.key), len(other.key))]
+
+
+class PNGOutput(ImageOutput):
+    __slots__ = ()
+
+    mime = 'image/png'
+
+
+class PNGOutputExecuted(PNGOutput):
+    __slots__ = ()
+
+    output_type = 'execute_result'
+
+
+# decoded images by hash of their data and size, the last used at the end
+decoded_images = OrderedDict()
+
+# the maximal number of decoded images kept
+decoded_images_max = 64
+
+
+def decode_image(data, size=None):
+    """decode a base64 encoded image and cache the result
+
+    Stored outputs are compared again after each restart and in every cell
+    the same image appears in, so decoded images are kept by the hash of
+    their data.
+
+    Parameters
+    ----------
+    data : string
+        the base64 encoded image
+    size : int or None (default)
+        if not None, images larger than this are scaled down so that their
+        longer side has this many pixels
+
+    Returns
+    -------
+    PIL.Image.Image
+        the decoded image in RGBA mode
+    """
+    key = (hashlib.sha1(data.encode('ascii')).hexdigest(), size)
+
+    if key in decoded_images:
+        image = decoded_images.pop(key)
+    else:
+        image = Image.open(BytesIO(base64.b64decode(data))).convert('RGBA')
+        if size and max(image.size) > size:
+            image.thumbnail((size, size))
+
+    decoded_images[key] = image
+    while len(decoded_images) > decoded_images_max:
+        decoded_images.popitem(last=False)
+
+    return image
+
+
+class PixelPNGOutput(PNGOutput):
+    """
+    Compare PNG images pixel by pixel with a tolerance
+
+    A pixel differs if one of its channels differs by more than `threshold`
+    (0 - 255). Images match if they have the same size and at most the
+    fraction `tolerance` of pixels differ. Images are scaled down to `size`
+    pixels before the comparison, which makes it faster and less sensitive
+    to small shifts.
+
+    Notes
+    -----
+    - Needs Pillow. Without it only identical images match
+    - `threshold`, `tolerance` and `size` can be changed using the options
+    """
+
+    __slots__ = ()
+
+    variant = 'pixel'
+
+    threshold = 10
+    tolerance = 0.01
+    size = 256
+
+    def _option(self, name):
+        return self.options.get('image_' + name, getattr(self, name))
+
+    @property
+    def image(self):
+        return decode_image(self.data[self.mime], int(self._option('size')))
+
+    def different_pixels(self, other):
+        """
+        The fraction of pixels that differ from the image of `other`
+
+        Returns
+        -------
+        float or None
+            the fraction of differing pixels or None if the sizes differ
+        """
+        image = self.image
+        other_image = other.image
+        if image.size != other_image.size:
+            return None
+
+        # the largest difference of all channels for each pixel
+        channels = ImageChops.difference(image, other_image).split()
+        difference = channels[0]
+        for channel in channels[1:]:
+            difference = ImageChops.lighter(difference, channel)
+
+        histogram = difference.histogram()
+        threshold = int(self._option('threshold'))
+        n_pixels = image.size[0] * image.size[1]
+
+        return sum(histogram[threshold + 1:]) / float(n_pixels)
+
+    def matches(self, other):
+        if self.key == other.key:
+            return True
+
+        if Image is None:
+            return False
+
+        fraction = self.different_pixels(other)
+        return fraction is not None and \
+            fraction <= float(self._option('tolerance'))
+
+    def compare_str(self, other):
+        if Image is None:
+            return super(PixelPNGOutput, self).compare_str(other) + \
+                ['install Pillow to compare images pixel by pixel']
+
+        fraction = self.different_pixels(other)
+        if fraction is None:
+            return ['>>> diff in %s' % str(self)] + \
+                ['size new : %dx%d vs size old : %dx%d' % (
+                    self.image.size + other.image.size)]
+
+        return ['>>> diff in %s' % str(self)] + \
+            ['%.2f%% of pixels differ by more than %d (tolerance %.2f%%)' % (
+                100.0 * fraction, int(self._option('threshold')),
+                100.0 * float(self._option('tolerance')))]
+
+
+class PixelPNGOutputExecuted(PixelPNGOutput):
+    __slots__ = ()
+
+    output_type = 'execute_result'
+
+
+class SVGOutput(ImageOutput):
+    __slots__ = ()
+
+    mime = 'image/svg'
+
+
+class SVGOutputExecuted(PNGOutput):
+    __slots__ = ()
+
+    output_type = 'execute_result'
+
+
+class TextPlainOutput(MimeBundleOutput):
+    __slots__ = ()
+
+    mime = 'text/plain'
+
+    @property
+    def text(self):
+        return str(self.data[self.mime])
+
+    def _content(self):
+        return self.text
+
+    def _cmp_key(self):
+        return self.sanitize(self.text)
+
+
+class TextPlainOutputExecuted(TextPlainOutput):
+    __slots__ = ()
+
+    output_type = 'execute_result'
+
+
+class NumericOutput(TypedOutput):
+    """
+    Compare text outputs with a tolerance for all numbers in it
+
+    The text is split into the numbers and the text around them. The text
+    has to match exactly and numbers `a` and `b` match if they are equal or
+    `abs(a - b) <= atol + rtol * abs(b)` like in `numpy.isclose`. Like
+    there an infinity (e.g. `1e400`) only matches the same infinity. If
+    numpy is available all numbers of an output are compared at once.
+
+    Notes
+    -----
+    - Use as first base class together with a text output type
+    - `rtol` and `atol` can be changed using the options
+    - The numbers are replaced by `#` in the text they are removed from, so
+      a `#` of the text itself is escaped
+
+    Examples
+    --------
+    >>> def stdout(text):
+    ...     return NumericStdOutOutput(
+    ...         {'output_type': 'stream', 'name': 'stdout', 'text': text})
+    >>> stdout('value = 1.0000001\\n') == stdout('value = 1\\n')
+    True
+    >>> stdout('value = 1\\n') == stdout('value = #\\n')
+    False
+    """
+
+    __slots__ = ()
+
+    variant = 'numeric'
+
+    rtol = 1e-5
+    atol = 1e-8
+
+    # integers, decimals and floats in scientific notation
+    number_pattern = re.compile(
+        r'[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+
+    def _content(self):
+        # the numbers are compared one by one
+        return None
+
+    def _cmp_key(self):
+        text = self.sanitize(self.text)
+        template = self.number_pattern.sub(
+            '#', text.replace('\\', '\\\\').replace('#', '\\#'))
+        if self.digest_size is not None and len(template) > self.digest_size:
+            template = OutputDigest(template)
+
+        return template, self.number_pattern.findall(text)
+
+    def _tolerances(self):
+        return (
+            float(self.options.get('rtol', self.rtol)),
+            float(self.options.get('atol', self.atol)))
+
+    def _close(self, other):
+        """
+        Check which numbers are close to the numbers of `other`
+
+        Returns
+        -------
+        list of bool or numpy.ndarray
+            True for each number within the tolerance
+        list of float or numpy.ndarray
+            the absolute differences
+        """
+        rtol, atol = self._tolerances()
+        numbers = self.key[1]
+        reference = other.key[1]
+
+        if np is not None:
+            numbers = np.array(numbers, dtype=float)
+            reference = np.array(reference, dtype=float)
+            equal = numbers == reference
+            finite = np.isfinite(numbers) & np.isfinite(reference)
+
+            # the difference of equal infinities is nan
+            with np.errstate(invalid='ignore'):
+                difference = np.where(
+                    equal, 0.0, np.abs(numbers - reference))
+
+            return equal | finite & (
+                difference <= atol + rtol * np.abs(reference)), difference
+
+        numbers = [float(a) for a in numbers]
+        reference = [float(b) for b in reference]
+        difference = [
+            0.0 if a == b else abs(a - b) for a, b in zip(numbers, reference)]
+        close = [
+            a == b or not math.isinf(a) and not math.isinf(b) and
+            d <= atol + rtol * abs(b)
+            for a, b, d in zip(numbers, reference, difference)]
+        return close, difference
+
+    def matches(self, other):
+        if self.key[0] != other.key[0] or \
+                len(self.key[1]) != len(other.key[1]):
+            return False
+
+        if self.key[1] == other.key[1]:
+            return True
+
+        close, difference = self._close(other)
+        return all(close)
+
+    def compare_str(self, other):
+        if self.key[0] != other.key[0] or \
+                len(self.key[1]) != len(other.key[1]):
+            # the text is different, so show the text diff
+            return itertools.chain(
+                ['>>> diff in %s' % str(self)],
+                self.run_diff(self.sanitize(self.text),
+                              self.sanitize(other.text)))
+
+        close, difference = self._close(other)
+        n_different = len(close) - sum(1 for c in close if c)
+        return ['>>> diff in %s' % str(self)] + [
+            '%d of %d numbers differ more than rtol=%g, atol=%g '
+            '(max absolute difference %g)' % (
+                n_different, len(close), self._tolerances()[0],
+                self._tolerances()[1], max(difference))]
+
+
+class NumericStdOutOutput(NumericOutput, StdOutOutput):
+    __slots__ = ()
+
+
+class NumericStdErrOutput(NumericOutput, StdErrOutput):
+    __slots__ = ()
+
+
+class NumericTextPlainOutput(NumericOutput, TextPlainOutput):
+    __slots__ = ()
+
+
+class NumericTextPlainOutputExecuted(NumericOutput, TextPlainOutputExecuted):
+    __slots__ = ()
+
+
+def _unique_lines(lines, lo, hi):
+    """the positions of all lines in `lines[lo:hi]` that occur only once"""
+    count = {}
+    position = {}
+    for index in range(lo, hi):
+        line = lines[index]
+        count[line] = count.get(line, 0) + 1
+        position[line] = index
+
+    return {
+        line: index for line, index in position.items() if count[line] == 1}
+
+
+def _patience_anchors(a, alo, ahi, b, blo, bhi):
+    """the longest increasing sequence of lines unique in both ranges"""
+    unique_a = _unique_lines(a, alo, ahi)
+    unique_b = _unique_lines(b, blo, bhi)
+
+    pairs = sorted(
+        (index, unique_b[line]) for line, index in unique_a.items()
+        if line in unique_b)
+
+    # patience sorting: the top card of each pile and back references
+    tops = []
+    piles = []
+    previous = {}
+    for i, j in pairs:
+        pile = bisect.bisect_left(tops, j)
+        if pile == len(tops):
+            tops.append(j)
+            piles.append((i, j))
+        else:
+            tops[pile] = j
+            piles[pile] = (i, j)
+
+        previous[(i, j)] = piles[pile - 1] if pile > 0 else None
+
+    anchors = []
+    pair = piles[-1] if piles else None
+    while pair is not None:
+        anchors.append(pair)
+        pair = previous[pair]
+
+    anchors.reverse()
+    return anchors
+
+
+def matching_blocks(a, b):
+    """find matching lines of two sequences using patience diff
+
+    Only lines that occur exactly once on both sides are used as anchors.
+    Common lines at the start and end of each region are matched directly.
+    Regions without unique lines are considered completely different. This
+    keeps the run time close to linear in the number of lines.
+
+    Parameters
+    ----------
+    a : list of hashable
+        the original lines
+    b : list of hashable
+        the changed lines
+
+    Returns
+    -------
+    list of tuple of (int, int, int)
+        the start in `a`, the start in `b` and the length of each matching
+        block, sorted by position
+    """
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+
+        # match common lines at the start
+        start = 0
+        while alo + start < ahi and blo + start < bhi and \
+                a[alo + start] == b[blo + start]:
+            start += 1
+
+        if start:
+            blocks.append((alo, blo, start))
+            alo += start
+            blo += start
+
+        # and at the end
+        end = 0
+        while alo < ahi - end and blo < bhi - end and \
+                a[ahi - end - 1] == b[bhi - end - 1]:
+            end += 1
+
+        if end:
+            blocks.append((ahi - end, bhi - end, end))
+            ahi -= end
+            bhi -= end
+
+        if alo == ahi or blo == bhi:
+            continue
+
+        # split the remaining region at the anchors and match in between
+        i, j = alo, blo
+        for anchor_i, anchor_j in _patience_anchors(a, alo, ahi, b, blo, bhi):
+            regions.append((i, anchor_i, j, anchor_j))
+            blocks.append((anchor_i, anchor_j, 1))
+            i, j = anchor_i + 1, anchor_j + 1
+
+        if (i, j) != (alo, blo):
+            regions.append((i, ahi, j, bhi))
+
+    # join adjacent blocks
+    merged = []
+    for block_i, block_j, length in sorted(blocks):
+        if merged and merged[-1][0] + merged[-1][2] == block_i and \
+                merged[-1][1] + merged[-1][2] == block_j:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + length)
+        else:
+            merged.append((block_i, block_j, length))
+
+    return merged
+
+
+def line_diff(original, testing, context=3, max_lines=None):
+    """compare two strings line by line
+
+    Creates lines in the style of `difflib.ndiff`. Each line starts with
+    `- ` if only in `original`, `+ ` if only in `testing` or two spaces if
+    unchanged. Unchanged lines more than `context` lines away from a change
+    are replaced by a single `...` line.
+
+    Parameters
+    ----------
+    original : string
+        the original text
+    testing : string
+        the text to compare with
+    context : int, default 3
+        the number of unchanged lines shown around each change
+    max_lines : int or None (default)
+        if not None stop after this many lines
+
+    Returns
+    -------
+    generator of string
+        the diff lines
+    """
+    a = original.splitlines()
+    b = testing.splitlines()
+
+    # compare numbers instead of long lines
+    line_ids = {}
+    a_ids = [line_ids.setdefault(line, len(line_ids)) for line in a]
+    b_ids = [line_ids.setdefault(line, len(line_ids)) for line in b]
+
+    blocks = matching_blocks(a_ids, b_ids) + [(len(a), len(b), 0)]
+
+    def diff_lines():
+        i = j = 0
+        for block_i, block_j, length in blocks:
+            for line in a[i:block_i]:
+                yield '- ' + line
+
+            for line in b[j:block_j]:
+                yield '+ ' + line
+
+            # show the unchanged lines close to the changes
+            first = block_i == 0 and block_j == 0
+            last = length == 0 or (
+                block_i + length == len(a) and block_j + length == len(b))
+
+            head = 0 if first else min(context, length)
+            tail = 0 if last else min(context, length - head)
+
+            for line in a[block_i:block_i + head]:
+                yield '  ' + line
+
+            if head + tail < length:
+                yield '  ...'
+
+            for line in a[block_i + length - tail:block_i + length]:
+                yield '  ' + line
+
+            i, j = block_i + length, block_j + length
+
+    if len(blocks) == 2 and blocks[0][2] == len(a) == len(b):
+        # no differences
+        return iter([])
+
+    lines = diff_lines()
+    if max_lines is not None:
+        lines = itertools.chain(
+            itertools.islice(lines, max_lines),
+            _truncated(lines, max_lines))
+
+    return lines
+
+
+def _truncated(lines, max_lines):
+    """yield a note if there are lines left"""
+    for _ in lines:
+        yield '  ... diff truncated after %d lines' % max_lines
+        break
+
+
+# list all possible Mime / Output Types
+registered_output_types = {
+    tt('').identifier: tt for tt in [
+        StdOutOutput, StdErrOutput, TextPlainOutput, TextPlainOutputExecuted,
+        PNGOutput, PNGOutputExecuted, SVGOutput, SVGOutputExecuted,
+        NumericStdOutOutput, NumericStdErrOutput, NumericTextPlainOutput,
+        NumericTextPlainOutputExecuted, PixelPNGOutput, PixelPNGOutputExecuted
+    ]}
+
+# these types will be considered by default
+used_output_types = ['stdout.text/plain', 'data.text/plain']
+
+
+def select_output_types(filters):
+    """select registered output types by parts of their identifier
+
+    A type is selected if one of the filters is part of its identifier. Types
+    with a variant like `stream.stdout.text/plain~numeric` are only
+    selected if the filter names the variant, e.g. `stdout.text/plain~numeric`
+    or just `numeric`.
+
+    Parameters
+    ----------
+    filters : list of string
+        the parts of the identifiers to select
+
+    Returns
+    -------
+    list of string
+        the identifiers of the selected types
+    """
+    return [
+        tt for tt, tt_class in registered_output_types.items()
+        if any(f in tt and tt_class.variant in f for f in filters)]
+
+
+def get_variant_types(output_types, variant):
+    """replace output types by their variant where one exists
+
+    Parameters
+    ----------
+    output_types : list of string
+        the identifiers of the output types
+    variant : string
+        the variant to use, e.g. `numeric`
+
+    Returns
+    -------
+    list of string
+        the identifiers with all types replaced that have the variant
+    """
+    variant_types = []
+    for tt in output_types:
+        base = tt.split('~')[0]
+        if base + '~' + variant in registered_output_types:
+            tt = base + '~' + variant
+
+        if tt not in variant_types:
+            variant_types.append(tt)
+
+    return variant_types
+
+
+def get_cell_output_types(output_types, commands):
+    """the output types to compare a cell with, see `get_variant_types`
+
+    Parameters
+    ----------
+    output_types : list of string
+        the identifiers of the output types of the test run
+    commands : dict
+        the commands of the cell, see `IPyKernel.get_commands`
+
+    Returns
+    -------
+    list of string
+        the identifiers with the variants replaced that the cell asks for
+        with `#! numeric` or `#! pixel`
+    """
+    for variant in ['numeric', 'pixel']:
+        if variant in commands:
+            output_types = get_variant_types(output_types, variant)
+
+    return output_types
+
+
+# the dispatch tables of `get_dispatch_table` by their output types
+dispatch_tables = {}
+
+
+def get_dispatch_table(output_types):
+    """the output types by the kind of output they handle
+
+    Tables are built once for each list of output types.
+
+    Parameters
+    ----------
+    output_types : list of string
+        the identifiers of the output types
+
+    Returns
+    -------
+    dict of tuple to list of class
+        the output type classes in the order of `output_types` by their
+        `(output_type, name)`, where `name` is the name of a stream or `data`
+        for mime bundles
+    """
+    key = tuple(output_types)
+    table = dispatch_tables.get(key)
+
+    if table is None:
+        table = {}
+        for tt in output_types:
+            tt_class = registered_output_types[tt]
+            table.setdefault(
+                (tt_class.output_type, tt_class.name), []).append(tt_class)
+
+        dispatch_tables[key] = table
+
+    return table
+
+
+def get_outs(cell_outputs, output_types, options=None):
+    """wrap the outputs of a cell in the output types that handle them
+
+    Parameters
+    ----------
+    cell_outputs : list of NotebookNode
+        the outputs of a cell
+    output_types : list of string
+        the identifiers of the output types to use
+    options : dict or None (default)
+        the options for the comparison passed to each output
+
+    Returns
+    -------
+    list of TypedOutput
+        the wrapped outputs, for each output in the order of `output_types`
+    """
+    table = get_dispatch_table(output_types)
+    outs = []
+
+    for output in cell_outputs:
+        candidates = table.get(
+            (output['output_type'], output.get('name', 'data')), ())
+
+        for tt_class in candidates:
+            if tt_class.accepts(output):
+                outs.append(tt_class(output, options))
+
+    return outs
+
+
+class ResultCache(object):
+    """
+    An on-disk cache of cell results
+
+    Each entry is a small json file named by its key. Entries are marked as
+    used by their modification time and `evict` removes the least recently
+    used entries once the cache grows above `max_size` bytes.
+
+    Entries are written to a temporary file first and then renamed, so
+    several processes can share one cache.
+    """
+
+    def __init__(self, path, max_size=50 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key[2:] + '.json')
+
+    def get(self, key):
+        """
+        Return the entry stored for `key` or None if there is none
+        """
+        filename = self._file(key)
+        try:
+            with open(filename, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            # mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        return entry
+
+    def put(self, key, entry):
+        """
+        Store a json serializable `entry` for `key`
+        """
+        filename = self._file(key)
+        directory = os.path.dirname(filename)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+            handle, tmp_filename = tempfile.mkstemp(dir=directory)
+            with os.fdopen(handle, 'w') as f:
+                f.write(json.dumps(entry))
+
+            replace_file(tmp_filename, filename)
+        except OSError:
+            # another process might have written the same entry or the cache
+            # is not writable. Either way the test results are not affected
+            pass
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits
+        """
+        entries = []
+        total_size = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                filename = os.path.join(root, name)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, filename))
+                total_size += stat.st_size
+
+        for mtime, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+            total_size -= size
+
+
+def get_cache_settings(args):
+    """all options that can change the result of a cell as a string
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        the parsed command line options
+
+    Returns
+    -------
+    string
+        the options and the user given fingerprint in a stable order
+    """
+    return json.dumps({
+        'eval': args.eval,
+        'extra_arguments': get_extra_arguments(args),
+        'warmup': get_warmup_code(args),
+        'kernel': get_kernel_name(args),
+        'tested_types': args.ttypes,
+        'rtol': args.rtol,
+        'atol': args.atol,
+        'image_threshold': args.image_threshold,
+        'image_tolerance': args.image_tolerance,
+        'image_size': args.image_size,
+        'stream_max_size': args.stream_max_size,
+        'strict': args.strict,
+        'pass_if_timeout': args.no_timeout,
+        'timeout': args.timeout,
+        'rerun': args.rerun,
+        'fingerprint': args.cache_fingerprint
+    }, sort_keys=True)
+
+
+def get_cell_keys(cells, settings, path):
+    """the cache keys of all code cells of a notebook
+
+    The key of a cell is a hash of its source and stored outputs, the
+    key of the previous code cell, the `settings` and the path of the
+    notebook. So a key changes whenever the cell or any cell before it
+    changes, and copies of a notebook in other directories, which run with
+    other files, do not share results.
+
+    Parameters
+    ----------
+    cells : list of NotebookNode
+        the cells of the notebook
+    settings : string
+        the options as returned by `get_cache_settings`
+    path : string
+        the path of the notebook
+
+    Returns
+    -------
+    dict of int to string
+        the key for the index of every code cell
+    """
+    keys = {}
+    path = os.path.abspath(path)
+    root = json.dumps([settings, path, os.path.dirname(path)])
+    key = hashlib.sha1(root.encode('utf-8')).hexdigest()
+
+    for index, cell in enumerate(cells):
+        if cell.cell_type != 'code' or not cell.source:
+            continue
+
+        content = json.dumps(
+            [key, cell.source, cell.get('outputs', [])], sort_keys=True)
+        key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        keys[index] = key
+
+    return keys
+
+
+# ==============================================================================
+#  TIMING HISTORY AND SHARDS
+# ==============================================================================
+
+def notebook_key(path):
+    """the name of a notebook in the timing history and result files
+
+    Paths are stored relative to the current directory, so the history can be
+    shared between machines that check out the project in different places.
+    """
+    return os.path.normpath(os.path.relpath(os.path.abspath(path)))
+
+
+def load_timings(path):
+    """the recorded duration in seconds of notebooks by their `notebook_key`
+
+    Returns an empty dict if there is no history yet.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_timings(path, results):
+    """add the durations of tested notebooks to the timing history
+
+    Parameters
+    ----------
+    path : string
+        the json file of the history
+    results : list of dict
+        the results as returned by `check_notebook`. Cached results are
+        skipped
+    """
+    timings = load_timings(path)
+    for result in results:
+        if result.get('cached'):
+            # only the time to look up the results
+            continue
+
+        timings[notebook_key(result['file'])] = result['run_time']
+
+    write_history(path, timings)
+
+
+def replace_file(tmp_filename, path):
+    """move a temporary file written in full to `path`
+
+    The file gets the permissions of a new file instead of those of a
+    temporary file, which only the user can read.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_filename, 0o666 & ~umask)
+
+    os.rename(tmp_filename, path)
+
+
+def write_history(path, history):
+    """replace a json history file so that readers never see a partial file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        handle, tmp_filename = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, 'w') as f:
+            f.write(json.dumps(history, indent=1, sort_keys=True))
+
+        replace_file(tmp_filename, path)
+    except OSError:
+        # like the result cache the history only makes later runs faster
+        pass
+
+
+def cell_key(cell):
+    """the name of a cell in the cell timing history, a hash of its source"""
+    return hashlib.sha1(cell.source.encode('utf-8')).hexdigest()
+
+
+def save_cell_timings(path, results, max_count=20, keep=False):
+    """add the durations of all run cells to the cell timing history
+
+    The history keeps the last `max_count` durations of each cell by its
+    `cell_key` for each notebook. Cells that are no longer part of a tested
+    notebook are removed unless `keep` is set. A run that timed out is
+    recorded with the timeout, so the timeout of a cell that became slower
+    grows with each run.
+
+    Parameters
+    ----------
+    path : string
+        the json file of the history
+    results : list of dict
+        the results as returned by `check_notebook`. Cached results are
+        skipped
+    max_count : int, default 20
+        the number of durations kept for each cell
+    keep : bool, default False
+        if True the durations of cells that were not run are kept, e.g. if
+        only some cells were selected
+    """
+    history = load_timings(path)
+    for result in results:
+        if result.get('cached'):
+            continue
+
+        old_cells = history.get(notebook_key(result['file']), {})
+        cells = dict(old_cells) if keep else {}
+        for timing in result['cell_timings']:
+            if timing['runs'] == 0 or 'key' not in timing:
+                continue
+
+            durations = cells.setdefault(
+                timing['key'], list(old_cells.get(timing['key'], [])))
+            durations.append(timing['wall'] / timing['runs'])
+            del durations[:-max_count]
+
+        if cells:
+            history[notebook_key(result['file'])] = cells
+
+    write_history(path, history)
+
+
+def get_cell_timeout(cell, commands, history, args):
+    """the timeout of a cell from `#! timeout` or its recorded durations
+
+    The timeout is the 95th percentile of the durations times
+    `--timeout-factor`, but at least `--min-timeout` and at most `--timeout`.
+    Without durations or with a factor of 0 it is `--timeout`.
+
+    Parameters
+    ----------
+    cell : NotebookNode
+        the cell
+    commands : dict
+        the commands of the cell, see `IPyKernel.get_commands`
+    history : dict of string to list of float
+        the recorded durations in seconds of the cells of the notebook by
+        their `cell_key`
+    args : argparse.Namespace
+        the parsed command line options
+
+    Returns
+    -------
+    float
+        the timeout of the cell in seconds
+    """
+    if 'timeout' in commands:
+        return float(commands['timeout'])
+
+    durations = history.get(cell_key(cell))
+    if not durations or args.timeout_factor <= 0:
+        return args.timeout
+
+    ordered = sorted(durations)
+    percentile = ordered[int(math.ceil(0.95 * len(ordered))) - 1]
+
+    return min(
+        args.timeout, max(args.min_timeout, percentile * args.timeout_factor))
+
+
+def estimate_durations(notebooks, timings):
+    """the expected duration of notebooks from earlier runs
+
+    Notebooks without a recorded duration are estimated by their file size.
+    If some notebooks have a duration the size is converted to seconds using
+    their average time per byte.
+
+    Parameters
+    ----------
+    notebooks : list of string
+        the paths of the notebooks
+    timings : dict of string to float
+        the timing history as returned by `load_timings`
+
+    Returns
+    -------
+    dict of string to float
+        the estimated duration of each notebook
+    """
+    durations = {}
+    known_time = 0.0
+    known_size = 0
+    for ipynb in notebooks:
+        key = notebook_key(ipynb)
+        if key in timings:
+            durations[ipynb] = timings[key]
+            known_time += timings[key]
+            known_size += os.path.getsize(ipynb)
+
+    seconds_per_byte = 1.0
+    if known_size > 0 and known_time > 0:
+        seconds_per_byte = known_time / known_size
+
+    for ipynb in notebooks:
+        if ipynb not in durations:
+            durations[ipynb] = os.path.getsize(ipynb) * seconds_per_byte
+
+    return durations
+
+
+def split_shards(notebooks, durations, count):
+    """distribute notebooks to shards with about the same total duration
+
+    The longest notebook is added to the shard with the shortest total
+    duration first. The result only depends on the notebooks and their
+    durations, so all shards compute the same split.
+
+    Parameters
+    ----------
+    notebooks : list of string
+        the paths of the notebooks
+    durations : dict of string to float
+        the expected duration of each notebook
+    count : int
+        the number of shards
+
+    Returns
+    -------
+    list of list of string
+        the notebooks of each shard in the original order
+    """
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+
+    for ipynb in sorted(notebooks, key=lambda nb: (-durations[nb], nb)):
+        shard = loads.index(min(loads))
+        shards[shard].append(ipynb)
+        loads[shard] += durations[ipynb]
+
+    return [
+        [ipynb for ipynb in notebooks if ipynb in shard] for shard in shards]
+
+
+def parse_shard(value):
+    """parse a shard like `2/4` into a tuple of (index, count)"""
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'a shard has the form i/N, e.g. 1/4')
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            'the shard index needs to be between 1 and %d' % count)
+
+    return index, count
+
+
+def write_result_file(path, results, run_time, shard=None):
+    """write the results of a run, e.g. of one shard, as json
+
+    Parameters
+    ----------
+    path : string
+        the file to write to
+    results : list of dict
+        the results as returned by `check_notebook`
+    run_time : float
+        the total time of the run in seconds
+    shard : tuple of (int, int) or None (default)
+        the index and number of shards if only a shard was tested
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(u'%s' % json.dumps({
+            'shard': list(shard) if shard else None,
+            'run_time': run_time,
+            'results': [
+                dict((key, value) for key, value in result.items()
+                     if key != 'output')
+                for result in results]
+        }, indent=1, sort_keys=True))
+
+
+def merge_result_files(paths):
+    """combine the result files written by several shards
+
+    Parameters
+    ----------
+    paths : list of string
+        the result files
+
+    Returns
+    -------
+    list of dict
+        the results of all notebooks in the order of the files
+    float
+        the longest run time of all shards in seconds
+    """
+    results = []
+    run_time = 0.0
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            content = json.load(f)
+
+        results.extend(content['results'])
+        run_time = max(run_time, content['run_time'])
+
+    return results, run_time
+
+
+# ==============================================================================
+#  CELL DEPENDENCIES
+# ==============================================================================
+
+# names that exist in every kernel and are not defined by a cell
+kernel_names = set(dir(builtins)) | set([
+    'get_ipython', 'display', 'In', 'Out', 'exit', 'quit', '_', '__', '___'])
+
+# line magics that neither read nor define variables of the notebook
+quiet_magics = set([
+    'matplotlib', 'load_ext', 'reload_ext', 'config', 'autoreload',
+    'aimport', 'precision', 'pwd', 'pip', 'conda'])
+
+# functions that read or define variables by a name given as string
+dynamic_functions = set(['exec', 'eval', 'execfile', 'globals', 'locals',
+                         'vars'])
+
+magic_pattern = re.compile(r'^(\s*)([%!])(\S*)')
+
+
+class CellNameVisitor(ast.NodeVisitor):
+    """
+    Collect the names a cell defines and uses
+
+    A name is defined if it is bound at the top level of the cell, e.g. by
+    an assignment, an import or a `def`. Setting an attribute or item of a
+    variable, e.g. `x.a = 1` or `x[0] += 1`, also defines it, and so does
+    calling a method of it at the top level, e.g. `x.append(1)`, since the
+    method may change it. Methods of the names in `modules` and of names
+    imported by the cell are not counted. All names that are read are used,
+    also those read inside functions. A cell that calls `exec`, `eval`,
+    `globals` and the like or uses `import *` is `dynamic`.
+    """
+
+    def __init__(self, modules=()):
+        self.defines = set()
+        self.uses = set()
+        self.imports = set()
+        self.modules = set(modules)
+        self.dynamic = False
+        self.depth = 0
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, (ast.Load, ast.Del)):
+            self.uses.add(node.id)
+
+        if isinstance(node.ctx, (ast.Store, ast.Del)) and self.depth == 0:
+            self.defines.add(node.id)
+
+    def _visit_scope(self, node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    def visit_FunctionDef(self, node):
+        if self.depth == 0:
+            self.defines.add(node.name)
+
+        self._visit_scope(node)
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_FunctionDef
+    visit_Lambda = visit_GeneratorExp = visit_ListComp = _visit_scope
+    visit_SetComp = visit_DictComp = _visit_scope
+
+    def visit_Global(self, node):
+        self.defines.update(node.names)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == '*':
+                self.dynamic = True
+            elif self.depth == 0:
+                name = alias.asname or alias.name.split('.')[0]
+                self.defines.add(name)
+                self.imports.add(name)
+
+    visit_ImportFrom = visit_Import
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name):
+            self.uses.add(node.target.id)
+
+        self.generic_visit(node)
+
+    def _visit_item(self, node):
+        if isinstance(node.ctx, (ast.Store, ast.Del)) and self.depth == 0:
+            base = node.value
+            while isinstance(base, (ast.Attribute, ast.Subscript)):
+                base = base.value
+
+            if isinstance(base, ast.Name):
+                self.defines.add(base.id)
+
+        self.generic_visit(node)
+
+    visit_Attribute = visit_Subscript = _visit_item
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name) and \
+                node.func.id in dynamic_functions:
+            self.dynamic = True
+
+        if isinstance(node.func, ast.Attribute) and self.depth == 0:
+            # a method call like `data.append(1)` may change `data`
+            base = node.func.value
+            while isinstance(base, (ast.Attribute, ast.Subscript)):
+                base = base.value
+
+            if isinstance(base, ast.Name) and \
+                    base.id not in self.modules | self.imports:
+                self.defines.add(base.id)
+
+        self.generic_visit(node)
+
+    def visit_Exec(self, node):
+        self.dynamic = True
+
+
+def cell_names(source, modules=()):
+    """the names a cell defines and uses
+
+    IPython magics and shell commands are ignored if they are known not to
+    touch variables (see `quiet_magics`), otherwise the cell is dynamic. A
+    cell that cannot be parsed is dynamic as well.
+
+    Parameters
+    ----------
+    source : string
+        the source of the cell
+    modules : iterable of string
+        the names of modules imported by cells before, calling their
+        functions does not define them
+
+    Returns
+    -------
+    set of string
+        the names defined by the cell
+    set of string
+        the names used by the cell
+    bool
+        True if the cell may use and define any name, see `CellNameVisitor`
+    set of string
+        the names of defined modules, those bound by an import
+    """
+    dynamic = False
+    lines = []
+
+    for line in source.splitlines():
+        match = magic_pattern.match(line)
+        if match is not None:
+            if match.group(2) != '%' or match.group(3) not in quiet_magics:
+                dynamic = True
+
+            line = match.group(1) + 'pass'
+
+        lines.append(line)
+
+    try:
+        tree = ast.parse('\n'.join(lines))
+    except SyntaxError:
+        return set(), set(), True, set()
+
+    visitor = CellNameVisitor(modules)
+    visitor.visit(tree)
+
+    return visitor.defines, visitor.uses, dynamic or visitor.dynamic, \
+        visitor.imports
+
+
+def command_names(commands, name):
+    """the space separated names of a command like `#! uses:x y`"""
+    value = commands.get(name)
+    if value is None or value is True:
+        return set()
+
+    return set(value.split())
+
+
+def get_cell_dependencies(cells):
+    """the cells each code cell of a notebook needs to be run before it
+
+    A cell depends on the last cell before it that defines a name it uses.
+    A dynamic cell depends on all code cells before it and provides all
+    names that no cell defines. The names found by `cell_names` can be
+    changed with the commands `#! uses:x y`, `#! defines:x y` and
+    `#! dynamic`, e.g. if a cell changes a variable inside a function like
+    `add_to(data)`. Cells with `#! skip` are never run and not part of the
+    graph.
+
+    Parameters
+    ----------
+    cells : list of NotebookNode
+        the cells of the notebook
+
+    Returns
+    -------
+    dict of int to set of int
+        the indices of the cells each code cell depends on directly
+    """
+    dependencies = {}
+
+    # the last cell that defined a name
+    definers = {}
+    dynamic_cells = []
+
+    # the names last bound by an import
+    modules = set()
+
+    for index, cell in enumerate(cells):
+        if cell.cell_type != 'code' or not cell.source:
+            continue
+
+        commands = IPyKernel.get_commands(cell)
+        if 'skip' in commands:
+            continue
+
+        defines, uses, dynamic, imports = cell_names(cell.source, modules)
+        defines |= command_names(commands, 'defines')
+        uses |= command_names(commands, 'uses')
+        dynamic = dynamic or 'dynamic' in commands
+
+        if dynamic:
+            required = set(dependencies)
+        else:
+            required = set()
+            for name in uses:
+                if name in definers:
+                    required.add(definers[name])
+                elif name not in kernel_names:
+                    required.update(dynamic_cells)
+
+        dependencies[index] = required
+
+        for name in defines:
+            definers[name] = index
+
+        modules = (modules - defines) | imports
+
+        if dynamic:
+            dynamic_cells.append(index)
+
+    return dependencies
+
+
+def get_required_cells(dependencies, targets):
+    """the target cells and all cells they depend on
+
+    Parameters
+    ----------
+    dependencies : dict of int to set of int
+        the direct dependencies as returned by `get_cell_dependencies`
+    targets : iterable of int
+        the indices of the cells that should be run
+
+    Returns
+    -------
+    set of int
+        the indices of all cells that need to be run in the order of the
+        notebook to run the targets
+    """
+    required = set()
+    pending = [index for index in targets if index in dependencies]
+
+    while pending:
+        index = pending.pop()
+        if index not in required:
+            required.add(index)
+            pending.extend(dependencies[index])
+
+    return required
+
+
+def parse_cells(value):
+    """parse a list of cell indices like `3,5-7` into a set of int"""
+    cells = set()
+    try:
+        for part in value.split(','):
+            if '-' in part:
+                first, last = [int(index) for index in part.split('-')]
+                cells.update(range(first, last + 1))
+            else:
+                cells.add(int(part))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'cells are given by their index like 3,5-7')
+
+    return cells
+
+
+def read_notebook_revision(path, revision):
+    """read a notebook as it was in a git revision
+
+    Returns None if the notebook is not part of the revision or not in a
+    git repository.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+
+    with open(os.devnull, 'wb') as devnull:
+        try:
+            text = subprocess.check_output(
+                ['git', 'show', '%s:./%s' % (revision, name)],
+                cwd=directory, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return nbformat.reads(text.decode('utf-8'), 4)
+
+
+def select_cells(ipynb, cells, args):
+    """the indices of the cells to run for `--cells` and `--changed-since`
+
+    The selected cells are those given by `--cells` and those whose source
+    changed since the revision of `--changed-since`, together with all cells
+    they depend on, see `get_cell_dependencies`.
+
+    Parameters
+    ----------
+    ipynb : string
+        the path of the notebook
+    cells : list of NotebookNode
+        the cells of the notebook
+    args : argparse.Namespace
+        the parsed command line options
+
+    Returns
+    -------
+    set of int or None
+        the indices of the cells to run or None if all cells are run
+    """
+    if args.cells is None and args.changed_since is None:
+        return None
+
+    targets = set(args.cells or [])
+
+    if args.changed_since is not None:
+        old = read_notebook_revision(ipynb, args.changed_since)
+        old_keys = set()
+        if old is not None:
+            old_keys = set(
+                cell_key(cell) for cell in old.cells
+                if cell.cell_type == 'code')
+
+        targets.update(
+            index for index, cell in enumerate(cells)
+            if cell.cell_type == 'code' and cell_key(cell) not in old_keys)
+
+    return get_required_cells(get_cell_dependencies(cells), targets)
+
+
+# ==============================================================================
+#  GOLDEN OUTPUTS
+# ==============================================================================
+
+def golden_file(ipynb):
+    """the store of recorded outputs next to a notebook"""
+    return os.path.splitext(ipynb)[0] + '.golden.json.gz'
+
+
+def golden_keys(cells):
+    """the keys of all code cells of a notebook in the golden store
+
+    A cell is found by the `cell_key` of its source and the number of code
+    cells before it with the same source, so the store stays valid if cells
+    are added, moved or removed.
+
+    Returns
+    -------
+    dict of int to (string, int)
+        the key and the occurrence for the index of every code cell
+    """
+    keys = {}
+    seen = {}
+
+    for index, cell in enumerate(cells):
+        if cell.cell_type != 'code' or not cell.source:
+            continue
+
+        key = cell_key(cell)
+        keys[index] = (key, seen.get(key, 0))
+        seen[key] = keys[index][1] + 1
+
+    return keys
+
+
+def normalize_outputs(outputs, mimes):
+    """the outputs of a cell with only the parts that are compared
+
+    Streams keep their name and text, display data and results the values
+    of the mime types in `mimes`. Errors are not stored, a cell that raises
+    an error is never recorded.
+    """
+    normalized = []
+
+    for output in outputs:
+        if output['output_type'] == 'stream':
+            normalized.append({
+                'output_type': 'stream',
+                'name': output['name'],
+                'text': output['text']})
+
+        elif output['output_type'] in ('display_data', 'execute_result'):
+            data = dict(
+                (mime, value) for mime, value in output['data'].items()
+                if mime in mimes)
+            if not data:
+                continue
+
+            out = {
+                'output_type': output['output_type'],
+                'data': data,
+                'metadata': {}}
+            if output['output_type'] == 'execute_result':
+                out['execution_count'] = None
+
+            normalized.append(out)
+
+    return normalized
+
+
+def load_golden(path):
+    """the recorded outputs of a golden store by cell key
+
+    Returns an empty dict if the store does not exist yet.
+    """
+    try:
+        with gzip.open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))['cells']
+    except (IOError, OSError, ValueError, KeyError):
+        return {}
+
+
+def save_golden(path, cells, recorded):
+    """add recorded outputs to the golden store of a notebook
+
+    Parameters
+    ----------
+    path : string
+        the store, see `golden_file`
+    cells : list of NotebookNode
+        the cells of the notebook
+    recorded : dict of int to list of dict
+        the normalized outputs for the index of each recorded cell. Cells that
+        were not recorded keep their stored outputs, cells that are no longer
+        part of the notebook are removed
+    """
+    stored = load_golden(path)
+    golden = {}
+
+    for index, (key, occurrence) in sorted(golden_keys(cells).items()):
+        outputs = recorded.get(index)
+        if outputs is None:
+            previous = stored.get(key, [])
+            if occurrence < len(previous):
+                outputs = previous[occurrence]
+
+        golden.setdefault(key, []).append(outputs)
+
+    # unknown outputs at the end of a list are not needed
+    for key, entries in list(golden.items()):
+        while entries and entries[-1] is None:
+            entries.pop()
+        if not entries:
+            del golden[key]
+
+    text = json.dumps(
+        {'version': 1, 'cells': golden}, indent=1, sort_keys=True)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_filename = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        # no time stamp, so recording the same outputs gives the same file
+        with gzip.GzipFile(
+                filename='', mode='wb', fileobj=f, mtime=0) as z:
+            z.write(text.encode('utf-8'))
+
+    replace_file(tmp_filename, path)
+
+
+def apply_golden(cells, golden):
+    """replace the outputs of all code cells by the recorded ones
+
+    Cells without recorded outputs get no outputs.
+
+    Returns
+    -------
+    int
+        the number of code cells with recorded outputs
+    """
+    found = 0
+
+    for index, (key, occurrence) in golden_keys(cells).items():
+        entries = golden.get(key, [])
+        outputs = None
+        if occurrence < len(entries):
+            outputs = entries[occurrence]
+
+        if outputs is not None:
+            found += 1
+
+        cells[index].outputs = [
+            nbformat.from_dict(output) for output in outputs or []]
+
+    return found
+
+
+# ==============================================================================
+#  NOTEBOOK TESTING
+# ==============================================================================
+
+def find_notebooks(patterns):
+    """expand a list of files, directories and glob patterns into notebooks
+
+    Directories are searched recursively for `.ipynb` files. Checkpoint
+    folders created by jupyter are ignored. Each notebook is only listed once
+    and in the order it was first found.
+
+    Parameters
+    ----------
+    patterns : list of string
+        the files, directories or glob patterns to expand
+
+    Returns
+    -------
+    list of string
+        the paths of all notebooks found
+    list of string
+        the patterns that did not match any notebook
+    """
+    notebooks = []
+    unmatched = []
+
+    for pattern in patterns:
+        found = []
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs[:] = sorted(
+                        d for d in dirs if d != '.ipynb_checkpoints')
+                    found.extend(
+                        os.path.join(root, f) for f in sorted(files)
+                        if f.endswith('.ipynb'))
+            else:
+                found.append(path)
+
+        if not found:
+            unmatched.append(pattern)
+
+        for path in found:
+            if path not in notebooks:
+                notebooks.append(path)
+
+    return notebooks, unmatched
+
+
+# a key of a mime bundle followed by the start of its value, which is a
+# string or a list of strings. Keys follow a `{` or `,` outside of strings
+mime_key_pattern = re.compile(
+    br'[{,]\s*"([a-zA-Z]+/[-+.\w]+)"\s*:\s*(?=["\[])')
+
+# the separator after a string in a list of strings
+json_list_separator_pattern = re.compile(br'\s*([,\]])\s*')
+
+json_whitespace_pattern = re.compile(br'\s*')
+
+
+def get_output_mimes(output_types):
+    """the mime types compared by a list of output types
+
+    Parameters
+    ----------
+    output_types : list of string
+        the identifiers of the output types
+
+    Returns
+    -------
+    set of string
+        the mime types of the output types and `text/plain`
+    """
+    mimes = set(registered_output_types[tt].mime for tt in output_types)
+    mimes.add('text/plain')
+    return mimes
+
+
+def _json_string_end(data, pos):
+    """the end of the json string that starts at `pos` or None"""
+    end = data.find(b'"', pos + 1)
+    while end >= 0:
+        # the quote ends the string unless it is escaped by an odd number of
+        # backslashes
+        backslashes = 0
+        while data[end - backslashes - 1:end - backslashes] == b'\\':
+            backslashes += 1
+
+        if backslashes % 2 == 0:
+            return end + 1
+
+        end = data.find(b'"', end + 1)
+
+    return None
+
+
+def _json_value_end(data, pos):
+    """the end of the string or list of strings that starts at `pos` or None
+    """
+    if data[pos:pos + 1] == b'"':
+        return _json_string_end(data, pos)
+
+    # a list of strings like `["line 1\n", "line 2"]`
+    match = json_list_separator_pattern.match(data, pos + 1)
+    if match is not None and match.group(1) == b']':
+        return match.end(1)
+
+    pos = json_whitespace_pattern.match(data, pos + 1).end()
+    while data[pos:pos + 1] == b'"':
+        pos = _json_string_end(data, pos)
+        match = pos and json_list_separator_pattern.match(data, pos)
+        if not match:
+            return None
+
+        if match.group(1) == b']':
+            return match.end(1)
+
+        pos = match.end()
+
+    return None
+
+
+def skip_outputs(data, mimes, min_size=1024):
+    """replace the values of output mime types that are not compared
+
+    Parameters
+    ----------
+    data : bytes or mmap.mmap
+        the json of a notebook
+    mimes : set of string
+        the mime types to keep
+    min_size : int, default 1024
+        values with less bytes are always kept
+
+    Returns
+    -------
+    bytes or None
+        the json with the large values of all other mime types replaced by
+        their mime type, their size and their sha1 hash. None if no value was
+        replaced. The replacement does not depend on the position of the
+        value, so it only changes if the value does
+    """
+    pieces = []
+    copied = 0
+    pos = 0
+
+    while True:
+        match = mime_key_pattern.search(data, pos)
+        if match is None:
+            break
+
+        start = match.end()
+        end = _json_value_end(data, start)
+        if end is None:
+            # not a string or list of strings, leave it to the parser
+            pos = start
+            continue
+
+        # continue after the value so large values are not searched
+        pos = end
+
+        mime = match.group(1).decode('ascii')
+        if mime in mimes or end - start < min_size:
+            continue
+
+        digest = hashlib.sha1(data[start:end]).hexdigest()
+        pieces.append(data[copied:start])
+        pieces.append(json.dumps(
+            'skipped %s: %d bytes, sha1 %s' % (
+                mime, end - start, digest)).encode('ascii'))
+        copied = end
+
+    if not pieces:
+        return None
+
+    pieces.append(data[copied:])
+    return b''.join(pieces)
+
+
+def read_notebook(path, mimes=None):
+    """read a notebook without the outputs that are not compared
+
+    Stored images and other large outputs take most of the space in many
+    notebooks. The file is mapped into memory and all values of output mime
+    types not in `mimes` are replaced by a short string with their mime
+    type, their size and their sha1 hash before the json is parsed (see
+    `skip_outputs`). So the outputs still change if the original does,
+    but are neither loaded nor parsed.
+
+    Parameters
+    ----------
+    path : string
+        the notebook file
+    mimes : set of string or None (default)
+        the mime types to keep. If None all outputs are kept
+
+    Returns
+    -------
+    NotebookNode
+        the notebook in version 4
+    """
+    text = None
+
+    if mimes is not None and os.path.getsize(path) > 0:
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                data = skip_outputs(mapped, mimes)
+            finally:
+                mapped.close()
+
+        if data is not None:
+            text = data.decode('utf-8')
+
+    if text is None:
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+
+    nb = nbformat.reads(text, 4)
+
+    # Convert all notebooks to the format IPython 3.0.0 uses to
+    # simplify comparison
+    return nbformat.convert(nb, 4)
+
+
+def get_extra_arguments(args):
+    """the extra arguments for the kernel from the command line options"""
+    extra_arguments = args.extra_arguments.split(";")
+
+    if args.pylab:
+        extra_arguments = ['--pylab=inline'] + extra_arguments
+
+    return extra_arguments
+
+
+def get_warmup_code(args):
+    """the code of the `--warmup` script or None if not given"""
+    if not args.warmup:
+        return None
+
+    with open(args.warmup, encoding='utf-8') as f:
+        return f.read()
+
+
+def parse_kernels(value):
+    """parse a list of kernelspec names like `python2,python3`
+
+    A name given twice is used once, the results of a kernel are shown under
+    its name.
+    """
+    names = []
+    for name in value.split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+
+    if not names:
+        raise argparse.ArgumentTypeError(
+            'kernels are given by their kernelspec name like python2,python3')
+
+    return names
+
+
+def get_kernel_names(args):
+    """the kernelspecs each notebook is run in, None is the default kernel"""
+    return args.kernels or [None]
+
+
+def get_kernel_name(args):
+    """the kernelspec of a run or None for the default kernel
+
+    The options of a run with several `--kernels` are split into one set of
+    options for each kernel first, see `kernel_args`.
+    """
+    return get_kernel_names(args)[0]
+
+
+def kernel_args(args, kernel_name):
+    """a copy of the command line options that runs only `kernel_name`"""
+    options = argparse.Namespace(**vars(args))
+    options.kernels = [kernel_name] if kernel_name is not None else None
+    return options
+
+
+def get_stream_max_size(args):
+    """the maximal number of characters of a stream or None if unlimited"""
+    if not args.stream_max_size:
+        return None
+
+    return args.stream_max_size * 1000 * 1000
+
+
+def get_compare_options(args, commands=None):
+    """the options passed to the outputs of a cell for the comparison
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        the parsed command line options
+    commands : dict or None (default)
+        the commands of the cell. `rtol` and `atol` override the options
+    """
+    if commands is None:
+        commands = {}
+
+    return {
+        'rtol': commands.get('rtol', args.rtol),
+        'atol': commands.get('atol', args.atol),
+        'diff_context': args.diff_context,
+        'diff_max_lines': args.diff_max_lines,
+        'image_threshold': args.image_threshold,
+        'image_tolerance': args.image_tolerance,
+        'image_size': args.image_size,
+        'stream_max_size': get_stream_max_size(args)
+    }
+
+
+def create_kernel_pool(args):
+    """create a kernel pool from the command line options"""
+    return IPyKernelPool(
+        size=args.kernel_pool,
+        extra_arguments=get_extra_arguments(args),
+        warmup=get_warmup_code(args),
+        kernel_name=get_kernel_name(args))
+
+
+def create_result_cache(args):
+    """create the result cache from the command line options
+
+    Returns None if caching is switched off with `--no-cache`.
+    """
+    if args.no_cache:
+        return None
+
+    return ResultCache(args.cache_dir, max_size=args.cache_size * 1024 * 1024)
+
+
+class NotebookSession(object):
+    """
+    The kernel of a notebook that is kept between runs in `--watch` mode
+
+    A run starts at the first code cell that changed since the last run (or
+    that was not run, e.g. after `--abort-if-fail`). The cells before it are
+    not run again and their variables are reused from the kernel. Their
+    results of the last run are part of the results of the new run. A new
+    kernel is started if the first code cell changed or the kernel died.
+
+    Notes
+    -----
+    - Variables defined by cells after the changed one in the last run are
+      still in the kernel when these cells are run again
+    """
+
+    def __init__(self):
+        self.kernel = None
+
+        # the keys of the code cells in the last run, see `get_cell_keys`
+        self.cell_keys = {}
+
+        # the index of the last cell that was run in the kernel
+        self.last_index = -1
+
+        # the results of the cells in the last run, see `cell_results` of
+        # `IPyTestConsole`
+        self.cell_results = []
+
+    def start_index(self, cell_keys):
+        """the index of the cell to start the next run at
+
+        Parameters
+        ----------
+        cell_keys : dict of int to string
+            the keys of the code cells of the changed notebook
+
+        Returns
+        -------
+        int or None
+            the index of the first code cell to run, 0 if the notebook needs
+            a new kernel or None if no code cell needs to be run
+        """
+        if self.kernel is None or not self.kernel.is_alive():
+            return 0
+
+        indices = sorted(cell_keys)
+        for index in indices:
+            if self.cell_keys.get(index) != cell_keys[index] or \
+                    index > self.last_index:
+                if index == indices[0]:
+                    return 0
+
+                return index
+
+        return None
+
+    def stop(self):
+        """shut down the kernel if it is still running"""
+        if self.kernel is not None and self.kernel.started:
+            self.kernel.stop()
+
+        self.kernel = None
+
+
+def restart_kernel(ipy, cells, args, history, tv):
+    """restart a hung kernel and run the cells before the hung one again
+
+    Cells are skipped and ignored like in the test, e.g. a `#! ignore` cell
+    may time out as long as it can be interrupted.
+
+    Parameters
+    ----------
+    ipy : IPyKernel
+        the hung kernel
+    cells : list of NotebookNode
+        the cells of the notebook before the hung cell
+    args : argparse.Namespace
+        the parsed command line options
+    history : dict of string to list of float
+        the recorded durations of the cells, see `get_cell_timeout`
+    tv : IPyTestConsole
+        the console to report to
+
+    Returns
+    -------
+    bool
+        True if all cells were run again, False if one of them timed out or
+        the kernel failed
+    """
+    tv.write(tv.red('not interrupted, restarting kernel ... '))
+
+    try:
+        ipy.restart()
+
+        if args.eval:
+            ipy.execute(args.eval)
+
+        for cell in cells:
+            if cell.cell_type != 'code' or ipy.is_empty_cell(cell):
+                continue
+
+            commands = ipy.get_commands(cell)
+            if 'skip' in commands:
+                continue
+
+            try:
+                ipy.run(cell, use_timeout=get_cell_timeout(
+                    cell, commands, history, args))
+            except Empty:
+                if 'ignore' in commands and not ipy.hung:
+                    continue
+
+                tv.write(tv.red('a cell before timed out, '))
+                if ipy.hung:
+                    ipy.restart()
+
+                return False
+    except Exception as e:
+        # e.g. the new kernel died while the cells were run again
+        tv.write(tv.red('failed: %s, ' % repr(e)))
+        return False
+
+    tv.write('ok ')
+    return True
+
+
+def run_notebook(ipynb, args, output_types, tv, kernel_pool=None,
+                 session=None):
+    """run all cells of a notebook as a test and write the results to `tv`
+
+    The notebook is run in a fresh kernel that uses the directory of the
+    notebook as working directory. If `--restart-if-fail` is set the notebook
+    is run again in a new kernel, so the counts in `tv` refer to the last
+    attempt only.
+
+    Parameters
+    ----------
+    ipynb : string
+        path to the notebook to be tested
+    args : argparse.Namespace
+        the parsed command line options
+    output_types : list of string
+        the identifiers of the output types to be compared
+    tv : IPyTestConsole
+        the console that receives all output and counts the results
+    kernel_pool : IPyKernelPool or None (default)
+        if not None the kernels are taken from this pool instead of being
+        started for each run
+    session : NotebookSession or None (default)
+        if not None the kernel is kept in the session after the run and only
+        the cells that changed since the last run in the session are run.
+        `--restart-if-fail` is not used
+    """
+    start_time = time.time()
+    verbose = args.verbose
+
+    tv.fold_open('ipynb')
+    if args.kernels:
+        tv.writeln('testing ipython notebook : "%s" in kernel "%s"' % (
+            ipynb, get_kernel_name(args)))
+    else:
+        tv.writeln('testing ipython notebook : "%s"' % ipynb)
+
+    timeout_rerun = args.rerun
+    fail_restart = args.restart
+
+    if session is not None:
+        fail_restart = 0
+
+    extra_arguments = get_extra_arguments(args)
+    warmup = get_warmup_code(args)
+
+    used_output_types = output_types
+
+    # run each notebook in its own directory so relative paths work and
+    # parallel runs do not depend on the directory the tests were started in
+    cwd = os.path.dirname(os.path.abspath(ipynb))
+
+    output_mimes = get_output_mimes(output_types)
+
+    if args.golden:
+        # the stored outputs are replaced, so none of them is loaded
+        nb = read_notebook(ipynb, set())
+    else:
+        nb = read_notebook(ipynb, output_mimes)
+
+    nbs = ipynb.split('/')[-1].split('.')
+
+    nb_class_name = nbs[1] + '.' + nbs[0].replace(" ", "_")
+
+    if hasattr(nb, 'worksheets'):
+        ws = nb.worksheets[0]
+    else:
+        ws = nb
+
+    cell_history = load_timings(get_cell_timings_file(args)).get(
+        notebook_key(ipynb), {})
+
+    if args.golden:
+        found = apply_golden(ws.cells, load_golden(golden_file(ipynb)))
+        tv.writeln('golden outputs of %d of %d code cells from "%s"' % (
+            found, len(golden_keys(ws.cells)), golden_file(ipynb)))
+
+    # the normalized outputs of the cells that ran without error
+    recorded = None
+    if args.record:
+        recorded = {}
+
+    selection = select_cells(ipynb, ws.cells, args)
+    if selection is not None:
+        n_code_cells = sum(
+            1 for cell in ws.cells if cell.cell_type == 'code' and cell.source)
+        if not selection:
+            tv.writeln('no code cell selected')
+            tv.fold_close('ipynb')
+            return
+
+        tv.writeln('running %d of %d code cells: %s' % (
+            len(selection), n_code_cells,
+            ', '.join(str(index) for index in sorted(selection))))
+
+    # a part of the notebook passing does not mean all of it passes
+    cache = None
+    if selection is None and recorded is None:
+        cache = create_result_cache(args)
+
+    cell_keys = {}
+
+    if cache is not None or session is not None:
+        cell_keys = get_cell_keys(
+            ws.cells, get_cache_settings(args), ipynb)
+
+    start_index = 0
+    if session is not None:
+        start_index = session.start_index(cell_keys)
+
+        if start_index is None:
+            tv.writeln('no code cell changed')
+            tv.fold_close('ipynb')
+            return
+
+        if start_index == 0:
+            session.stop()
+
+    if cache is not None and session is None:
+        cached = [cache.get(key) for index, key in sorted(cell_keys.items())]
+
+        if all(entry is not None for entry in cached):
+            # nothing changed since all cells passed the last time
+            tv.cached = True
+            tv.br()
+            for index, entry in zip(sorted(cell_keys), cached):
+                tv.current_cell = (index, entry['cell'])
+                tv.write(nb_class_name + '.' + entry['cell'] + ' ... cached / ')
+                tv.write_result(entry['result'], okay_list={
+                    entry['result']: True})
+
+            tv.br()
+            tv.write_summary(time.time() - start_time)
+            tv.fold_close('ipynb')
+            return
+
+    notebook_restart = True
+    notebook_run_count = 0
+
+    # the last checkpoint a restart can resume from. Holds the index of the
+    # cell, the name of the cell, the checkpoint file and the result counts
+    # and results of the cells up to it
+    checkpoint = None
+    checkpoint_dir = None
+
+    while notebook_restart:
+        notebook_restart = False
+        notebook_run_count += 1
+
+        tv.reset()
+        startup_time = time.time()
+        if start_index > 0:
+            tv.write("reusing kernel ... ")
+            kernel = session.kernel
+            kernel.console = tv
+        elif kernel_pool is not None:
+            tv.write("starting kernel ... ")
+            kernel = kernel_pool.acquire(cwd)
+            kernel.console = tv
+        else:
+            tv.write("starting kernel ... ")
+            kernel = IPyKernel(
+                extra_arguments=extra_arguments, cwd=cwd, console=tv,
+                warmup=warmup, kernel_name=get_kernel_name(args))
+
+        if session is not None:
+            kernel.keep_alive = True
+            session.kernel = kernel
+            session.cell_keys = cell_keys
+
+        with kernel as ipy:
+            ipy.default_timeout = args.timeout
+            ipy.interrupt_timeout = args.interrupt_timeout
+            ipy.stream_max_size = get_stream_max_size(args)
+            tv.writeln("ok")
+            tv.add_time('startup', time.time() - startup_time)
+
+            tv.br()
+
+            if args.eval and start_index == 0:
+                ipy.execute(args.eval)
+
+            # cells before the first changed one have been run in the session
+            resume_index = start_index - 1
+            if session is not None:
+                session.last_index = resume_index
+
+            if start_index > 0:
+                kept = [
+                    cell_result for cell_result in session.cell_results
+                    if cell_result[0][0] < start_index]
+                tv.keep_results(kept)
+                tv.writeln('keeping the results of %d cell(s) before, '
+                           '%d failed' % (
+                               len(kept), sum(1 for r in kept if not r[2])))
+
+            if checkpoint is not None:
+                tv.write('restoring checkpoint after %s ... ' % (
+                    checkpoint['cell']))
+                try:
+                    ipy.load_checkpoint(checkpoint['file'])
+                except Exception as e:
+                    tv.writeln(tv.red(
+                        'failed: %s. Running all cells' % str(e)))
+                    checkpoint = None
+                else:
+                    tv.writeln('ok')
+                    resume_index = checkpoint['index']
+                    tv.pass_count, tv.fail_count, result_count, \
+                        cell_results = checkpoint['counts']
+                    tv.result_count = dict(result_count)
+                    tv.cell_results = list(cell_results)
+
+            # the code cells that are run, so the next one can be started
+            # while the outputs of a cell are compared
+            run_indices = [
+                index for index, cell in enumerate(ws.cells)
+                if index > resume_index and cell.cell_type == 'code' and
+                not ipy.is_empty_cell(cell) and
+                'skip' not in ipy.get_commands(cell) and
+                (selection is None or index in selection)]
+            next_indices = dict(zip(run_indices, run_indices[1:]))
+
+            # the index and execution of the cell that was started early
+            started = None
+
+            for cell_index, cell in enumerate(ws.cells):
+                if notebook_restart:
+                    # if we restart anyway skip all remaining cells
+                    continue
+
+                if cell_index <= resume_index:
+                    # these cells have been run before the checkpoint
+                    continue
+
+                if session is not None:
+                    session.last_index = cell_index
+
+                if cell.cell_type == 'markdown':
+                    for line in cell.source.splitlines():
+                        # only tv.writeln(headlines in markdown
+                        if line.startswith('#') and line[1] != '!':
+                            tv.writeln(line)
+
+                # if cell.cell_type == 'heading':
+                #     tv.writeln('#' * cell.level + ' ' + cell.source)
+
+                if cell.cell_type == 'raw':
+                    # handle RAW cells
+                    continue
+
+                if cell.cell_type != 'code':
+                    continue
+
+                # if code cell then continue
+
+                if ipy.is_empty_cell(cell):
+                    # empty cell will not be tested
+                    continue
+
+                if selection is not None and cell_index not in selection:
+                    # the cell is not needed by the selected cells
+                    continue
+
+                # if hasattr(cell, 'prompt_number'):
+                #     tv.write(nb_class_name + '.' + 'In [%3i]' %
+                #              cell.prompt_number + ' ... ')
+                if hasattr(cell, 'execution_count') and \
+                        cell.execution_count is not None:
+                    cell_name = 'In [%3i]' % cell.execution_count
+                else:
+                    cell_name = 'In [---]'
+
+                tv.write(nb_class_name + '.' + cell_name + ' ... ')
+                tv.current_cell = (cell_index, cell_name)
+
+                nb_cell_commands = ipy.get_commands(cell)
+
+                result = 'success'
+
+                if 'skip' in nb_cell_commands:
+                    tv.write_result('skip')
+                    continue
+
+                cell_run_count = 0
+                cell_run_again = True
+                cell_passed = True
+
+                # True if the kernel was restarted, but the cells before
+                # could not be run again
+                replay_failed = False
+
+                ex_cell_outputs = []
+
+                cell_timeout = get_cell_timeout(
+                    cell, nb_cell_commands, cell_history, args)
+
+                cell_start_time = time.time()
+
+                early_execution = None
+                if started is not None and started[0] == cell_index:
+                    early_execution = started[1]
+                    cell_start_time = early_execution.submit_time
+
+                started = None
+                timing = {
+                    'file': ipynb,
+                    'index': cell_index,
+                    'cell': cell_name,
+                    'key': cell_key(cell),
+                    'timeout': cell_timeout,
+                    'attempt': notebook_run_count,
+                    'runs': 0,
+                    'wall': 0.0,
+                    'wait': 0.0,
+                    'busy': 0.0,
+                    'messages': 0,
+                    'bytes': 0,
+                    'queued': 0,
+                    'dropped': 0,
+                    'compare': 0.0
+                }
+                tv.cell_timings.append(timing)
+
+                while cell_run_again:
+                    cell_run_count += 1
+                    cell_run_again = False
+                    cell_passed = True
+                    dropped = ipy.loop.dropped
+
+                    try:
+                        if early_execution is None:
+                            ex_cell_outputs = ipy.run(
+                                cell, use_timeout=cell_timeout)
+                        else:
+                            # a rerun after a timeout starts the cell again
+                            execution, early_execution = early_execution, None
+                            ex_cell_outputs = ipy.finish(execution)
+
+                    except Exception as e:
+                        # we got a jupyter problem to execute something
+                        # in the kernel at all. Not that the execution raised
+                        # an error
+                        # Might still be that the cell did not execute
+                        # or timeout
+
+                        if ipy.hung:
+                            # the cell did not stop when it was interrupted
+                            replay_failed = not restart_kernel(
+                                ipy, [
+                                    c for i, c in enumerate(
+                                        ws.cells[:cell_index])
+                                    if selection is None or i in selection],
+                                args, cell_history, tv)
+
+                        if replay_failed:
+                            # the new kernel lacks the state of the cells
+                            # before, this and later cells cannot be tested
+                            cell_passed = False
+                            tv.write_result('kernel')
+                            tv.fold_open('ipynb.kernel')
+                            tv.writeln(
+                                '>>> the cells before could not be run '
+                                'again after restarting the kernel, the '
+                                'remaining cells are not run')
+                            tv.fold_close('ipynb.kernel')
+
+                        elif 'ignore' not in nb_cell_commands:
+                            cell_passed = False
+                            if repr(e) == 'Empty()':
+                                # Assume it has been timed out!
+                                if cell_run_count <= timeout_rerun:
+                                    cell_run_again = True
+                                    tv.write('timeout after %.3gs [retry #%d] ' % (
+                                        cell_timeout, cell_run_count))
+                                else:
+                                    if 'pass-if-timeout' in nb_cell_commands:
+                                        tv.write_result('timeout', okay_list={'timeout': True})
+                                    elif 'fail-if-timeout' in nb_cell_commands:
+                                        tv.write_result('timeout', okay_list={'timeout': False})
+                                    else:
+                                        tv.write_result('timeout')
+
+                                        ipy.clear()
+
+                            else:
+                                tv.write_result('kernel')
+                                tv.fold_open('ipynb.kernel')
+                                tv.writeln('>>> ' + e[0] + ' ("' + e[1] + '")')
+                                tv.writeln(repr(e[2]), indent=4)
+                                tv.fold_close('ipynb.kernel')
+                        else:
+                            if repr(e) == 'Empty()':
+                                # Assume it has been timed out!
+                                tv.write('timeout / ')
+                                tv.write_result('ignore')
+                            else:
+                                tv.write('kernel / ')
+                                tv.write_result('ignore')
+                                tv.fold_open('ipynb.kernel')
+                                tv.writeln('>>> ' + e[0] + ' ("' + e[1] + '")')
+                                tv.writeln(repr(e[2]), indent=4)
+                                tv.fold_close('ipynb.kernel')
+
+                    if ipy.last_execution is not None:
+                        timing['runs'] += 1
+                        for key, value in ipy.last_execution.timing.items():
+                            if key == 'queued':
+                                timing[key] = max(timing[key], value)
+                            else:
+                                timing[key] += value
+
+                    # messages of e.g. `--eval` or an interrupted run
+                    timing['dropped'] += ipy.loop.dropped - dropped
+
+                timing['wall'] = time.time() - cell_start_time
+                tv.add_time('wait', timing['wait'])
+                tv.add_time('execution', timing['busy'])
+                tv.add_time('transport', max(
+                    0.0, timing['wall'] - timing['wait'] - timing['busy']))
+
+                if not cell_passed:
+                    if tv.last_fail and notebook_run_count <= fail_restart:
+                        notebook_restart = True
+
+                    if args.abort_fail or replay_failed:
+                        break
+                    else:
+                        continue
+
+                failed = False
+                diff = False
+                diff_str = ''
+                out_str = ''
+
+                # Check first, if we have an error output
+
+                for out in ex_cell_outputs:
+                    if out.output_type == 'error':
+                        # An error occurred. Cell is not completed correctly
+                        if 'ignore' not in nb_cell_commands:
+                            tv.write_result('error')
+                        else:
+                            tv.write('error / ')
+                            tv.write_result('ignore')
+
+                        tv.fold_open('ipynb.error')
+                        tv.writeln('>>> ' + out.ename + ' ("' + out.evalue + '")')
+
+                        for idx, trace in enumerate(out.traceback[1:]):
+                            tv.writeln(trace, indent=4)
+
+                        tv.fold_close('ipynb.error')
+                        failed = True
 
-        return s
+                if recorded is not None and not failed:
+                    recorded[cell_index] = normalize_outputs(
+                        ex_cell_outputs, output_mimes)
+
+                # start the next cell while this one is compared unless its
+                # result could stop the run, or a checkpoint is saved after it
+                may_fail = 'ignore' not in nb_cell_commands and (
+                    failed or 'strict' in nb_cell_commands or (
+                        not tv.default_results['diff'] and
+                        'lazy' not in nb_cell_commands))
+                may_stop = args.abort_fail or \
+                    notebook_run_count <= fail_restart
+                saves_checkpoint = 'checkpoint' in nb_cell_commands and \
+                    fail_restart > 0
+
+                next_index = next_indices.get(cell_index)
+                if next_index is not None and not saves_checkpoint and \
+                        not (may_fail and may_stop):
+                    next_cell = ws.cells[next_index]
+                    started = (next_index, ipy.submit(
+                        next_cell, use_timeout=get_cell_timeout(
+                            next_cell, ipy.get_commands(next_cell),
+                            cell_history, args)))
 
-    @staticmethod
-    def run_ndiff(original, testing):
-        return list(
-            difflib.ndiff(original.splitlines(1), testing.splitlines(1)))
+                # if there has been no `error` so far run the comparison
 
+                # this will first filter cells we want to compare at all
+                # and then run the comparison on these
 
-class StdOutOutput(TypedOutput):
-    output_type = 'stream'
-    name = 'stdout'
-    mime = 'text/plain'
+                # we will create a sorted list of all relevant contenttypes
 
-    def __nonzero__(self):
-        return super(StdOutOutput, self).__nonzero__() and \
-            self._out['name'] == self.name
+                cell_output_types = get_cell_output_types(
+                    used_output_types, nb_cell_commands)
+                compare_options = get_compare_options(args, nb_cell_commands)
 
-    def _cmp_key(self):
-        return self.sanitize(self.text)
+                compare_start_time = time.time()
 
-    @property
-    def text(self):
-        return self._out['text']
+                ex_cell_outs = get_outs(
+                    ex_cell_outputs, cell_output_types, compare_options)
+                nb_cell_outs = get_outs(
+                    cell.outputs, cell_output_types, compare_options)
 
+                out_str = ''
+                err_str = ''
 
-class StdErrOutput(StdOutOutput):
-    name = 'stderr'
+                if verbose or 'verbose' in nb_cell_commands:
+                    text_cells = get_outs(
+                        ex_cell_outputs,
+                        ['stream.stdout.text/plain', 'execute_result.data.text/plain'])
+                    for text_cell in text_cells:
+                        out_str += text_cell.text.strip() + '\n'
 
+                    text_cells = get_outs(
+                        ex_cell_outputs,
+                        ['stream.stderr.text/plain'])
+                    for text_cell in text_cells:
+                        err_str += text_cell.text.strip() + '\n'
 
-class MimeBundleOutput(TypedOutput):
-    mime = 'none'
-    name = 'data'
-    output_type = 'display_data'
+                if not failed:
+                    if len(ex_cell_outs) != len(nb_cell_outs):
+                        diff_str += tv.blue(">>> diff in number of relevant content parts %d vs %d\n") % (
+                            len(ex_cell_outputs), len(cell.outputs))
 
-    @property
-    def data(self):
-        return self._out[self.name]
+                        if len(ex_cell_outs) > len(nb_cell_outs):
+                            nb_cell_outs += ['---'] * (len(ex_cell_outs) - len(nb_cell_outs))
+                        else:
+                            ex_cell_outs += ['---'] * (len(nb_cell_outs) - len(ex_cell_outs))
 
-    def __nonzero__(self):
-        return super(MimeBundleOutput, self).__nonzero__() and \
-            self.mime in self.data
+                        for orig, test in zip(nb_cell_outs, ex_cell_outs):
+                            diff_str += tv.green("    %36s ") % str(orig)
+                            diff_str += ' | ' + tv.red("%s\n") % str(test)
 
-    def _cmp_key(self):
-        return self.data[self.mime]
+                        diff = True
+                    else:
+                        for o1, o2 in zip(nb_cell_outs, ex_cell_outs):
+                            if o1 != o2:
+                                # Output is different
+                                diff = True
 
+                                if args.show_diff:
+                                    err_message = o2.compare_str(o1)
+                                    diff_str += tv.format_diff(err_message)
+                                    diff_str += '\n'
 
-class ImageOutput(MimeBundleOutput):
-    def compare_str(self, other):
-        return ['>>> diff in %s' % str(self)] + \
-               ['size new : %d vs size old : %d )' % (
-                   len(self.key), len(other.key))]
+                timing['compare'] = time.time() - compare_start_time
+                tv.add_time('comparison', timing['compare'])
 
+                if diff and not failed:
+                    if 'ignore' not in nb_cell_commands:
+                        if 'strict' in nb_cell_commands:
+                            # strict mode means a difference will fail the test
+                            tv.write_result('diff', okay_list={'diff': False})
+                        elif 'lazy' in nb_cell_commands:
+                            # lazy mode means a difference will pass the test
+                            tv.write_result('diff', okay_list={'diff': True})
+                        else:
+                            # use defaults
+                            tv.write_result('diff')
+                    else:
+                        tv.write('diff / ')
+                        tv.write_result('ignore')
 
-class PNGOutput(ImageOutput):
-    mime = 'image/png'
+                    if args.show_diff:
+                        tv.fold_open('ipynb.diff')
+                        tv.writeln(diff_str)
+                        tv.fold_close('ipynb.diff')
 
+                if not failed and not diff:
+                    tv.write_result('success')
 
-class PNGOutputExecuted(PNGOutput):
-    output_type = 'execute_result'
+                if tv.last_fail and notebook_run_count <= fail_restart:
+                    # we had a fail so restart the whole notebook
+                    notebook_restart = True
 
+                if out_str != '' and 'quiet' not in nb_cell_commands:
+                    n_lines = len(out_str.strip().split('\n'))
+                    tv.write(tv.blue(">>> stdout / result text [%d line(s)]\n" % n_lines))
+                    tv.fold_open('ipynb.out')
+                    tv.writeln(out_str, indent=4)
+                    tv.fold_close('ipynb.out')
 
-class SVGOutput(ImageOutput):
-    mime = 'image/svg'
+                if err_str != '' and 'quiet' not in nb_cell_commands:
+                    n_lines = len(err_str.strip().split('\n'))
+                    tv.write(tv.red(">>> stderr / result text [%d line(s)]\n" % n_lines))
+                    tv.fold_open('ipynb.out')
+                    tv.writeln(err_str, indent=4)
+                    tv.fold_close('ipynb.out')
 
+                if 'checkpoint' in nb_cell_commands and fail_restart > 0 \
+                        and not tv.last_fail:
+                    # save the state so a restart can resume after this cell
+                    if checkpoint_dir is None:
+                        checkpoint_dir = tempfile.mkdtemp(prefix='ipynbtest')
 
-class SVGOutputExecuted(PNGOutput):
-    output_type = 'execute_result'
+                    checkpoint_file = os.path.join(
+                        checkpoint_dir, 'cell%d.pickle' % cell_index)
 
+                    tv.write(tv.blue('>>> saving checkpoint ... '))
+                    try:
+                        skipped = ipy.save_checkpoint(checkpoint_file)
+                    except Exception as e:
+                        skipped = None
+                        tv.writeln(tv.red('failed: %s' % str(e)))
+                    else:
+                        if skipped:
+                            tv.writeln(tv.red(
+                                'incomplete, cannot save %s' %
+                                ', '.join(skipped)))
+                        else:
+                            tv.writeln('ok')
+
+                    if skipped == []:
+                        checkpoint = {
+                            'index': cell_index,
+                            'cell': cell_name,
+                            'file': checkpoint_file,
+                            'counts': (
+                                tv.pass_count, tv.fail_count,
+                                dict(tv.result_count),
+                                list(tv.cell_results))
+                        }
 
-class TextPlainOutput(MimeBundleOutput):
-    mime = 'text/plain'
+                if args.abort_fail and tv.last_fail:
+                    # a fail should stop the tests (but allow retries)
+                    tv.writeln(tv.blue('aborting tests!'))
+                    break
 
-    @property
-    def text(self):
-        return str(self.data[self.mime])
+            if started is not None:
+                # the run stopped before the cell that was started early
+                ipy.cancel(started[1])
+                ipy.interrupt()
 
-    def _cmp_key(self):
-        return self.sanitize(self.text)
+            if session is not None:
+                session.cell_results = list(tv.cell_results)
 
+            if cache is not None:
+                # remember passed cells so unchanged notebooks can be skipped
+                for (index, name), result, passed in tv.cell_results:
+                    if passed:
+                        cache.put(
+                            cell_keys[index], {'cell': name, 'result': result})
 
-class TextPlainOutputExecuted(TextPlainOutput):
-    output_type = 'execute_result'
+            tv.br()
+            tv.write_summary(time.time() - start_time)
 
+            if notebook_restart:
+                tv.br()
+                tv.writeln(
+                    tv.red("  attempt #%d of max %d failed, restarting notebook!" % (
+                        notebook_run_count, fail_restart + 1
+                    ))
+                )
+                if checkpoint is not None:
+                    tv.writeln(tv.red("  resuming from checkpoint after %s" %
+                                      checkpoint['cell']))
 
-# list all possible Mime / Output Types
-registered_output_types = {
-    tt('').identifier: tt for tt in [
-        StdOutOutput, StdErrOutput, TextPlainOutput, TextPlainOutputExecuted,
-        PNGOutput, PNGOutputExecuted, SVGOutput, SVGOutputExecuted
-    ]}
+            tv.br()
+            if session is not None:
+                tv.write("keeping kernel ... ")
+            else:
+                tv.write("shutting down kernel ... ")
 
-# these types will be considered by default
-used_output_types = ['stdout.text/plain', 'data.text/plain']
+        tv.writeln('ok')
 
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
 
-def get_outs(cell_outputs, output_types):
-    outs = []
+    if recorded is not None:
+        tv.write('recording outputs of %d cells to "%s" ... ' % (
+            len(recorded), golden_file(ipynb)))
+        try:
+            save_golden(golden_file(ipynb), ws.cells, recorded)
+        except (IOError, OSError) as e:
+            tv.writeln(tv.red('failed: %s' % str(e)))
+        else:
+            tv.writeln('ok')
 
-    for output in cell_outputs:
-        for tt_class in output_types:
-            tt = registered_output_types[tt_class](output)
-            if tt:
-                outs.append(tt)
+    tv.fold_close('ipynb')
 
-    return outs
 
+def create_console(args, stream=None):
+    """create a console for a notebook run using the command line options"""
+    tv = IPyTestConsole(stream)
 
-# ==============================================================================
-#  MAIN
-# ==============================================================================
+    if args.strict:
+        tv.default_results['diff'] = False
 
-if __name__ == '__main__':
-    total_start_time = time.time()
+    if args.no_timeout:
+        tv.default_results['timeout'] = True
+
+    return tv
+
+
+# the kernel pool of a worker process, see `init_worker`
+worker_kernel_pool = None
+
+
+def init_worker(args):
+    """prepare a worker process and start its kernel pool if requested
+
+    With several `--kernels` a worker runs notebooks in all of them, so it
+    starts no pool.
+    """
+    global worker_kernel_pool
+
+    if args.kernel_pool > 0 and len(get_kernel_names(args)) == 1:
+        worker_kernel_pool = create_kernel_pool(args)
+        Finalize(None, worker_kernel_pool.shutdown, exitpriority=10)
+
+
+def check_notebook(ipynb, args, output_types, tv, kernel_pool=None,
+                   session=None):
+    """run a notebook and return its results
+
+    Unlike `run_notebook` errors of the test setup itself (e.g. an
+    unreadable notebook) are reported to `tv` and fail this notebook only.
+
+    Parameters
+    ----------
+    ipynb : string
+        path to the notebook to be tested
+    args : argparse.Namespace
+        the parsed command line options
+    output_types : list of string
+        the identifiers of the output types to be compared
+    tv : IPyTestConsole
+        the console that receives all output and counts the results
+    kernel_pool : IPyKernelPool or None (default)
+        if not None the kernels are taken from this pool
+    session : NotebookSession or None (default)
+        if not None only the changed cells are run in the kernel of the
+        session, see `run_notebook`
+
+    Returns
+    -------
+    dict
+        the notebook path, the `kernel` name, whether the results were
+        `cached`, `pass_count`, `fail_count`, `result_count`, the
+        `start_time` and `run_time` in seconds, the `cells` as list of
+        (index, name, result, passed) and the `cell_timings` and
+        `phase_times` collected by `tv`
+    """
+    start_time = time.time()
+
+    try:
+        run_notebook(ipynb, args, output_types, tv, kernel_pool, session)
+    except Exception as e:
+        tv.br()
+        tv.writeln(tv.red('>>> could not test notebook "%s": %s' % (
+            ipynb, repr(e))))
+        tv.fail_count += 1
+
+    return {
+        'file': ipynb,
+        'kernel': get_kernel_name(args),
+        'cached': tv.cached,
+        'pass_count': tv.pass_count,
+        'fail_count': tv.fail_count,
+        'result_count': tv.result_count,
+        'start_time': start_time,
+        'run_time': time.time() - start_time,
+        'cells': [
+            (index, name, result, passed)
+            for (index, name), result, passed in tv.cell_results],
+        'cell_timings': tv.cell_timings,
+        'phase_times': tv.phase_times
+    }
+
+
+def run_notebook_job(job):
+    """test a single notebook in a worker process
+
+    All console output is collected and returned together with the result
+    counts so the parent process can print it in one piece and merge the
+    results of all notebooks.
+
+    Parameters
+    ----------
+    job : tuple of (string, argparse.Namespace, list of string)
+        the notebook path, the parsed command line options and the output
+        types to be compared
+
+    Returns
+    -------
+    dict
+        the results as returned by `check_notebook` and the collected
+        console `output`
+    """
+    ipynb, args, output_types = job
+
+    stream = StringIO()
+    tv = create_console(args, stream)
+
+    kernel_pool = worker_kernel_pool
+    if kernel_pool is not None and not kernel_pool.matches(
+            get_extra_arguments(args), get_warmup_code(args),
+            get_kernel_name(args)):
+        kernel_pool = None
+
+    result = check_notebook(ipynb, args, output_types, tv, kernel_pool)
+    result['output'] = stream.getvalue()
+
+    return result
+
+
+def write_summary(tv, results, run_time):
+    """write the combined results of several notebooks
+
+    Parameters
+    ----------
+    tv : IPyTestConsole
+        the console to write to
+    results : list of dict
+        the results as returned by `run_notebook_job`
+    run_time : float
+        the total time of all runs in seconds
+    """
+    tv.br()
+    tv.writeln("  notebook results (%5.3f seconds)" % run_time)
+    tv.writeln("  ================================")
+    for result in results:
+        if result['fail_count'] > 0:
+            status = tv.red('fail')
+        else:
+            status = tv.green('ok  ')
+
+        name = result['file']
+        if result.get('kernel') is not None:
+            name += ' [%s]' % result['kernel']
+
+        tv.writeln("    %s %s (%d passed, %d failed, %5.3f seconds)" % (
+            status, name, result['pass_count'],
+            result['fail_count'], result['run_time']))
+
+    tv.br()
+    tv.writeln("    %3i cells passed [" %
+               sum(r['pass_count'] for r in results) + tv.green('ok') + "]")
+    tv.writeln("    %3i cells failed [" %
+               sum(r['fail_count'] for r in results) + tv.red('fail') + "]")
+    tv.br()
+
+
+def write_matrix(tv, results, kernel_names):
+    """write the result of each cell in each kernel of `--kernels`
+
+    Cells whose result is not the same in all kernels are marked with `*`.
+
+    Parameters
+    ----------
+    tv : IPyTestConsole
+        the console to write to
+    results : list of dict
+        the results as returned by `check_notebook`
+    kernel_names : list of string
+        the kernels in the order of the columns
+    """
+    runs = OrderedDict()
+    for result in results:
+        runs.setdefault(result['file'], {})[result['kernel']] = result
+
+    width = max([10] + [len(name) for name in kernel_names])
+
+    tv.br()
+    tv.writeln("  kernel matrix")
+    tv.writeln("  ================================")
+
+    for ipynb, by_kernel in runs.items():
+        verdicts = {}
+        for kernel_name, result in by_kernel.items():
+            for index, name, cell_result, passed in result['cells']:
+                verdicts.setdefault((index, name), {})[kernel_name] = (
+                    cell_result, passed)
+
+        tv.writeln("    %s" % ipynb)
+        tv.writeln("      %-10s %-8s %s" % ('cell', 'name', ' '.join(
+            '%-*s' % (width, kernel_name) for kernel_name in kernel_names)))
+
+        for (index, name), cell in sorted(verdicts.items()):
+            columns = []
+            for kernel_name in kernel_names:
+                if kernel_name not in cell:
+                    columns.append('%-*s' % (width, '---'))
+                    continue
+
+                cell_result, passed = cell[kernel_name]
+                text = '%-*s' % (width, '%s %s' % (
+                    'ok' if passed else 'fail', cell_result))
+                columns.append(tv.green(text) if passed else tv.red(text))
+
+            same = len(set(cell.values())) == 1 and \
+                len(cell) == len(kernel_names)
+
+            tv.writeln("    %s %-10s %-8s %s" % (
+                ' ' if same else '*', 'Cell %d' % index, name,
+                ' '.join(columns)))
+
+    tv.br()
+
+
+def write_profile(tv, results, n_cells=10):
+    """write the time spent in each phase and the slowest cells
+
+    Parameters
+    ----------
+    tv : IPyTestConsole
+        the console to write to
+    results : list of dict
+        the results as returned by `check_notebook`
+    n_cells : int, default 10
+        the number of slowest cells to show
+    """
+    phase_times = {}
+    for result in results:
+        for phase, seconds in result['phase_times'].items():
+            phase_times[phase] = phase_times.get(phase, 0.0) + seconds
+
+    tv.br()
+    tv.writeln("  profile")
+    tv.writeln("  ================================")
+    for phase, seconds in sorted(
+            phase_times.items(), key=lambda item: -item[1]):
+        tv.writeln("    %-12s %9.3f seconds" % (phase, seconds))
+
+    timings = [t for result in results for t in result['cell_timings']]
+    timings.sort(key=lambda t: -t['wall'])
+
+    tv.br()
+    tv.writeln("  %d slowest cells" % min(n_cells, len(timings)))
+    tv.writeln("  ================================")
+    tv.writeln("    %8s %8s %8s %8s %6s %10s %6s %6s  %s" % (
+        'wall', 'wait', 'busy', 'compare', 'msgs', 'bytes', 'queued',
+        'drops', 'cell'))
+    for t in timings[:n_cells]:
+        tv.writeln("    %8.3f %8.3f %8.3f %8.3f %6d %10d %6d %6d  %s.%s" % (
+            t['wall'], t['wait'], t['busy'], t['compare'], t['messages'],
+            t['bytes'], t.get('queued', 0), t.get('dropped', 0),
+            os.path.basename(t['file']), t['cell']))
+    tv.br()
+
+
+def write_profile_dump(path, results, run_time):
+    """write the timing of all cells and phases as json
+
+    Parameters
+    ----------
+    path : string
+        the file to write to
+    results : list of dict
+        the results as returned by `check_notebook`
+    run_time : float
+        the total time of all runs in seconds
+    """
+    profile = {
+        'run_time': run_time,
+        'notebooks': [{
+            'file': result['file'],
+            'run_time': result['run_time'],
+            'phase_times': result['phase_times'],
+            'cells': result['cell_timings']
+        } for result in results]
+    }
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(u'%s' % json.dumps(profile, indent=1, sort_keys=True))
+
+
+# the socket of `--serve` if none is given. Same as in `ipynbtest_client.py`
+default_socket = os.path.join(
+    tempfile.gettempdir(), 'ipynbtest-%s.sock' % getpass.getuser())
+
+
+def get_parser():
+    """create the parser for the command line options"""
     parser = argparse.ArgumentParser(
         description='Run all cells in an ipython notebook as a test and ' +
                     'check whether these successfully execute and ' +
                     'compares their output to the one inside the notebook. \n\n'
                     'A word of caution when using it to test for Python 2 / 3. '
-                    'The code here is tested for Python 2.7 / 3.4 / 3.5. When '
-                    'you want to test a specific version for your notebook '
-                    'you need to make sure that you are the same python '
-                    'version as you want tested for the notebook. This test '
-                    'cannot invoke another python version or use an existing '
-                    'environment. Notebooks are rarely written  Py 2/3 '
-                    'compatible though.')
+                    'The code here is tested for Python 2.7 / 3.4 / 3.5. '
+                    'Notebooks are run in the default kernel unless other '
+                    'installed kernels are given with `--kernels`, e.g. one '
+                    'for each python version or environment. Notebooks are '
+                    'rarely written Py 2/3 compatible though.')
 
     parser.add_argument(
-        'file',
-        metavar='file.ipynb',
-        help='the notebook to be checked',
+        'files',
+        metavar='file.ipynb', nargs='*',
+        help='the notebooks to be checked. Directories are searched for '
+             'notebooks and glob patterns like `examples/*.ipynb` are '
+             'expanded',
         type=str)
 
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs',
+        type=int, default=1,
+        help='the number of notebooks tested in parallel. Each notebook is '
+             'run in its own kernel in a separate process. Default is 1')
+
+    parser.add_argument(
+        '--shard', dest='shard',
+        type=parse_shard, default=None,
+        help='only test the i-th of N parts of the notebooks, e.g. `2/4`. '
+             'The notebooks are split so that all parts take about the same '
+             'time using the durations of earlier runs (see `--timings`) or '
+             'the file size of new notebooks')
+
+    parser.add_argument(
+        '--timings', dest='timings',
+        type=str, default='',
+        help='the json file that records the duration of each notebook for '
+             '`--shard`. It is updated after each run without `--shard` and '
+             'by `--merge`, not with `--no-cache` unless this is given. '
+             'Default is `timings.json` in the cache dir')
+
+    parser.add_argument(
+        '--result-file', dest='result_file',
+        type=str, default='',
+        help='a json file to write the results of all notebooks to, e.g. '
+             'one for each shard')
+
+    parser.add_argument(
+        '--merge', dest='merge',
+        action='store_true',
+        default=False,
+        help='if set then the files are result files written with '
+             '`--result-file` and their combined results are reported '
+             'instead of testing notebooks')
+
+    parser.add_argument(
+        '--watch', dest='watch',
+        type=float, default=None, nargs='?', const=1.0,
+        help='if set then the notebooks are tested again whenever they are '
+             'saved, checking every given number of seconds (default 1). '
+             'Each notebook keeps its kernel and only the first changed '
+             'code cell and the cells after it are run')
+
+    parser.add_argument(
+        '--cells', dest='cells',
+        type=parse_cells, default=None,
+        help='only run these cells and the cells they depend on, e.g. '
+             '`3,5-7`. Cells are given by their index in the notebook '
+             'counting from 0 like `Cell 3` of the pytest plugin. The '
+             'dependencies are found from the names each cell defines and '
+             'uses, see `#! uses` and `#! defines`')
+
+    parser.add_argument(
+        '--changed-since', dest='changed_since',
+        type=str, default=None,
+        help='only run the cells that changed since this git revision, '
+             'e.g. `HEAD` or `main`, and the cells they depend on. All cells '
+             'of a notebook that is not part of the revision are run')
+
+    parser.add_argument(
+        '--record', dest='record',
+        action='store_true', default=False,
+        help='store the outputs of all cells that run without error in '
+             '`NOTEBOOK.golden.json.gz` next to each notebook. Only the '
+             'tested mime types are stored, keyed by a hash of the cell '
+             'source. Results are not cached')
+
+    parser.add_argument(
+        '--golden', dest='golden',
+        action='store_true', default=False,
+        help='compare with the outputs stored by `--record` instead of the '
+             'outputs in the notebook, which are not loaded. Cells without '
+             'stored outputs are expected to have no output')
+
+    parser.add_argument(
+        '--kernels', dest='kernels',
+        type=parse_kernels, default=None,
+        help='run each notebook in each of these kernels at the same time, '
+             'e.g. `python2,python3`. The kernels are given by the name of '
+             'their kernelspec, see `jupyter kernelspec list`, and the '
+             'result of each cell in each kernel is shown as a matrix. '
+             'Default is the default kernel')
+
+    parser.add_argument(
+        '--serve', dest='serve',
+        type=str, default=None, nargs='?', const=default_socket,
+        help='run as a server on this unix socket and test the notebooks '
+             'sent by `ipynbtest_client.py` with the same options as '
+             '`ipynbtest.py`. Imports and a kernel pool (`--kernel-pool`, '
+             'at least 1) are kept warm between jobs. Default socket is '
+             '`ipynbtest-USER.sock` in the temp directory')
+
+    parser.add_argument(
+        '--kernel-pool', dest='kernel_pool',
+        type=int, default=0,
+        help='the number of kernels that are started ahead of time and kept '
+             'ready for the next notebook or restart. With `--jobs` each '
+             'job has its own pool. Default is 0 (start kernels when needed)')
+
+    parser.add_argument(
+        '--warmup', dest='warmup',
+        type=str, default='',
+        help='a python file that is run in every kernel after starting it, '
+             'e.g. to import heavy packages. Together with `--kernel-pool` '
+             'this happens before the kernel is needed')
+
+    parser.add_argument(
+        '--no-cache', dest='no_cache',
+        action='store_true',
+        default=False,
+        help='if set then all cells are run even if the notebook, its '
+             'outputs and the options did not change since all cells passed '
+             'the last time. Changes to the environment and to data files '
+             'are only detected through `--cache-fingerprint`. The timing '
+             'history is not updated unless `--timings` is given')
+
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir',
+        type=str, default='.ipynbtest_cache',
+        help='the directory to store the results of passed cells. Default '
+             'is `.ipynbtest_cache`')
+
+    parser.add_argument(
+        '--cache-size', dest='cache_size',
+        type=int, default=50,
+        help='the maximal size of the cache in MB. Least recently used '
+             'results are removed first. Default is 50')
+
+    parser.add_argument(
+        '--cache-fingerprint', dest='cache_fingerprint',
+        type=str, default='',
+        help='a string that describes the environment, e.g. a hash of the '
+             'installed packages. Cached results are only used for the same '
+             'fingerprint')
+
     parser.add_argument(
         '-t', '--timeout', dest='timeout',
         type=int, default=300,
@@ -862,6 +5562,29 @@ if __name__ == '__main__':
              'However, a test cell that takes this long should be split in ' +
              'more than one or simplified.')
 
+    parser.add_argument(
+        '--timeout-factor', dest='timeout_factor',
+        type=float, default=5.0,
+        help='the timeout of a cell that ran before is the 95th percentile of '
+             'its recorded durations times this factor, but at least '
+             '`--min-timeout` and at most `--timeout`. `#! timeout` is '
+             'always used. The durations are kept in `timings.cells.json` '
+             'next to `--timings`. Use 0 to always use `--timeout`. '
+             'Default is 5')
+
+    parser.add_argument(
+        '--min-timeout', dest='min_timeout',
+        type=float, default=10.0,
+        help='the smallest timeout of a cell derived from its recorded '
+             'durations, see `--timeout-factor`. Default is 10s')
+
+    parser.add_argument(
+        '--interrupt-timeout', dest='interrupt_timeout',
+        type=float, default=10.0,
+        help='a cell that timed out is interrupted. If it did not stop after '
+             'this many seconds the kernel is restarted and the cells before '
+             'it are run again. Default is 10s')
+
     parser.add_argument(
         '--rerun-if-timeout', dest='rerun',
         type=int, default=2, nargs='?',
@@ -909,6 +5632,48 @@ if __name__ == '__main__':
              'test/plain exeution results. No images will be tested.'
         )
 
+    parser.add_argument(
+        '--rtol', dest='rtol',
+        type=float, default=NumericOutput.rtol,
+        help='the relative tolerance for numbers in outputs compared with '
+             'the `numeric` types, e.g. `--tested-types numeric`. Default '
+             'is %g' % NumericOutput.rtol)
+
+    parser.add_argument(
+        '--atol', dest='atol',
+        type=float, default=NumericOutput.atol,
+        help='the absolute tolerance for numbers in outputs compared with '
+             'the `numeric` types. Default is %g' % NumericOutput.atol)
+
+    parser.add_argument(
+        '--image-threshold', dest='image_threshold',
+        type=int, default=PixelPNGOutput.threshold,
+        help='pixels of images compared with the `pixel` types count as '
+             'different if a color channel differs by more than this value '
+             '(0-255). Default is %d' % PixelPNGOutput.threshold)
+
+    parser.add_argument(
+        '--image-tolerance', dest='image_tolerance',
+        type=float, default=PixelPNGOutput.tolerance,
+        help='the fraction of pixels that may differ for images compared '
+             'with the `pixel` types. Default is %g' %
+             PixelPNGOutput.tolerance)
+
+    parser.add_argument(
+        '--image-size', dest='image_size',
+        type=int, default=PixelPNGOutput.size,
+        help='images compared with the `pixel` types are scaled down to '
+             'this size in pixels before comparing. Use 0 to compare at full '
+             'size. Default is %d' % PixelPNGOutput.size)
+
+    parser.add_argument(
+        '--stream-max-size', dest='stream_max_size',
+        type=int, default=16,
+        help='the maximal size in MB (million characters) kept of the '
+             'stdout and stderr of a cell. Output beyond that is only '
+             'compared by its length and hash. Use 0 to keep all output. '
+             'Default is 16')
+
     parser.add_argument(
         '--pass-if-timeout',
         dest='no_timeout', action='store_true',
@@ -924,6 +5689,32 @@ if __name__ == '__main__':
         help='if set to true differences in the cell are shown ' +
              'in `diff` style')
 
+    parser.add_argument(
+        '--diff-context', dest='diff_context',
+        type=int, default=3,
+        help='the number of unchanged lines shown around each change with '
+             '`--show-diff`. Default is 3')
+
+    parser.add_argument(
+        '--diff-max-lines', dest='diff_max_lines',
+        type=int, default=500,
+        help='the maximal number of lines shown for each diff with '
+             '`--show-diff`. Default is 500')
+
+    parser.add_argument(
+        '--profile', dest='profile',
+        action='store_true',
+        default=False,
+        help='if set then the time spent in each phase (kernel startup, '
+             'waiting, execution, transport, comparison and output) and the '
+             'slowest cells are shown at the end')
+
+    parser.add_argument(
+        '--profile-dump', dest='profile_dump',
+        type=str, default='',
+        help='a json file to write the timing, the number of messages and '
+             'their size for every executed cell to')
+
     parser.add_argument(
         '--abort-if-fail',
         dest='abort_fail', action='store_true',
@@ -949,354 +5740,411 @@ if __name__ == '__main__':
         help='if set then text output is send to the ' +
              'console.')
 
-    args = parser.parse_args()
-    ipynb = args.file
-    verbose = args.verbose
+    return parser
 
-    tv = IPyTestConsole()
 
-    if args.strict:
-        tv.default_results['diff'] = False
+# ==============================================================================
+#  MAIN
+# ==============================================================================
 
-    if args.no_timeout:
-        tv.default_results['timeout'] = True
+def get_timings_file(args):
+    """the path of the timing history from the command line options"""
+    if args.timings:
+        return args.timings
 
-    tv.fold_open('ipynb')
-    tv.writeln('testing ipython notebook : "%s"' % ipynb)
+    return os.path.join(args.cache_dir, 'timings.json')
 
-    timeout_rerun = args.rerun
-    fail_restart = args.restart
 
-    extra_arguments = args.extra_arguments.split(";")
+def get_cell_timings_file(args):
+    """the path of the cell timing history next to the timing history"""
+    return os.path.splitext(get_timings_file(args))[0] + '.cells.json'
 
-    if args.pylab:
-        extra_arguments = ['--pylab=inline'] + extra_arguments
 
-    used_output_filter = [t_name.strip() for t_name in args.ttypes.split(',')]
-    used_output_types = filter(
-        lambda x: any(f in x for f in used_output_filter),
-        registered_output_types)
+def keeps_timings(args):
+    """True if the timing histories are updated after a run
 
-    if verbose:
-        tv.write(tv.blue('>>> using the following content types to compare\n'))
-        for tt in used_output_types:
-            tv.write(tt + '\n', indent=4)
-    with open(ipynb, encoding='utf-8') as f:
-        nb = nbformat.reads(f.read(), 4)
-        # Convert all notebooks to the format IPython 3.0.0 uses to
-        # simplify comparison
-        nb = nbformat.convert(nb, 4)
+    Like the result cache they are not written with `--no-cache`, unless
+    `--timings` is given.
+    """
+    return bool(args.timings) or not args.no_cache
 
-    notebook_restart = True
-    notebook_run_count = 0
 
-    while notebook_restart:
-        notebook_restart = False
-        notebook_run_count += 1
+def merge(args):
+    """report the combined results of the result files of several shards"""
+    tv = create_console(args)
 
-        tv.reset()
-        tv.write("starting kernel ... ")
-        with IPyKernel(extra_arguments=extra_arguments) as ipy:
-            ipy.default_timeout = args.timeout
-            tv.writeln("ok")
+    results, run_time = merge_result_files(args.files)
+    if keeps_timings(args):
+        save_timings(get_timings_file(args), results)
+        save_cell_timings(get_cell_timings_file(args), results)
 
-            nbs = ipynb.split('/')[-1].split('.')
+    write_summary(tv, results, run_time)
 
-            nb_class_name = nbs[1] + '.' + nbs[0].replace(" ", "_")
+    if args.profile:
+        write_profile(tv, results)
 
-            tv.br()
+    if args.result_file:
+        write_result_file(args.result_file, results, run_time)
 
-            if hasattr(nb, 'worksheets'):
-                ws = nb.worksheets[0]
-            else:
-                ws = nb
+    if any(result['fail_count'] != 0 for result in results):
+        tv.writeln(tv.red('some tests not passed.'))
+        sys.exit(1)
+    else:
+        tv.writeln(tv.green('all tests passed.'))
+        sys.exit(0)
 
-            if args.eval:
-                ipy.execute(args.eval)
 
-            for cell in ws.cells:
-                if notebook_restart:
-                    # if we restart anyway skip all remaining cells
-                    continue
+def file_state(path):
+    """the modification time and size of a file or None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
 
-                if cell.cell_type == 'markdown':
-                    for line in cell.source.splitlines():
-                        # only tv.writeln(headlines in markdown
-                        if line.startswith('#') and line[1] != '!':
-                            tv.writeln(line)
+    return stat.st_mtime, stat.st_size
 
-                # if cell.cell_type == 'heading':
-                #     tv.writeln('#' * cell.level + ' ' + cell.source)
 
-                if cell.cell_type == 'raw':
-                    # handle RAW cells
-                    continue
+def watch(args, output_types):
+    """test the notebooks again whenever they are saved until stopped
 
-                if cell.cell_type != 'code':
-                    continue
+    The notebooks are polled every `--watch` seconds. New notebooks matching
+    the command line are tested as well. A notebook is tested once its file
+    did not change for one interval, so it is not read while being written.
+    Each notebook keeps its kernel between runs, see `NotebookSession`.
+    """
+    tv = create_console(args)
+    sessions = {}
+    tested = {}
+    pending = {}
 
-                # if code cell then continue
+    tv.writeln('watching for changes every %g seconds, stop with Ctrl-C' % (
+        args.watch))
 
-                if ipy.is_empty_cell(cell):
-                    # empty cell will not be tested
+    try:
+        while True:
+            notebooks, _ = find_notebooks(args.files)
+
+            for ipynb in notebooks:
+                state = file_state(ipynb)
+                if state is None or state == tested.get(ipynb):
                     continue
 
-                # if hasattr(cell, 'prompt_number'):
-                #     tv.write(nb_class_name + '.' + 'In [%3i]' %
-                #              cell.prompt_number + ' ... ')
-                if hasattr(cell, 'execution_count') and \
-                        cell.execution_count is not None:
-                    tv.write(nb_class_name + '.' + 'In [%3i]' %
-                             cell.execution_count + ' ... ')
-                else:
-                    tv.write(nb_class_name + '.' + 'In [---]' + ' ... ')
+                if ipynb in tested and state != pending.get(ipynb):
+                    # wait until the file did not change for one interval
+                    pending[ipynb] = state
+                    continue
 
-                nb_cell_commands = ipy.get_commands(cell)
+                tested[ipynb] = state
+                session = sessions.setdefault(ipynb, NotebookSession())
 
-                result = 'success'
+                result = check_notebook(
+                    ipynb, args, output_types, create_console(args),
+                    session=session)
 
-                timeout = ipy.default_timeout
+                if result['fail_count'] != 0:
+                    tv.writeln(tv.red('some tests not passed.'))
+                elif result['pass_count'] != 0:
+                    tv.writeln(tv.green('all tests passed.'))
 
-                if 'skip' in nb_cell_commands:
-                    tv.write_result('skip')
-                    continue
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for session in sessions.values():
+            session.stop()
 
-                cell_run_count = 0
-                cell_run_again = True
-                cell_passed = True
+    sys.exit(0)
 
-                ex_cell_outputs = []
 
-                while cell_run_again:
-                    cell_run_count += 1
-                    cell_run_again = False
-                    cell_passed = True
+class JobStream(object):
+    """
+    A file like object that sends everything written to a client of `serve`
 
-                    try:
-                        if 'timeout' in nb_cell_commands:
-                            ex_cell_outputs = ipy.run(
-                                cell,
-                                use_timeout=int(nb_cell_commands['timeout']))
-                        else:
-                            ex_cell_outputs = ipy.run(cell)
+    Each write is sent as a json line `{name: text}`, where name is `out` or
+    `err` for text that goes to stdout or stderr of the client.
+    """
 
-                    except Exception as e:
-                        # we got a jupyter problem to execute something
-                        # in the kernel at all. Not that the execution raised
-                        # an error
-                        # Might still be that the cell did not execute
-                        # or timeout
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
 
-                        if 'ignore' not in nb_cell_commands:
-                            cell_passed = False
-                            if repr(e) == 'Empty()':
-                                # Assume it has been timed out!
-                                if cell_run_count <= timeout_rerun:
-                                    cell_run_again = True
-                                    tv.write('timeout [retry #%d] ' % cell_run_count)
-                                else:
-                                    if 'pass-if-timeout' in nb_cell_commands:
-                                        tv.write_result('timeout', okay_list={'timeout': True})
-                                    elif 'fail-if-timeout' in nb_cell_commands:
-                                        tv.write_result('timeout', okay_list={'timeout': False})
-                                    else:
-                                        tv.write_result('timeout')
+    def write(self, s):
+        self.conn.sendall(
+            (json.dumps({self.name: s}) + '\n').encode('utf-8'))
 
-                                        ipy.clear()
+    def flush(self):
+        pass
 
-                            else:
-                                tv.write_result('kernel')
-                                tv.fold_open('ipynb.kernel')
-                                tv.writeln('>>> ' + e[0] + ' ("' + e[1] + '")')
-                                tv.writeln(repr(e[2]), indent=4)
-                                tv.fold_close('ipynb.kernel')
-                        else:
-                            if repr(e) == 'Empty()':
-                                # Assume it has been timed out!
-                                tv.write('timeout / ')
-                                tv.write_result('ignore')
-                            else:
-                                tv.write('kernel / ')
-                                tv.write_result('ignore')
-                                tv.fold_open('ipynb.kernel')
-                                tv.writeln('>>> ' + e[0] + ' ("' + e[1] + '")')
-                                tv.writeln(repr(e[2]), indent=4)
-                                tv.fold_close('ipynb.kernel')
 
-                if not cell_passed:
-                    if tv.last_fail and notebook_run_count <= fail_restart:
-                        notebook_restart = True
+def serve_job(conn, kernel_pool):
+    """run `main` for the request of a client and send it the output
 
-                    if args.abort_fail:
-                        break
-                    else:
-                        continue
+    The request is a json line with the command line `argv` and the working
+    directory `cwd` of the client. Everything written to stdout and stderr
+    during the job is sent to the client, followed by `{"exit": status}`.
 
-                failed = False
-                diff = False
-                diff_str = ''
-                out_str = ''
+    Parameters
+    ----------
+    conn : socket.socket
+        the connection to the client
+    kernel_pool : IPyKernelPool
+        the kernels of the server
+    """
+    request = json.loads(conn.makefile('rb').readline().decode('utf-8'))
 
-                # Check first, if we have an error output
+    stdout, stderr, cwd = sys.stdout, sys.stderr, os.getcwd()
+    status = 0
 
-                for out in ex_cell_outputs:
-                    if out.output_type == 'error':
-                        # An error occurred. Cell is not completed correctly
-                        if 'ignore' not in nb_cell_commands:
-                            tv.write_result('error')
-                        else:
-                            tv.write('error / ')
-                            tv.write_result('ignore')
+    try:
+        sys.stdout = JobStream(conn, 'out')
+        sys.stderr = JobStream(conn, 'err')
+        os.chdir(request['cwd'])
 
-                        tv.fold_open('ipynb.error')
-                        tv.writeln('>>> ' + out.ename + ' ("' + out.evalue + '")')
+        main(request['argv'], kernel_pool)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            sys.stderr.write('%s\n' % e.code)
+            status = 1
+    except Exception:
+        sys.stderr.write(traceback.format_exc())
+        status = 1
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        os.chdir(cwd)
 
-                        for idx, trace in enumerate(out.traceback[1:]):
-                            tv.writeln(trace, indent=4)
+    conn.sendall((json.dumps({'exit': status}) + '\n').encode('utf-8'))
 
-                        tv.fold_close('ipynb.error')
-                        failed = True
 
-                # if there has been no `error` so far run the comparison
+def serve(args):
+    """test the notebooks sent by clients on a unix socket until stopped
 
-                # this will first filter cells we want to compare at all
-                # and then run the comparison on these
+    Jobs are run one at a time in this process, so imports and the kernels
+    of the pool stay warm. Stop the server with Ctrl-C or SIGTERM.
+    """
+    tv = create_console(args)
+    path = args.serve
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except socket.error:
+            # left behind by a server that did not shut down
+            os.remove(path)
+        else:
+            probe.close()
+            tv.writeln(tv.red('a server is running on "%s" already' % path))
+            sys.exit(1)
 
-                # we will create a sorted list of all relevant contenttypes
+    args.kernel_pool = max(1, args.kernel_pool)
+    kernel_pool = create_kernel_pool(args)
 
-                ex_cell_outs = get_outs(ex_cell_outputs, used_output_types)
-                nb_cell_outs = get_outs(cell.outputs, used_output_types)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
 
-                out_str = ''
-                err_str = ''
+    # SIGTERM should remove the socket and stop the kernels as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-                if verbose or 'verbose' in nb_cell_commands:
-                    text_cells = get_outs(
-                        ex_cell_outputs,
-                        ['stream.stdout.text/plain', 'execute_result.data.text/plain'])
-                    for text_cell in text_cells:
-                        out_str += text_cell.text.strip() + '\n'
+    tv.writeln('serving on "%s" with %d warm kernel(s)' % (
+        path, args.kernel_pool))
 
-                    text_cells = get_outs(
-                        ex_cell_outputs,
-                        ['stream.stderr.text/plain'])
-                    for text_cell in text_cells:
-                        err_str += text_cell.text.strip() + '\n'
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                serve_job(conn, kernel_pool)
+            except Exception as e:
+                # e.g. the client disconnected during the job
+                tv.writeln(tv.red('>>> job failed: %s' % repr(e)))
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+        kernel_pool.shutdown()
+        tv.writeln('server stopped')
+
+    sys.exit(0)
+
+
+def main(argv=None, kernel_pool=None):
+    """test the notebooks given by the command line options and exit
+
+    Parameters
+    ----------
+    argv : list of string or None (default)
+        the command line options. If None the options of this process are
+        used
+    kernel_pool : IPyKernelPool or None (default)
+        the kernels of a server running this job. They are used if they were
+        started with the same `--extra-arguments` and `--warmup`
+    """
+    total_start_time = time.time()
+    parser = get_parser()
+    args = parser.parse_args(argv)
 
-                if not failed:
-                    if len(ex_cell_outs) != len(nb_cell_outs):
-                        diff_str += tv.blue(">>> diff in number of relevant content parts %d vs %d\n") % (
-                            len(ex_cell_outputs), len(cell.outputs))
+    if args.serve is not None:
+        if kernel_pool is not None:
+            parser.error('--serve cannot be used by a client')
 
-                        if len(ex_cell_outs) > len(nb_cell_outs):
-                            nb_cell_outs += ['---'] * (len(ex_cell_outs) - len(nb_cell_outs))
-                        else:
-                            ex_cell_outs += ['---'] * (len(nb_cell_outs) - len(ex_cell_outs))
+        if not hasattr(socket, 'AF_UNIX'):
+            parser.error('--serve needs unix sockets')
 
-                        for orig, test in zip(nb_cell_outs, ex_cell_outs):
-                            diff_str += tv.green("    %36s ") % str(orig)
-                            diff_str += ' | ' + tv.red("%s\n") % str(test)
+        if len(get_kernel_names(args)) > 1:
+            parser.error('--serve starts kernels of one kernelspec')
 
-                        diff = True
-                    else:
-                        for o1, o2 in zip(nb_cell_outs, ex_cell_outs):
-                            if o1 != o2:
-                                # Output is different
-                                err_message = o2.compare_str(o1)
-                                diff_str += tv.format_diff(err_message)
-                                diff = True
+        serve(args)
 
-                if diff and not failed:
-                    if 'ignore' not in nb_cell_commands:
-                        if 'strict' in nb_cell_commands:
-                            # strict mode means a difference will fail the test
-                            tv.write_result('diff', okay_list={'diff': False})
-                        elif 'lazy' in nb_cell_commands:
-                            # lazy mode means a difference will pass the test
-                            tv.write_result('diff', okay_list={'diff': True})
-                        else:
-                            # use defaults
-                            tv.write_result('diff')
-                    else:
-                        tv.write('diff / ')
-                        tv.write_result('ignore')
+    if not args.files:
+        parser.error('no notebooks given')
 
-                    if args.show_diff:
-                        tv.fold_open('ipynb.diff')
-                        tv.writeln(diff_str)
-                        tv.fold_close('ipynb.diff')
+    if args.merge:
+        merge(args)
 
-                if not failed and not diff:
-                    tv.write_result('success')
+    notebooks, unmatched = find_notebooks(args.files)
+    if unmatched:
+        parser.error('no notebook found for "%s"' % '", "'.join(unmatched))
 
-                if tv.last_fail and notebook_run_count <= fail_restart:
-                    # we had a fail so restart the whole notebook
-                    notebook_restart = True
+    if args.shard is not None:
+        index, count = args.shard
+        durations = estimate_durations(
+            notebooks, load_timings(get_timings_file(args)))
+        notebooks = split_shards(notebooks, durations, count)[index - 1]
 
-                if out_str != '' and 'quiet' not in nb_cell_commands:
-                    n_lines = len(out_str.strip().split('\n'))
-                    tv.write(tv.blue(">>> stdout / result text [%d line(s)]\n" % n_lines))
-                    tv.fold_open('ipynb.out')
-                    tv.writeln(out_str, indent=4)
-                    tv.fold_close('ipynb.out')
+    if args.jobs < 1:
+        parser.error('the number of jobs needs to be at least 1')
 
-                if err_str != '' and 'quiet' not in nb_cell_commands:
-                    n_lines = len(err_str.strip().split('\n'))
-                    tv.write(tv.red(">>> stderr / result text [%d line(s)]\n" % n_lines))
-                    tv.fold_open('ipynb.out')
-                    tv.writeln(err_str, indent=4)
-                    tv.fold_close('ipynb.out')
+    if args.warmup and not os.path.isfile(args.warmup):
+        parser.error('warm up script "%s" not found' % args.warmup)
 
-                if args.abort_fail and tv.last_fail:
-                    # a fail should stop the tests (but allow retries)
-                    tv.writeln(tv.blue('aborting tests!'))
-                    break
+    kernel_names = get_kernel_names(args)
+    if args.kernels:
+        missing = set(args.kernels) - set(
+            KernelSpecManager().find_kernel_specs())
+        if missing:
+            parser.error('no kernelspec "%s", see `jupyter kernelspec list`' % (
+                '", "'.join(sorted(missing))))
 
-            tv.br()
-            total_run_time = time.time() - total_start_time
-            tv.writeln("  testing results (%5.3f seconds)" % total_run_time)
-            tv.writeln("  ================================")
-            if tv.pass_count > 0:
-                tv.writeln("    %3i cells passed [" %
-                           tv.pass_count + tv.green('ok') + "]")
-            if tv.fail_count > 0:
-                tv.writeln("    %3i cells failed [" %
-                           tv.fail_count + tv.red('fail') + "]")
+    if len(kernel_names) > 1:
+        if args.watch is not None:
+            parser.error('--watch runs notebooks in one kernel')
 
-            tv.br()
-            tv.writeln("  %3i cells successfully replicated [success]" %
-                       tv.result_count['success'])
-            tv.writeln("  %3i cells had mismatched outputs [diff]" %
-                       tv.result_count['diff'])
-            tv.writeln("  %3i cells timed out during execution [time]" %
-                       tv.result_count['timeout'])
-            tv.writeln("  %3i cells ran with python errors [error]" %
-                       tv.result_count['error'])
-            tv.writeln("  %3i cells have been run without comparison [ignore]" %
-                       tv.result_count['ignore'])
-            tv.writeln("  %3i cells failed to even run (IPython error) [kernel]" %
-                       tv.result_count['kernel'])
-            tv.writeln("  %3i cells have been skipped [skip]" %
-                       tv.result_count['skip'])
+        if args.record:
+            # the kernels would record their outputs to the same store
+            parser.error('--record runs notebooks in one kernel')
 
-            if notebook_restart:
-                tv.br()
-                tv.writeln(
-                    tv.red("  attempt #%d of max %d failed, restarting notebook!" % (
-                        notebook_run_count, fail_restart + 1
-                    ))
-                )
+    tv = create_console(args)
 
-            tv.br()
-            tv.write("shutting down kernel ... ")
+    if args.shard is not None:
+        tv.writeln('testing shard %d of %d with %d notebook(s)' % (
+            args.shard + (len(notebooks),)))
 
-        tv.writeln('ok')
+    used_output_filter = [t_name.strip() for t_name in args.ttypes.split(',')]
+    used_output_types = select_output_types(used_output_filter)
 
-    tv.fold_close('ipynb')
+    if args.verbose:
+        tv.write(tv.blue('>>> using the following content types to compare\n'))
+        for tt in used_output_types:
+            tv.write(tt + '\n', indent=4)
 
-    if tv.fail_count != 0:
+    if args.watch is not None:
+        watch(args, used_output_types)
+
+    # each notebook is run in all kernels at the same time
+    jobs = [
+        (ipynb, kernel_args(args, kernel_name), used_output_types)
+        for ipynb in notebooks for kernel_name in kernel_names]
+    results = []
+
+    processes = min(args.jobs * len(kernel_names), len(jobs))
+
+    if processes <= 1:
+        # run in this process and write directly to the console
+        if kernel_pool is not None and not kernel_pool.matches(
+                get_extra_arguments(args), get_warmup_code(args),
+                get_kernel_name(args)):
+            # the kernels of the server were started with other options
+            kernel_pool = None
+
+        own_kernel_pool = kernel_pool is None and args.kernel_pool > 0
+        if own_kernel_pool:
+            kernel_pool = create_kernel_pool(args)
+
+        try:
+            for ipynb, job_args, output_types in jobs:
+                results.append(check_notebook(
+                    ipynb, job_args, output_types, create_console(args),
+                    kernel_pool))
+        finally:
+            if own_kernel_pool:
+                kernel_pool.shutdown()
+    else:
+        pool = multiprocessing.Pool(
+            processes=processes,
+            initializer=init_worker, initargs=(args,))
+        try:
+            # print each notebook as soon as it is done
+            for result in pool.imap_unordered(run_notebook_job, jobs):
+                tv.write(result['output'])
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+
+        results.sort(key=lambda r: (
+            notebooks.index(r['file']), kernel_names.index(r['kernel'])))
+
+        for result in results:
+            # the time a notebook waited for a free worker
+            result['phase_times']['queue'] = \
+                result['start_time'] - total_start_time
+
+    cache = create_result_cache(args)
+    if cache is not None:
+        cache.evict()
+
+    # a run of selected cells does not tell the duration of a notebook
+    selective = args.cells is not None or args.changed_since is not None
+
+    if keeps_timings(args):
+        if args.shard is None and not selective:
+            # all shards need to split the notebooks using the same history,
+            # so shards leave it to `--merge` to record their durations
+            save_timings(get_timings_file(args), results)
+
+        save_cell_timings(
+            get_cell_timings_file(args), results, keep=selective)
+
+    if args.result_file:
+        write_result_file(
+            args.result_file, results, time.time() - total_start_time,
+            args.shard)
+
+    if len(results) > 1:
+        write_summary(tv, results, time.time() - total_start_time)
+
+    if len(kernel_names) > 1:
+        write_matrix(tv, results, kernel_names)
+
+    if args.profile:
+        write_profile(tv, results)
+
+    if args.profile_dump:
+        write_profile_dump(
+            args.profile_dump, results, time.time() - total_start_time)
+
+    if any(result['fail_count'] != 0 for result in results):
         tv.writeln(tv.red('some tests not passed.'))
-        exit(1)
+        sys.exit(1)
     else:
         tv.writeln(tv.green('all tests passed.'))
-        exit(0)
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
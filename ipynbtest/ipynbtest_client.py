@@ -0,0 +1,70 @@
+#! python
+"""
+Test notebooks with a running `ipynbtest.py --serve` server
+
+usage: ipynbtest_client.py [--socket SOCKET] [ipynbtest options] file.ipynb
+
+All options except `--socket` are passed to the server, which tests the
+notebooks like `ipynbtest.py` would with the same options. The output is
+printed while the notebooks are tested and the exit code is the one of
+`ipynbtest.py`. Relative paths are relative to the current directory.
+
+Only the standard library is imported, so the client starts fast. Start the
+server once, e.g. in the background
+
+    ipynbtest.py --serve --kernel-pool 2 &
+    ipynbtest_client.py --strict examples/
+"""
+
+import os
+import sys
+import json
+import socket
+import getpass
+import argparse
+import tempfile
+
+# the socket of `ipynbtest.py --serve` if none is given
+default_socket = os.path.join(
+    tempfile.gettempdir(), 'ipynbtest-%s.sock' % getpass.getuser())
+
+
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '--socket', dest='socket',
+        type=str, default=default_socket)
+
+    # `--help` and all other options are handled by the server
+    args, argv = parser.parse_known_args()
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(args.socket)
+    except socket.error:
+        sys.stderr.write(
+            'no ipynbtest server on "%s", start one with '
+            '`ipynbtest.py --serve %s`\n' % (args.socket, args.socket))
+        sys.exit(2)
+
+    request = {'argv': argv, 'cwd': os.getcwd()}
+    conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    streams = {'out': sys.stdout, 'err': sys.stderr}
+
+    for line in conn.makefile('rb'):
+        message = json.loads(line.decode('utf-8'))
+
+        if 'exit' in message:
+            sys.exit(message['exit'])
+
+        for name, text in message.items():
+            streams[name].write(text)
+            streams[name].flush()
+
+    sys.stderr.write('the ipynbtest server closed the connection\n')
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
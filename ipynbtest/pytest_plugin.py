@@ -0,0 +1,433 @@
+"""
+A pytest plugin to test ipython notebooks like `ipynbtest.py` does
+
+Each notebook is collected as a test file and each of its code cells as a
+test. The cells of a notebook are run in order in one kernel that uses the
+directory of the notebook as working directory. The outputs are compared with
+the output types of ipynbtest and the `#!` commands of a cell are used, e.g.
+`#! skip` skips the test of a cell.
+
+Notebooks are only collected with `--nbtest`. The options of `ipynbtest.py`
+are given with `--nbtest-args`
+
+    pytest --nbtest --nbtest-args="--strict --tested-types numeric" examples
+
+As with `ipynbtest.py` a difference in the output does not fail a cell unless
+`--strict` or `#! strict` is used. It is reported as a `NotebookDiffWarning`.
+
+With pytest-xdist the notebooks are spread across the workers, e.g. `-n 4`.
+The default `--dist load` is changed to `--dist loadfile` so the cells of a
+notebook stay in one worker. If a cell is run without the cells before it,
+e.g. with `--last-failed` or `-k`, the cells before it that it depends on
+are run first without testing them (see `--cells` of `ipynbtest.py`).
+
+With `--nbtest-args=--golden` the cells are compared with the outputs
+recorded by `ipynbtest.py --record`.
+"""
+
+from __future__ import absolute_import
+
+import os
+import re
+import shlex
+import warnings
+
+try:
+    from itertools import izip_longest as zip_longest
+except ImportError:
+    from itertools import zip_longest
+
+import pytest
+
+# `ipynbtest.py` imports jupyter_client, zmq and nbformat. The plugin is
+# loaded by every pytest session, so it is only imported with `--nbtest`, see
+# `pytest_configure`
+ipt = None
+
+
+# pytest 7 passes `pathlib.Path`s and nodes have a `path`
+PATHLIB_NODES = hasattr(pytest, 'version_tuple')
+
+# the color codes of tracebacks from the kernel
+ansi_escape_pattern = re.compile(r'\x1b\[[0-9;]*m')
+
+
+class NotebookDiffWarning(UserWarning):
+    """the output of a cell differs, but this does not fail the test"""
+
+
+class NotebookCellFailure(Exception):
+    """a cell failed, the message is the report of the failure"""
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('ipynbtest', 'testing ipython notebooks')
+
+    group.addoption(
+        '--nbtest', dest='nbtest',
+        action='store_true', default=False,
+        help='collect ipython notebooks (.ipynb) and test their cells with '
+             'ipynbtest')
+
+    group.addoption(
+        '--nbtest-args', dest='nbtest_args',
+        type=str, default='',
+        help='the options of `ipynbtest.py` to test the notebooks with, e.g. '
+             '"--strict --timeout 60". Options that select or report '
+             'notebooks like `--jobs` or `--profile` and `--record` have no '
+             'effect')
+
+
+def get_args(config):
+    """the ipynbtest options from `--nbtest-args`
+
+    Raises
+    ------
+    pytest.UsageError
+        if the options are not valid for `ipynbtest.py`
+    """
+    options = shlex.split(config.getoption('nbtest_args'))
+
+    try:
+        # the parser needs a notebook, the notebooks are collected by pytest
+        return ipt.get_parser().parse_args(options + ['notebook.ipynb'])
+    except SystemExit:
+        raise pytest.UsageError(
+            'invalid --nbtest-args "%s"' % config.getoption('nbtest_args'))
+
+
+def pytest_configure(config):
+    global ipt
+
+    if config.getoption('nbtest'):
+        from . import ipynbtest as ipt
+
+        config.ipynbtest_args = get_args(config)
+
+        if len(ipt.get_kernel_names(config.ipynbtest_args)) > 1:
+            raise pytest.UsageError(
+                'the notebooks are tested in one kernel, use `ipynbtest.py '
+                '--kernels` to test them in several')
+
+        used_output_filter = [
+            t_name.strip()
+            for t_name in config.ipynbtest_args.ttypes.split(',')]
+        config.ipynbtest_output_types = ipt.select_output_types(
+            used_output_filter)
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_make_scheduler(config, log):
+    """keep the cells of a notebook in one worker when using pytest-xdist"""
+    if config.getoption('nbtest') and config.getoption('dist') == 'load':
+        from xdist.scheduler import LoadFileScheduling
+        return LoadFileScheduling(config, log)
+
+
+def node_path(node):
+    """the path of the file of a node as string"""
+    if PATHLIB_NODES:
+        return str(node.path)
+
+    return str(node.fspath)
+
+
+def is_notebook(path, parent):
+    return parent.config.getoption('nbtest') and \
+        str(path).endswith('.ipynb') and \
+        '.ipynb_checkpoints' not in str(path)
+
+
+if PATHLIB_NODES:
+    def pytest_collect_file(file_path, parent):
+        if is_notebook(file_path, parent):
+            return NotebookFile.from_parent(parent, path=file_path)
+else:
+    def pytest_collect_file(path, parent):
+        if is_notebook(path, parent):
+            if hasattr(NotebookFile, 'from_parent'):
+                return NotebookFile.from_parent(parent, fspath=path)
+
+            return NotebookFile(path, parent)
+
+
+class NotebookFile(pytest.File):
+    """
+    A notebook as pytest collector of its code cells
+
+    The kernel is started before the first cell of the notebook is tested and
+    shut down after the last one.
+    """
+
+    def collect(self):
+        args = self.config.ipynbtest_args
+        output_types = self.config.ipynbtest_output_types
+
+        self.kernel = ipt.IPyKernel(
+            extra_arguments=ipt.get_extra_arguments(args),
+            cwd=os.path.dirname(os.path.abspath(node_path(self))),
+            warmup=ipt.get_warmup_code(args),
+            kernel_name=ipt.get_kernel_name(args))
+
+        # the cells that have been run in the kernel
+        self.executed = set()
+
+        # the recorded durations of the cells for adaptive timeouts
+        self.cell_history = ipt.load_timings(
+            ipt.get_cell_timings_file(args)).get(
+                ipt.notebook_key(node_path(self)), {})
+
+        if args.golden:
+            nb = ipt.read_notebook(node_path(self), set())
+            ipt.apply_golden(nb.cells, ipt.load_golden(
+                ipt.golden_file(node_path(self))))
+        else:
+            nb = ipt.read_notebook(
+                node_path(self), ipt.get_output_mimes(output_types))
+
+        self.cells = []
+        self.dependencies = ipt.get_cell_dependencies(nb.cells)
+
+        for cell_index, cell in enumerate(nb.cells):
+            if cell.cell_type != 'code' or self.kernel.is_empty_cell(cell):
+                continue
+
+            commands = self.kernel.get_commands(cell)
+            self.cells.append((cell_index, cell, commands))
+
+            kwargs = dict(
+                name='Cell %d' % cell_index,
+                cell=cell, index=cell_index, commands=commands)
+
+            if hasattr(NotebookCell, 'from_parent'):
+                item = NotebookCell.from_parent(self, **kwargs)
+            else:
+                item = NotebookCell(parent=self, **kwargs)
+
+            if 'skip' in commands:
+                item.add_marker(pytest.mark.skip(reason='#! skip'))
+
+            yield item
+
+    def setup(self):
+        args = self.config.ipynbtest_args
+
+        # results are counted like `ipynbtest.py` does to decide whether a
+        # cell passed. The console also receives unexpected messages
+        self.console = ipt.create_console(args, stream=ipt.StringIO())
+        self.kernel.console = self.console
+
+        self.kernel.start()
+        self.kernel.default_timeout = args.timeout
+        self.kernel.interrupt_timeout = args.interrupt_timeout
+        self.kernel.stream_max_size = ipt.get_stream_max_size(args)
+
+        if args.eval:
+            self.kernel.execute(args.eval)
+
+    def teardown(self):
+        if self.kernel.started:
+            self.kernel.stop()
+
+    def run_cell(self, index, cell, commands):
+        """run a cell and return its outputs
+
+        The timeout of the cell is that of `ipynbtest.py`, see
+        `get_cell_timeout`. A cell that timed out is run again
+        `--rerun-if-timeout` times. If it could not be interrupted the kernel
+        is restarted and the cells before it are run again.
+
+        Raises
+        ------
+        Empty
+            if the last run of the cell timed out
+        """
+        run_count = 0
+        timeout = ipt.get_cell_timeout(
+            cell, commands, self.cell_history, self.config.ipynbtest_args)
+
+        while True:
+            run_count += 1
+            try:
+                return self.kernel.run(cell, use_timeout=timeout)
+            except ipt.Empty:
+                if self.kernel.hung:
+                    self.restart_kernel()
+                    self.run_before(index)
+
+                if run_count > self.config.ipynbtest_args.rerun:
+                    raise
+
+    def restart_kernel(self):
+        """restart a hung kernel, all cells need to be run again"""
+        self.kernel.restart()
+        self.executed = set()
+
+        if self.config.ipynbtest_args.eval:
+            self.kernel.execute(self.config.ipynbtest_args.eval)
+
+    def run_before(self, index):
+        """run the cells the cell with `index` depends on if not run yet
+
+        The cells are not tested. This happens if only some cells of the
+        notebook are tested or were given to this worker.
+        """
+        required = ipt.get_required_cells(self.dependencies, [index])
+
+        for cell_index, cell, commands in self.cells:
+            if cell_index >= index:
+                break
+
+            if cell_index in self.executed or cell_index not in required:
+                continue
+
+            self.executed.add(cell_index)
+            try:
+                self.run_cell(cell_index, cell, commands)
+            except ipt.Empty:
+                pass
+
+
+class NotebookCell(pytest.Item):
+    """
+    A code cell of a notebook as test
+
+    The cell passes or fails with the same result `ipynbtest.py` would report
+    for it.
+    """
+
+    def __init__(self, name, parent, cell=None, index=None, commands=None,
+                 **kwargs):
+        super(NotebookCell, self).__init__(name, parent, **kwargs)
+        self.cell = cell
+        self.index = index
+        self.commands = commands
+
+    def check_result(self, result, report='', okay_list=None):
+        """count a result and fail if `ipynbtest.py` would
+
+        Parameters
+        ----------
+        result : string
+            the result of the cell like `error` or `diff`
+        report : string
+            the report of the test for a failed cell
+        okay_list : dict or None (default)
+            results that pass or fail the test unlike the defaults
+
+        Raises
+        ------
+        NotebookCellFailure
+            if the cell failed the test
+        """
+        console = self.parent.console
+
+        if 'ignore' in self.commands:
+            result = 'ignore'
+
+        console.current_cell = (self.index, self.name)
+        console.write_result(result, okay_list)
+
+        if console.last_fail:
+            raise NotebookCellFailure(report)
+
+        if result == 'diff':
+            warnings.warn_explicit(
+                NotebookDiffWarning(
+                    '%s differs from the notebook\n%s' % (self.name, report)),
+                NotebookDiffWarning, self.nodeid, 0)
+
+    def runtest(self):
+        notebook = self.parent
+        commands = self.commands
+
+        notebook.run_before(self.index)
+        notebook.executed.add(self.index)
+
+        try:
+            ex_cell_outputs = notebook.run_cell(
+                self.index, self.cell, commands)
+        except ipt.Empty:
+            okay_list = None
+            if 'pass-if-timeout' in commands:
+                okay_list = {'timeout': True}
+            elif 'fail-if-timeout' in commands:
+                okay_list = {'timeout': False}
+
+            self.check_result(
+                'timeout', 'the cell did not finish in time', okay_list)
+            return
+        except Exception as e:
+            self.check_result('kernel', 'the kernel failed with %r' % (e,))
+            return
+
+        for stream in ['stdout', 'stderr']:
+            text = ''.join(
+                out.text
+                for out in ipt.get_outs(
+                    ex_cell_outputs, ['stream.%s.text/plain' % stream]))
+            if text:
+                self.add_report_section('call', stream, text)
+
+        for out in ex_cell_outputs:
+            if out.output_type == 'error':
+                report = '\n'.join(
+                    ['>>> %s ("%s")' % (out.ename, out.evalue)] +
+                    [ansi_escape_pattern.sub('', trace)
+                     for trace in out.traceback[1:]])
+                self.check_result('error', report)
+                return
+
+        args = self.config.ipynbtest_args
+        cell_output_types = ipt.get_cell_output_types(
+            self.config.ipynbtest_output_types, commands)
+        compare_options = ipt.get_compare_options(args, commands)
+
+        ex_cell_outs = ipt.get_outs(
+            ex_cell_outputs, cell_output_types, compare_options)
+        nb_cell_outs = ipt.get_outs(
+            self.cell.outputs, cell_output_types, compare_options)
+
+        lines = []
+
+        if len(ex_cell_outs) != len(nb_cell_outs):
+            lines.append('>>> diff in number of relevant content parts '
+                         '%d vs %d' % (len(ex_cell_outs), len(nb_cell_outs)))
+            lines.extend(
+                '    %36s | %s' % (orig, test)
+                for orig, test in zip_longest(
+                    nb_cell_outs, ex_cell_outs, fillvalue='---'))
+        else:
+            for o1, o2 in zip(nb_cell_outs, ex_cell_outs):
+                if o1 != o2:
+                    lines.extend(
+                        ll.rstrip('\n') for ll in o2.compare_str(o1)
+                        if ll.strip() and not ll.startswith('?'))
+
+        if lines:
+            okay_list = None
+            if 'strict' in commands:
+                okay_list = {'diff': False}
+            elif 'lazy' in commands:
+                okay_list = {'diff': True}
+
+            self.check_result('diff', '\n'.join(lines), okay_list)
+        else:
+            self.check_result('success')
+
+    def repr_failure(self, excinfo, *args, **kwargs):
+        if isinstance(excinfo.value, NotebookCellFailure):
+            return str(excinfo.value)
+
+        return super(NotebookCell, self).repr_failure(
+            excinfo, *args, **kwargs)
+
+    def reportinfo(self):
+        if self.cell.get('execution_count') is not None:
+            description = 'In [%3i]' % self.cell.execution_count
+        else:
+            description = 'In [---]'
+
+        path = node_path(self)
+        return path, self.index, '%s::%s %s' % (
+            os.path.basename(path), self.name, description)
@@ -99,7 +99,11 @@ def buildKeywordDictionary():
     setupKeywords["package_dir"]       = {
         'ipynbtest': 'ipynbtest',
     }
-    setupKeywords["scripts"]           = ['ipynbtest/ipynbtest.py']
+    setupKeywords["scripts"]           = [
+        'ipynbtest/ipynbtest.py', 'ipynbtest/ipynbtest_client.py']
+    setupKeywords["entry_points"]      = {
+        'pytest11': ['ipynbtest = ipynbtest.pytest_plugin']
+    }
     setupKeywords["package_data"]      = {
         'ipynbtest': ['ipynbtest/examples/ipynbtest_tutorial.ipynb']
     }
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# test the ipynbtest of this checkout and not an installed version
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+
+pytest_plugins = ['pytester']
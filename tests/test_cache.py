@@ -0,0 +1,75 @@
+"""tests of the result cache and its keys"""
+
+import os
+
+import nbformat
+
+from ipynbtest import ipynbtest as ipt
+
+
+def cells(*sources):
+    return [nbformat.v4.new_markdown_cell('# title')] + [
+        nbformat.v4.new_code_cell(source) for source in sources]
+
+
+def keys(cells, settings='settings', path='nb.ipynb'):
+    return ipt.get_cell_keys(cells, settings, path)
+
+
+def test_only_code_cells_have_keys():
+    assert sorted(keys(cells('x = 1', '', 'y = 2'))) == [1, 3]
+
+
+def test_key_depends_on_cells_before():
+    old = keys(cells('x = 1', 'y = 2', 'z = 3'))
+    new = keys(cells('x = 1', 'y = 3', 'z = 3'))
+
+    assert old[1] == new[1]
+    assert old[2] != new[2]
+    assert old[3] != new[3]
+
+
+def test_key_depends_on_outputs():
+    changed = cells('print(1)')
+    changed[1].outputs = [
+        nbformat.v4.new_output('stream', name='stdout', text='1\n')]
+
+    assert keys(cells('print(1)')) != keys(changed)
+
+
+def test_key_depends_on_settings_and_path():
+    key = keys(cells('x = 1'))
+
+    assert key != keys(cells('x = 1'), settings='other')
+    assert key != keys(cells('x = 1'), path=os.path.join('other', 'nb.ipynb'))
+
+
+def test_settings_change_with_options():
+    def settings(*argv):
+        return ipt.get_cache_settings(
+            ipt.get_parser().parse_args(list(argv) + ['nb.ipynb']))
+
+    assert settings() == settings('--timings', 't.json')
+    assert settings() != settings('--strict')
+    assert settings() != settings('--eval', 'x = 1')
+
+
+def test_entries_are_stored_by_key(tmpdir):
+    cache = ipt.ResultCache(str(tmpdir))
+    key = keys(cells('x = 1'))[1]
+
+    assert cache.get(key) is None
+    cache.put(key, {'result': 'success'})
+    assert cache.get(key) == {'result': 'success'}
+
+
+def test_evict_removes_least_recently_used(tmpdir):
+    cache = ipt.ResultCache(str(tmpdir), max_size=30)
+    cache.put('aa01', {'result': 'success'})
+    cache.put('aa02', {'result': 'success'})
+    os.utime(cache._file('aa01'), (1, 1))
+
+    cache.evict()
+
+    assert cache.get('aa01') is None
+    assert cache.get('aa02') == {'result': 'success'}
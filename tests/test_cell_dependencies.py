@@ -0,0 +1,71 @@
+"""tests of the names cells define and use and the cells they depend on"""
+
+import nbformat
+
+from ipynbtest import ipynbtest as ipt
+
+
+def code_cells(*sources):
+    return [nbformat.v4.new_code_cell(source) for source in sources]
+
+
+def required(sources, targets):
+    cells = code_cells(*sources)
+    return ipt.get_required_cells(ipt.get_cell_dependencies(cells), targets)
+
+
+def test_assignment_and_use():
+    defines, uses, dynamic, imports = ipt.cell_names('y = x + 1')
+    assert defines == set(['y'])
+    assert uses == set(['x'])
+    assert not dynamic
+    assert imports == set()
+
+
+def test_method_call_defines_name():
+    defines, uses, dynamic, imports = ipt.cell_names('l.append(x)')
+    assert 'l' in defines
+    assert uses == set(['l', 'x'])
+
+
+def test_item_and_augmented_assignment_define_name():
+    assert 'd' in ipt.cell_names('d["a"] = 1')[0]
+    assert 'd' in ipt.cell_names('d["a"] += 1')[0]
+    assert 'n' in ipt.cell_names('n += 1')[0]
+    assert 'obj' in ipt.cell_names('obj.attr.value = 2')[0]
+
+
+def test_method_call_inside_function_defines_nothing():
+    defines = ipt.cell_names('def f():\n    l.append(1)')[0]
+    assert defines == set(['f'])
+
+
+def test_module_function_does_not_define_module():
+    defines, _, _, imports = ipt.cell_names(
+        'import numpy as np\nnp.seterr(all="ignore")')
+    assert imports == set(['np'])
+
+    defines = ipt.cell_names('x = np.zeros(3)', modules=['np'])[0]
+    assert defines == set(['x'])
+
+
+def test_mutating_cell_is_replayed():
+    sources = ['x = 1', 'l = []', 'l.append(x)', 'print(l)']
+    assert required(sources, [3]) == set([0, 1, 2, 3])
+
+
+def test_module_calls_do_not_chain_cells():
+    sources = [
+        'import numpy as np', 'a = np.zeros(3)', 'b = np.ones(3)', 'print(b)']
+    assert required(sources, [3]) == set([0, 2, 3])
+
+
+def test_dynamic_cell():
+    assert ipt.cell_names('exec("x = 1")')[2]
+    assert ipt.cell_names('%run script.py')[2]
+    assert not ipt.cell_names('%matplotlib inline')[2]
+
+
+def test_commands_change_names():
+    sources = ['data = []', '#! defines:data\nadd_to(data)', 'print(data)']
+    assert required(sources, [2]) == set([0, 1, 2])
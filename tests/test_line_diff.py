@@ -0,0 +1,48 @@
+"""tests of the line by line diff of outputs"""
+
+from ipynbtest import ipynbtest as ipt
+
+
+def diff(original, testing, **kwargs):
+    return list(ipt.line_diff(original, testing, **kwargs))
+
+
+def numbered(n):
+    return '\n'.join('line %d' % i for i in range(n))
+
+
+def test_equal_texts_have_no_diff():
+    assert diff('a\nb\n', 'a\nb\n') == []
+
+
+def test_changed_line():
+    assert diff('a\nb\nc', 'a\nB\nc') == ['  a', '- b', '+ B', '  c']
+
+
+def test_added_and_removed_lines():
+    assert diff('a\nb', 'a\nb\nc') == ['  a', '  b', '+ c']
+    assert diff('a\nb\nc', 'b\nc') == ['- a', '  b', '  c']
+
+
+def test_unchanged_lines_far_from_changes_are_left_out():
+    lines = diff(numbered(20), numbered(20).replace('line 10', 'changed'))
+
+    assert lines == (
+        ['  ...'] + ['  line %d' % i for i in range(7, 10)] +
+        ['- line 10', '+ changed'] +
+        ['  line %d' % i for i in range(11, 14)] + ['  ...'])
+
+
+def test_context():
+    lines = diff(numbered(5), numbered(5).replace('line 2', 'changed'),
+                 context=0)
+
+    assert lines == ['  ...', '- line 2', '+ changed', '  ...']
+
+
+def test_max_lines():
+    lines = diff(numbered(10), '', max_lines=3)
+
+    assert lines == [
+        '- line 0', '- line 1', '- line 2',
+        '  ... diff truncated after 3 lines']
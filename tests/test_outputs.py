@@ -0,0 +1,46 @@
+"""tests of comparing outputs"""
+
+import pytest
+
+from ipynbtest import ipynbtest as ipt
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def stdout(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(ipt, 'np', None)
+
+    def create(text, **options):
+        output = ipt.NumericStdOutOutput(
+            {'output_type': 'stream', 'name': 'stdout', 'text': text})
+        output.options = options
+        return output
+
+    return create
+
+
+def test_numbers_within_tolerance_match(stdout):
+    assert stdout('x = 1.0000001, y = 2\n') == stdout('x = 1, y = 2.0\n')
+    assert stdout('x = 1.1\n') != stdout('x = 1\n')
+    assert stdout('x = 1.1\n', rtol='0.2') == stdout('x = 1\n')
+
+
+def test_text_around_numbers_has_to_match(stdout):
+    assert stdout('x = 1\n') != stdout('y = 1\n')
+    assert stdout('x = 1\n') != stdout('x = #\n')
+
+
+def test_equal_infinities_match(stdout):
+    assert stdout('1e400 2.0000001\n') == stdout('1e400 2\n')
+    assert stdout('-1e400 2.0000001\n') == stdout('-2e400 2\n')
+    assert stdout('1e400 2\n') != stdout('-1e400 2\n')
+    assert stdout('1 2.0000001\n') != stdout('1e400 2\n')
+    assert stdout('1e400 2.0000001\n') != stdout('1 2\n')
+
+
+def test_diff_shows_largest_difference(stdout):
+    lines = stdout('1e400 1 2\n').compare_str(stdout('1e400 1 3\n'))
+    assert '1 of 3 numbers differ' in lines[1]
+    assert '(max absolute difference 1)' in lines[1]
@@ -0,0 +1,55 @@
+"""tests of the pytest plugin"""
+
+import os
+import sys
+import json
+import hashlib
+import subprocess
+
+import nbformat
+import pytest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture
+def nbtest(testdir, monkeypatch):
+    monkeypatch.setenv('PYTHONPATH', root)
+
+    def run(sources, *args):
+        nb = nbformat.v4.new_notebook()
+        nb.cells = [nbformat.v4.new_code_cell(source) for source in sources]
+        nbformat.write(nb, str(testdir.tmpdir.join('nb.ipynb')))
+
+        return testdir.runpytest_subprocess(
+            '-p', 'ipynbtest.pytest_plugin', '--nbtest', *args)
+
+    return run
+
+
+def test_plugin_does_not_import_jupyter_without_nbtest():
+    code = (
+        'import sys, ipynbtest.pytest_plugin; '
+        'print(sorted(set(["jupyter_client", "zmq", "nbformat"]) & '
+        'set(sys.modules)))')
+    output = subprocess.check_output(
+        [sys.executable, '-c', code], cwd=root)
+    assert output.decode('ascii').strip() == '[]'
+
+
+def test_cells_are_tests(nbtest):
+    result = nbtest(['x = 1', 'print(x)', 'raise ValueError("cell")'])
+    result.assert_outcomes(passed=2, failed=1)
+
+
+def test_recorded_durations_give_timeout(nbtest, testdir):
+    source = 'import time\ntime.sleep(10)'
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    testdir.tmpdir.join('timings.cells.json').write(
+        json.dumps({'nb.ipynb': {key: [0.1]}}))
+
+    result = nbtest(
+        [source], '--nbtest-args=--timings timings.json '
+        '--timeout-factor 2 --min-timeout 1 --interrupt-timeout 2')
+    result.assert_outcomes(failed=1)
+    result.stdout.fnmatch_lines(['*did not finish in time*'])
@@ -0,0 +1,54 @@
+"""tests of skipping the outputs that are not compared when reading"""
+
+import json
+
+import nbformat
+
+from ipynbtest import ipynbtest as ipt
+
+IMAGE = 'iVBORw0KGgo' * 200
+
+
+def notebook_json(markdown):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = [
+        nbformat.v4.new_markdown_cell(markdown),
+        nbformat.v4.new_code_cell('show()', outputs=[
+            nbformat.v4.new_output('display_data', data={
+                'image/png': IMAGE, 'text/plain': '<Figure>'})])]
+    return nbformat.writes(nb).encode('utf-8')
+
+
+def test_skip_outputs_replaces_large_values():
+    data = notebook_json('# title')
+    skipped = json.loads(ipt.skip_outputs(data, set(['text/plain'])))
+    output = skipped['cells'][1]['outputs'][0]
+
+    assert output['data']['text/plain'] == ['<Figure>']
+    assert output['data']['image/png'].startswith('skipped image/png')
+    assert IMAGE not in output['data']['image/png']
+
+
+def test_skip_outputs_keeps_tested_and_small_values():
+    data = notebook_json('# title')
+    assert ipt.skip_outputs(data, set(['image/png', 'text/plain'])) is None
+    assert ipt.skip_outputs(data, set(), min_size=10 ** 6) is None
+
+
+def test_skipped_value_does_not_depend_on_position():
+    def outputs(markdown):
+        skipped = json.loads(ipt.skip_outputs(
+            notebook_json(markdown), set(['text/plain'])))
+        return skipped['cells'][1]['outputs']
+
+    assert outputs('# title') == outputs('# a longer title')
+
+
+def test_cell_keys_ignore_changes_of_other_cells(tmpdir):
+    def keys(markdown):
+        path = tmpdir.join('nb.ipynb')
+        path.write_binary(notebook_json(markdown))
+        nb = ipt.read_notebook(str(path), set(['text/plain']))
+        return ipt.get_cell_keys(nb.cells, 'settings', str(path))
+
+    assert keys('# title') == keys('# a longer title')
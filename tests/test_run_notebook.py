@@ -0,0 +1,61 @@
+"""tests of running notebooks in a kernel"""
+
+import nbformat
+
+from ipynbtest import ipynbtest as ipt
+
+
+def write_notebook(path, cells):
+    nb = nbformat.v4.new_notebook()
+    nb.cells = cells
+    nbformat.write(nb, str(path))
+    return str(path)
+
+
+def check(path, *argv, **kwargs):
+    args = ipt.get_parser().parse_args(
+        ['--no-cache'] + list(argv) + [path])
+    output_types = ipt.select_output_types(
+        [name.strip() for name in args.ttypes.split(',')])
+    tv = ipt.create_console(args, stream=ipt.StringIO())
+    return ipt.check_notebook(
+        path, args, output_types, tv, session=kwargs.get('session'))
+
+
+def test_restart_from_checkpoint_keeps_results(tmpdir):
+    path = write_notebook(tmpdir.join('nb.ipynb'), [
+        nbformat.v4.new_code_cell('x = 1'),
+        nbformat.v4.new_code_cell('#! checkpoint\ny = 2'),
+        nbformat.v4.new_code_cell('#! strict\nprint(x + y)', outputs=[
+            nbformat.v4.new_output('stream', name='stdout', text='4\n')])])
+
+    result = check(path, '--restart-if-fail', '1')
+
+    assert [cell[:3] for cell in result['cells']] == [
+        (0, 'In [---]', 'success'),
+        (1, 'In [---]', 'success'),
+        (2, 'In [---]', 'diff')]
+    assert (result['pass_count'], result['fail_count']) == (2, 1)
+
+
+def test_session_keeps_results_of_cells_not_run_again(tmpdir):
+    path = write_notebook(tmpdir.join('nb.ipynb'), [
+        nbformat.v4.new_code_cell('x = 1'),
+        nbformat.v4.new_code_cell('#! strict\nprint(x)', outputs=[
+            nbformat.v4.new_output('stream', name='stdout', text='2\n')]),
+        nbformat.v4.new_code_cell('y = 3')])
+    session = ipt.NotebookSession()
+    try:
+        result = check(path, '--abort-if-fail', session=session)
+        assert (result['pass_count'], result['fail_count']) == (1, 1)
+
+        # only the cell after the failed one is run again
+        result = check(path, '--abort-if-fail', session=session)
+    finally:
+        session.stop()
+
+    assert [cell[:3] for cell in result['cells']] == [
+        (0, 'In [---]', 'success'),
+        (1, 'In [---]', 'diff'),
+        (2, 'In [---]', 'success')]
+    assert (result['pass_count'], result['fail_count']) == (2, 1)
@@ -0,0 +1,66 @@
+"""tests of `ipynbtest.py --serve` and `ipynbtest_client.py`"""
+
+import os
+import sys
+import time
+import signal
+import subprocess
+
+import pytest
+
+package = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'ipynbtest')
+
+
+@pytest.fixture
+def server(tmpdir):
+    path = str(tmpdir.join('ipynbtest.sock'))
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(package, 'ipynbtest.py'),
+         '--serve', path],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + 60
+    while not os.path.exists(path):
+        assert process.poll() is None, process.stdout.read()
+        assert time.time() < deadline, 'the server did not start'
+        time.sleep(0.1)
+
+    yield process, path
+
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def client(path, *argv):
+    return subprocess.call(
+        [sys.executable, os.path.join(package, 'ipynbtest_client.py'),
+         '--socket', path] + list(argv),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def test_client_gets_exit_code_of_job(server):
+    process, path = server
+
+    # the job fails like `ipynbtest.py` without a notebook
+    assert client(path) == 2
+
+    # the server keeps running after a failed job
+    assert process.poll() is None
+
+
+def test_ctrl_c_stops_server(server):
+    process, path = server
+
+    process.send_signal(signal.SIGINT)
+    output = process.communicate()[0].decode('utf-8')
+
+    assert process.returncode == 0
+    assert 'server stopped' in output
+    assert 'usage:' not in output
+    assert not os.path.exists(path)
+
+
+def test_client_without_server(tmpdir):
+    assert client(str(tmpdir.join('missing.sock')), 'notebook.ipynb') == 2
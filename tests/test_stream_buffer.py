@@ -0,0 +1,32 @@
+"""tests of collecting output streams"""
+
+from ipynbtest import ipynbtest as ipt
+
+
+def write_in_chunks(text, size, max_size):
+    buf = ipt.StreamBuffer(max_size)
+    for start in range(0, len(text), size):
+        buf.write(text[start:start + size])
+
+    return buf.getvalue()
+
+
+def test_result_does_not_depend_on_chunks():
+    text = ''.join(
+        ''.join('%d%%\r' % p for p in range(0, 101, 10)) + 'line %d\n' % i
+        for i in range(100))
+    expected = ipt.stream_text(text, 300)
+
+    assert 'characters skipped' in expected
+    for size in [1, 3, 7, 64, len(text)]:
+        assert write_in_chunks(text, size, 300) == expected
+
+
+def test_long_line_is_cut_as_it_arrives():
+    text = 'x' * 500 + '\rdone\n'
+
+    # in one piece the carriage return replaces the long line
+    assert ipt.stream_text(text, 300) == 'done\n'
+
+    # in chunks the beginning is cut before the carriage return arrives
+    assert 'characters skipped' in write_in_chunks(text, 100, 300)
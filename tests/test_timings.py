@@ -0,0 +1,48 @@
+"""tests of the timing history"""
+
+import os
+import stat
+
+import nbformat
+
+from ipynbtest import ipynbtest as ipt
+
+
+def parse(*argv):
+    return ipt.get_parser().parse_args(list(argv) + ['notebook.ipynb'])
+
+
+def test_history_is_readable_like_a_new_file(tmpdir):
+    path = str(tmpdir.join('history', 'timings.json'))
+    ipt.write_history(path, {'a.ipynb': 1.0})
+
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~umask
+    assert ipt.load_timings(path) == {'a.ipynb': 1.0}
+
+
+def test_cached_results_are_not_recorded(tmpdir):
+    path = str(tmpdir.join('timings.json'))
+    ipt.save_timings(path, [
+        {'file': 'a.ipynb', 'run_time': 10.0, 'cached': False}])
+    ipt.save_timings(path, [
+        {'file': 'a.ipynb', 'run_time': 0.1, 'cached': True}])
+
+    assert ipt.load_timings(path) == {'a.ipynb': 10.0}
+
+
+def test_no_cache_keeps_no_timings():
+    assert ipt.keeps_timings(parse())
+    assert not ipt.keeps_timings(parse('--no-cache'))
+    assert ipt.keeps_timings(parse('--no-cache', '--timings', 't.json'))
+
+
+def test_cell_timeout():
+    cell = nbformat.v4.new_code_cell('x = 1')
+    history = {ipt.cell_key(cell): [1.0, 2.0, 3.0]}
+    args = parse('--timeout', '60', '--min-timeout', '5')
+
+    assert ipt.get_cell_timeout(cell, {'timeout': '0.5'}, history, args) == 0.5
+    assert ipt.get_cell_timeout(cell, {}, history, args) == 15.0
+    assert ipt.get_cell_timeout(cell, {}, {}, args) == 60